@@ -11,9 +11,21 @@ import time
 import datetime
 import serial
 import math
+import array
 import struct
 import decimal
+import select
+import glob
+import mmap
+import zlib
+import signal
 import traceback
+import cProfile
+
+try:
+	from collections.abc import Mapping
+except ImportError:
+	from collections import Mapping
 
 # setup timezone
 os.environ['TZ'] = 'Europe/Berlin'
@@ -37,7 +49,20 @@ driver = {
 	'connection'  : "com.victronenergy.battery.ttyCHGBMS01"
 }
 
-logging.info("Starting Chargery BMS driver " + str(driver['version']))
+# combined battery of all BMS with --aggregate
+AGGREGATE_CONNECTION = "com.victronenergy.battery.chargerybms_aggregate"
+AGGREGATE_NAME       = "Chargery BMS Aggregate"
+
+
+# argparse type of --speed, a factor of 0 or less has no replay time
+def positive_float(text):
+	try:
+		value = float(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid number: " + text)
+	if (value <= 0):
+		raise argparse.ArgumentTypeError("must be greater than 0: " + text)
+	return value
 
 
 parser = argparse.ArgumentParser(description = 'Chargery BMS driver')
@@ -45,1619 +70,2383 @@ parser.add_argument('--version', action='version', version='%(prog)s v' + str(dr
 parser.add_argument('--debug', action="store_true", help='enable debug logging')
 parser.add_argument('--test', action="store_true", help='test some stored examples network packets')
 parser.add_argument('--victron', action="store_true", help='enable Victron DBUS support for VenusOS')
+parser.add_argument('--log-digest', type=int, default=0, metavar='SECONDS', help='log one min/avg/max summary every SECONDS instead of a line per frame')
+parser.add_argument('--history', type=int, default=0, metavar='MINUTES', help='keep the samples of the last MINUTES and per minute and per hour rollups in memory')
+parser.add_argument('--history-dump', metavar='FILE', help='write the --history as CSV to FILE on kill -USR1')
+parser.add_argument('--store', metavar='DIRECTORY', help='append the cell voltages and impedances to daily history files in DIRECTORY')
+parser.add_argument('--store-interval', type=int, default=300, metavar='SECONDS', help='seconds between two writes of the history files (default 300)')
+parser.add_argument('--aggregate', action="store_true", help='publish one combined battery of all BMS given with -d')
+parser.add_argument('--probe', type=int, nargs='?', const=1, metavar='COUNT', help='find the serial ports of COUNT BMS (default 1) among the -d devices or all USB serial ports and drive them')
+parser.add_argument('--probe-time', type=float, default=3, metavar='SECONDS', help='seconds to listen for frames with --probe (default 3)')
+parser.add_argument('--stale', type=float, default=0, metavar='SECONDS', help='invalidate the values of a packet type and raise /Alarms/BmsCable if no frame of it arrived for SECONDS, 0 = never (default)')
+parser.add_argument('--event-driven', action="store_true", help='read serial data as soon as it arrives instead of polling every second')
+parser.add_argument('--record', metavar='FILE', help='append the raw serial data with timestamps to a capture file')
+parser.add_argument('--replay', metavar='FILE', help='decode a capture file instead of reading the serial device')
+parser.add_argument('--profile', metavar='FILE', help='run under cProfile and write the stats to FILE every profile interval')
+parser.add_argument('--profile-interval', type=int, default=300, metavar='SECONDS', help='seconds between two profile stats files (default 300)')
+replayArguments = parser.add_mutually_exclusive_group()
+replayArguments.add_argument('--speed', type=positive_float, default=1.0, help='replay speed factor (default 1.0 = real time)')
+replayArguments.add_argument('--max', action="store_true", help='replay as fast as possible')
 requiredArguments = parser.add_argument_group('required arguments')
-requiredArguments.add_argument('-d', '--device', help='serial device for data (eg /dev/ttyUSB0)', required=True)
-args = parser.parse_args()
+requiredArguments.add_argument('-d', '--device', action='append', help='serial device for data (eg /dev/ttyUSB0), repeat it for several BMS, not needed with --replay or --test')
 
-if args.debug: # switch to debug level
-	logger = logging.getLogger()
-	logger.setLevel(logging.DEBUG)
 
+PACKET_HEADER             = 0x24
+PACKET_STATUS_CELLS       = 0x56
+PACKET_STATUS_BMS         = 0x57
+PACKET_STATUS_IMPEDANCES  = 0x58
 
-# victron stuff should be used
-if args.victron:
+PACKET_LENGTH_MINIMUM            = 10
+PACKET_LENGTH_MAXIMUM            = 61
+PACKET_LENGTH_STATUS_CELLS       = [29, 45, 61]
+PACKET_LENGTH_STATUS_BMS         = [19]
 
-	# Victron packages
-	sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
-	from vedbus import VeDbusService
+# Special handling here: the impedances packet length is dynamically
+# and depends on how many cells are monitored. The minimum length of
+# the network packet with headers, command, length, currentmode1, current1
+# and checksum is 8 bytes. On 6 monitored cells the packet length will
+# be 8+(2*6) = 20 bytes. Therefore, the smallest possible and valid
+# impedances network packet will be 10 bytes
+PACKET_LENGTH_STATUS_IMPEDANCES  = 10
 
+# BMS8, BMS16 and BMS24, the impedances packet holds at most 24 cells
+MAX_CELL_COUNT = 24
 
-	from dbus.mainloop.glib import DBusGMainLoop
-	DBusGMainLoop(set_as_default=True)
+PACKET_HEADER_BYTES = bytes(bytearray([PACKET_HEADER, PACKET_HEADER]))
 
-	dbusservice = VeDbusService(driver['connection'])
+# the serial port is read straight into this buffer, a full tty buffer
+# (4095 bytes on Linux) fits next to the bytes of an incomplete frame
+RECEIVE_BUFFER_SIZE = 4096 + PACKET_LENGTH_MAXIMUM
 
-	# Create the management objects, as specified in the ccgx dbus-api document
-	dbusservice.add_path('/Mgmt/ProcessName', __file__)
-	dbusservice.add_path('/Mgmt/ProcessVersion', 'Unknown and Python ' + platform.python_version())
-	dbusservice.add_path('/Mgmt/Connection', driver['connection'])
+# names of the packet types in the /Diagnostics paths
+PACKET_NAMES = {
+	PACKET_STATUS_CELLS      : "Cells",
+	PACKET_STATUS_BMS        : "Status",
+	PACKET_STATUS_IMPEDANCES : "Impedances"
+}
 
-	# Create the mandatory objects
-	dbusservice.add_path('/DeviceInstance',  driver['instance'])
-	dbusservice.add_path('/ProductId',       driver['id'])
-	dbusservice.add_path('/ProductName',     driver['name'])
-	dbusservice.add_path('/FirmwareVersion', driver['version'])
-	dbusservice.add_path('/HardwareVersion', driver['version'])
-	dbusservice.add_path('/Serial',          driver['serial'])
-	dbusservice.add_path('/Connected',       1)
-	
-	# Create alarms
-	dbusservice.add_path('/Alarms/InternalFailure', 0)
+# seconds between two updates of the /Diagnostics paths
+DIAGNOSTICS_INTERVAL = 10
+
+# a lost serial port is reopened after RECONNECT_DELAY seconds, every
+# failed attempt doubles the delay up to RECONNECT_DELAY_MAX seconds
+RECONNECT_DELAY     = 1
+RECONNECT_DELAY_MAX = 60
+
+# seconds between two checks for stale packet types with --stale
+STALE_CHECK_INTERVAL = 1
+
+# candidate ports of --probe without -d
+PROBE_PATTERNS = ('/dev/ttyUSB*', '/dev/ttyACM*')
+
+# stats files kept by --profile, FILE and FILE.1 up to FILE.4
+PROFILE_FILES = 5
+
+# processing stages measured by the stage timers
+STAGE_READ      = 0
+STAGE_FRAMING   = 1
+STAGE_DECODE    = 2
+STAGE_AGGREGATE = 3
+STAGE_PUBLISH   = 4
+STAGE_NAMES     = ("Read", "Framing", "Decode", "Aggregate", "Publish")
+
+# latencies kept per packet type for the percentiles, about 10 minutes
+LATENCY_SAMPLES = 600
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# history buckets, per minute for 6 hours and per hour for 7 days. The
+# raw samples are sized for one frame per second and type.
+HISTORY_SAMPLE_RATE = 1
+HISTORY_MINUTES     = 6 * 60
+HISTORY_HOURS       = 7 * 24
+
+# channels of the status history
+HISTORY_CURRENT   = 0
+HISTORY_SENSOR_T1 = 1
+HISTORY_SENSOR_T2 = 2
+HISTORY_STATUS_CHANNELS = 3
+HISTORY_STATUS_NAMES = ('current', 't1', 't2')
+
+# History files hold blocks of rows, one block per write. A block is the
+# header (first and last timestamp, rows, cells, data bytes), the
+# timestamps as doubles and one column of floats per cell, little endian.
+# The files of past days are compressed block by block.
+STORE_BLOCK             = struct.Struct('<ddIII4x')
+STORE_KINDS             = ("voltages", "impedances")
+STORE_DAY_FORMAT        = '%Y%m%d'
+STORE_SUFFIX            = '.col'
+STORE_COMPRESSED_SUFFIX = '.col.z'
+
+
+# Precompiled frame layouts, one unpack_from call decodes all fields of
+# a frame. The cell voltages are sent big endian and the battery capacities
+# little endian, so the cells frame needs a second layout for them.
+STATUS_BMS_LAYOUT = struct.Struct('>4xHBHHHBHBB')
+
+STATUS_CELLS_LAYOUTS = dict(
+	(4 + (2 * cell_count) + 8 + 1, (cell_count, struct.Struct('>4x' + str(cell_count) + 'H'), struct.Struct('<II')))
+	for cell_count in (8, 16, 24))
+
+STATUS_IMPEDANCES_LAYOUTS = dict(
+	(packet_length, (int((packet_length - 8) / 2), struct.Struct('<4xBH' + str(int((packet_length - 8) / 2)) + 'H')))
+	for packet_length in range(PACKET_LENGTH_STATUS_IMPEDANCES, 8 + (2 * MAX_CELL_COUNT) + 2))
+
+
+# Capture files start with the magic, followed by one record per serial
+# read: wall clock timestamp, data length and the raw data
+CAPTURE_MAGIC  = b'CHGBMSCAP1'
+CAPTURE_RECORD = struct.Struct('<dH')
+
+# Stored example network packets for --test: cells of a BMS8, BMS16 and
+# BMS24, status packets with charge, discharge (negative temperatures)
+# and storage mode and impedances of 8, 16 and 24 cells
+TEST_PACKETS = [
+	'2424561d0cf00ce90cf90ce20cee0ceb0cf30ce500204e00006a180070',
+	'2424562d0d490d460d4d0d520d430d4a0d470d4c0d480d450d4e0d4b0d440d490d500d4700409c00400d03005f',
+	'2424563d0cd80cdf0ce60ced0cdd0ce40ceb0cdb0ce20ce90cd90ce00ce70cee0cde0ce50cec0cdc0ce30cea0cda0ce10ce80cd80060ea00400d0300d2',
+	'242457130e420100eb00d700c6560af00000db',
+	'242457130e100005f0ffc9ff882a0b5400019e',
+	'242457130dde020000ffff000a640abe0100d4',
+	'2424581801c80078007b007e00810079007c007f00820069',
+	'2424582800f005730078007d0075007a007f0077007c00740079007e0076007b00730078007d004a',
+	'2424583800e0016e0075007c00720079006f0076007d0073007a00700077007e0074007b00710078006e0075007c00720079006f007600be'
+]
 
-	# Create device list
-	dbusservice.add_path('/Devices/0/DeviceInstance',  driver['instance'])
-	dbusservice.add_path('/Devices/0/FirmwareVersion', driver['version'])
-	dbusservice.add_path('/Devices/0/ProductId',       driver['id'])
-	dbusservice.add_path('/Devices/0/ProductName',     driver['name'])
-	dbusservice.add_path('/Devices/0/ServiceName',     driver['servicename'])
-	dbusservice.add_path('/Devices/0/VregLink',        "(API)")
 
-	# Create the chargery bms paths
-	dbusservice.add_path('/Info/Soc',                      -1)
-	dbusservice.add_path('/Info/CurrentMode',              -1)
-	dbusservice.add_path('/Info/Current',                  -1)
-	dbusservice.add_path('/Info/Temp/Sensor1',             -1)
-	dbusservice.add_path('/Info/Temp/Sensor2',             -1)
-	dbusservice.add_path('/Info/ChargeEndVoltage',         -1)
-	dbusservice.add_path('/Info/DischargeEndVoltage',      -1)
-	dbusservice.add_path('/Info/ChargeRelayStatus',        -1)
-	dbusservice.add_path('/Info/DischargeRelayStatus',     -1)
-	dbusservice.add_path('/Info/UpdateTimestamp',          -1)
-	dbusservice.add_path('/Voltages/Cell1',                -1)
-	dbusservice.add_path('/Voltages/Cell2',                -1)
-	dbusservice.add_path('/Voltages/Cell3',                -1)
-	dbusservice.add_path('/Voltages/Cell4',                -1)
-	dbusservice.add_path('/Voltages/Cell5',                -1)
-	dbusservice.add_path('/Voltages/Cell6',                -1)
-	dbusservice.add_path('/Voltages/Cell7',                -1)
-	dbusservice.add_path('/Voltages/Cell8',                -1)
-	dbusservice.add_path('/Voltages/Cell9',                -1)
-	dbusservice.add_path('/Voltages/Cell10',               -1)
-	dbusservice.add_path('/Voltages/Cell11',               -1)
-	dbusservice.add_path('/Voltages/Cell12',               -1)
-	dbusservice.add_path('/Voltages/Cell13',               -1)
-	dbusservice.add_path('/Voltages/Cell14',               -1)
-	dbusservice.add_path('/Voltages/Cell15',               -1)
-	dbusservice.add_path('/Voltages/Cell16',               -1)
-	dbusservice.add_path('/Voltages/Cell17',               -1)
-	dbusservice.add_path('/Voltages/Cell18',               -1)
-	dbusservice.add_path('/Voltages/Cell19',               -1)
-	dbusservice.add_path('/Voltages/Cell20',               -1)
-	dbusservice.add_path('/Voltages/Cell21',               -1)
-	dbusservice.add_path('/Voltages/Cell22',               -1)
-	dbusservice.add_path('/Voltages/Cell23',               -1)
-	dbusservice.add_path('/Voltages/Cell24',               -1)
-	dbusservice.add_path('/Voltages/Sum',                  -1)
-	dbusservice.add_path('/Voltages/Diff',                 -1)
-	dbusservice.add_path('/Voltages/Max',                  -1)
-	dbusservice.add_path('/Voltages/Min',                  -1)
-	dbusservice.add_path('/Voltages/Avg',                  -1)
-	dbusservice.add_path('/Voltages/BatteryCapacityWH',    -1)
-	dbusservice.add_path('/Voltages/BatteryCapacityAH',    -1)
-	dbusservice.add_path('/Voltages/UpdateTimestamp',      -1)
-	dbusservice.add_path('/Impedances/CurrentMode1',       -1)
-	dbusservice.add_path('/Impedances/Current1',           -1)
-	dbusservice.add_path('/Impedances/Cell1',              -1)
-	dbusservice.add_path('/Impedances/Cell2',              -1)
-	dbusservice.add_path('/Impedances/Cell3',              -1)
-	dbusservice.add_path('/Impedances/Cell4',              -1)
-	dbusservice.add_path('/Impedances/Cell5',              -1)
-	dbusservice.add_path('/Impedances/Cell6',              -1)
-	dbusservice.add_path('/Impedances/Cell7',              -1)
-	dbusservice.add_path('/Impedances/Cell8',              -1)
-	dbusservice.add_path('/Impedances/Cell9',              -1)
-	dbusservice.add_path('/Impedances/Cell10',             -1)
-	dbusservice.add_path('/Impedances/Cell11',             -1)
-	dbusservice.add_path('/Impedances/Cell12',             -1)
-	dbusservice.add_path('/Impedances/Cell13',             -1)
-	dbusservice.add_path('/Impedances/Cell14',             -1)
-	dbusservice.add_path('/Impedances/Cell15',             -1)
-	dbusservice.add_path('/Impedances/Cell16',             -1)
-	dbusservice.add_path('/Impedances/Cell17',             -1)
-	dbusservice.add_path('/Impedances/Cell18',             -1)
-	dbusservice.add_path('/Impedances/Cell19',             -1)
-	dbusservice.add_path('/Impedances/Cell20',             -1)
-	dbusservice.add_path('/Impedances/Cell21',             -1)
-	dbusservice.add_path('/Impedances/Cell22',             -1)
-	dbusservice.add_path('/Impedances/Cell23',             -1)
-	dbusservice.add_path('/Impedances/Cell24',             -1)
-	dbusservice.add_path('/Impedances/Sum',                -1)
-	dbusservice.add_path('/Impedances/Diff',               -1)
-	dbusservice.add_path('/Impedances/Max',                -1)
-	dbusservice.add_path('/Impedances/Min',                -1)
-	dbusservice.add_path('/Impedances/Avg',                -1)
-	dbusservice.add_path('/Impedances/UpdateTimestamp',    -1)
-
-
-	# Create the real values paths
-	dbusservice.add_path('/Raw/Info/Soc',                      -1)
-	dbusservice.add_path('/Raw/Info/CurrentMode',              -1)
-	dbusservice.add_path('/Raw/Info/Current',                  -1)
-	dbusservice.add_path('/Raw/Info/Temp/Sensor1',             -1)
-	dbusservice.add_path('/Raw/Info/Temp/Sensor2',             -1)
-	dbusservice.add_path('/Raw/Info/ChargeEndVoltage',         -1)
-	dbusservice.add_path('/Raw/Info/DischargeEndVoltage',      -1)
-	dbusservice.add_path('/Raw/Info/ChargeRelayStatus',        -1)
-	dbusservice.add_path('/Raw/Info/DischargeRelayStatus',     -1)
-	dbusservice.add_path('/Raw/Info/UpdateTimestamp',          -1)
-	dbusservice.add_path('/Raw/Voltages/Cell1',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell2',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell3',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell4',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell5',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell6',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell7',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell8',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell9',                -1)
-	dbusservice.add_path('/Raw/Voltages/Cell10',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell11',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell12',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell13',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell14',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell15',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell16',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell17',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell18',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell19',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell20',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell21',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell22',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell23',               -1)
-	dbusservice.add_path('/Raw/Voltages/Cell24',               -1)
-	dbusservice.add_path('/Raw/Voltages/Sum',                  -1)
-	dbusservice.add_path('/Raw/Voltages/Diff',                 -1)
-	dbusservice.add_path('/Raw/Voltages/Max',                  -1)
-	dbusservice.add_path('/Raw/Voltages/Min',                  -1)
-	dbusservice.add_path('/Raw/Voltages/Avg',                  -1)
-	dbusservice.add_path('/Raw/Voltages/BatteryCapacityWH',    -1)
-	dbusservice.add_path('/Raw/Voltages/BatteryCapacityAH',    -1)
-	dbusservice.add_path('/Raw/Voltages/UpdateTimestamp',      -1)
-	dbusservice.add_path('/Raw/Impedances/CurrentMode1',       -1)
-	dbusservice.add_path('/Raw/Impedances/Current1',           -1)
-	dbusservice.add_path('/Raw/Impedances/Cell1',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell2',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell3',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell4',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell5',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell6',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell7',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell8',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell9',              -1)
-	dbusservice.add_path('/Raw/Impedances/Cell10',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell11',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell12',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell13',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell14',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell15',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell16',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell17',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell18',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell19',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell20',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell21',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell22',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell23',             -1)
-	dbusservice.add_path('/Raw/Impedances/Cell24',             -1)
-	dbusservice.add_path('/Raw/Impedances/Sum',                -1)
-	dbusservice.add_path('/Raw/Impedances/Diff',               -1)
-	dbusservice.add_path('/Raw/Impedances/Max',                -1)
-	dbusservice.add_path('/Raw/Impedances/Min',                -1)
-	dbusservice.add_path('/Raw/Impedances/Avg',                -1)
-	dbusservice.add_path('/Raw/Impedances/UpdateTimestamp',    -1)
+MIN_CELL_VOLTAGE   = 1.0
+MIN_CELL_IMPEDANCE = 0.0
 
+# Again special handling: Negative temperatures will result in
+# a buffer overflow we do handle this if temperature values
+# are retruned above 65000 which is about - 53,6 degree celsius
+MINUS_TEMPERATURE_OFFSET = 65000
 
-try:
+# Maximum number of rendered texts kept per formatter
+TEXT_CACHE_SIZE = 1024
+
+# D-Bus paths of the cells, built once instead of for every frame
+CELL_VOLTAGE_PATHS       = ["/Voltages/Cell" + str(i) for i in range(1, MAX_CELL_COUNT+1)]
+CELL_VOLTAGE_RAW_PATHS   = ["/Raw/Voltages/Cell" + str(i) for i in range(1, MAX_CELL_COUNT+1)]
+CELL_IMPEDANCE_PATHS     = ["/Impedances/Cell" + str(i) for i in range(1, MAX_CELL_COUNT+1)]
+CELL_IMPEDANCE_RAW_PATHS = ["/Raw/Impedances/Cell" + str(i) for i in range(1, MAX_CELL_COUNT+1)]
+
+# D-Bus schema of a BMS service as (path, initial value). The management
+# and device paths are added by create_service(), the cell paths by
+# add_cell_paths() once the first frame shows the number of cells.
+DIAGNOSTICS_PATHS = (
+	[(path, 0) for path in ('/Diagnostics/BytesPerSecond', '/Diagnostics/BytesReceived', '/Diagnostics/BytesDropped',
+		'/Diagnostics/Resyncs', '/Diagnostics/ChecksumErrors', '/Diagnostics/TruncatedFrames', '/Diagnostics/SerialBufferHighWater',
+		'/Diagnostics/PublishQueue/Depth', '/Diagnostics/PublishQueue/HighWater', '/Diagnostics/PublishQueue/Dropped',
+		'/Diagnostics/Reconnects')] +
+	[('/Diagnostics/ReconnectSeconds', -1)] +
+	[('/Diagnostics/Stale/' + name, 0) for name in PACKET_NAMES.values()] +
+	[('/Diagnostics/Frames/' + name, 0) for name in PACKET_NAMES.values()] +
+	[('/Diagnostics/FramesPerSecond/' + name, 0) for name in PACKET_NAMES.values()] +
+	[('/Diagnostics/Latency/' + name + '/P' + str(rank), -1) for name in PACKET_NAMES.values() for rank in LATENCY_PERCENTILES] +
+	[('/Diagnostics/Stages/' + name, -1) for name in STAGE_NAMES])
+
+# values of the BMS, every one is mirrored under /Raw
+VALUE_PATHS = (
+	'/Info/Soc', '/Info/CurrentMode', '/Info/Current', '/Info/Temp/Sensor1', '/Info/Temp/Sensor2',
+	'/Info/ChargeEndVoltage', '/Info/DischargeEndVoltage', '/Info/ChargeRelayStatus', '/Info/DischargeRelayStatus',
+	'/Info/UpdateTimestamp',
+	'/Voltages/Sum', '/Voltages/Diff', '/Voltages/Max', '/Voltages/Min', '/Voltages/Avg',
+	'/Voltages/BatteryCapacityWH', '/Voltages/BatteryCapacityAH', '/Voltages/UpdateTimestamp',
+	'/Impedances/CurrentMode1', '/Impedances/Current1', '/Impedances/Sum', '/Impedances/Diff', '/Impedances/Max',
+	'/Impedances/Min', '/Impedances/Avg', '/Impedances/UpdateTimestamp')
+
+# numbers without text, so without /Raw mirror
+INDEX_PATHS = ('/Voltages/MinCellIndex', '/Voltages/MaxCellIndex', '/Impedances/MinCellIndex', '/Impedances/MaxCellIndex')
+
+SERVICE_PATHS = tuple(
+	[('/Alarms/InternalFailure', 0), ('/Alarms/BmsCable', 0)] + DIAGNOSTICS_PATHS +
+	[(path, -1) for path in VALUE_PATHS] + [(path, -1) for path in INDEX_PATHS] +
+	[('/Raw' + path, -1) for path in VALUE_PATHS])
+
+# value, index and /Raw paths of every packet type without the cells,
+# they are set to -1 once the packet type is stale
+PACKET_PATH_PREFIXES = {
+	PACKET_STATUS_CELLS      : "/Voltages/",
+	PACKET_STATUS_BMS        : "/Info/",
+	PACKET_STATUS_IMPEDANCES : "/Impedances/"
+}
+PACKET_PATHS = dict((packet_type,
+	tuple(path for path in (VALUE_PATHS + INDEX_PATHS) if path.startswith(prefix)) +
+	tuple("/Raw" + path for path in VALUE_PATHS if path.startswith(prefix)))
+	for (packet_type, prefix) in PACKET_PATH_PREFIXES.items())
+
+PACKET_CELL_PATHS = {
+	PACKET_STATUS_CELLS      : (CELL_VOLTAGE_PATHS, CELL_VOLTAGE_RAW_PATHS),
+	PACKET_STATUS_BMS        : (),
+	PACKET_STATUS_IMPEDANCES : (CELL_IMPEDANCE_PATHS, CELL_IMPEDANCE_RAW_PATHS)
+}
 
-	logging.info("Open serial port " + args.device)
-	serial_port = serial.Serial(args.device, 115200, timeout=1)
+CURRENT_MODE_TEXT  = { 0x00 : "Discharge", 0x01 : "Charge", 0x02 : "Storage" }
+CURRENT_MODE1_TEXT = { 0x00 : "Discharge", 0x01 : "Charge" }
+RELAY_STATUS_TEXT  = { 0x00 : "On", 0x01 : "Off" }
+
+
+# Latest decoded values of the BMS. The decoders overwrite the attributes
+# and the array('d') cell vectors in place, -1 marks a value that was not
+# received yet. Cells above cell_count / impedance_count are kept at -1.
+class BmsState(object):
+
+	__slots__ = (
+		'charged_end_voltage', 'discharged_end_voltage', 'charge_relay_status', 'discharge_relay_status',
+		'current_mode', 'current', 'sensor_t1', 'sensor_t2', 'soc', 'status_timestamp',
+		'cell_count', 'cell_voltages', 'voltages_sum', 'voltages_max', 'voltages_min', 'voltages_diff',
+		'voltages_average', 'voltages_min_index', 'voltages_max_index', 'battery_capacity_wh', 'battery_capacity_ah',
+		'voltages_timestamp', 'impedance_count', 'cell_impedances', 'current_mode1', 'current1', 'impedances_sum',
+		'impedances_max', 'impedances_min', 'impedances_diff', 'impedances_average', 'impedances_min_index',
+		'impedances_max_index', 'impedances_timestamp')
+
+	def __init__(self):
+		self.cell_count      = 0
+		self.cell_voltages   = array.array('d', [-1.0] * MAX_CELL_COUNT)
+		self.impedance_count = 0
+		self.cell_impedances = array.array('d', [-1.0] * MAX_CELL_COUNT)
+		self.reset_status()
+		self.reset_voltages()
+		self.reset_impedances()
+
+	def reset_status(self):
+		self.charged_end_voltage    = -1
+		self.discharged_end_voltage = -1
+		self.charge_relay_status    = -1
+		self.discharge_relay_status = -1
+		self.current_mode           = -1
+		self.current                = -1
+		self.sensor_t1              = -1
+		self.sensor_t2              = -1
+		self.soc                    = -1
+		self.status_timestamp       = -1
+
+	def reset_voltages(self):
+		self.set_cell_count(0)
+		self.voltages_sum        = -1
+		self.voltages_max        = -1
+		self.voltages_min        = -1
+		self.voltages_min_index  = -1
+		self.voltages_max_index  = -1
+		self.voltages_diff       = -1
+		self.voltages_average    = -1
+		self.battery_capacity_wh = -1
+		self.battery_capacity_ah = -1
+		self.voltages_timestamp  = -1
+
+	def reset_impedances(self):
+		self.set_impedance_count(0)
+		self.current_mode1        = -1
+		self.current1             = -1
+		self.impedances_sum       = -1
+		self.impedances_max       = -1
+		self.impedances_min       = -1
+		self.impedances_min_index = -1
+		self.impedances_max_index = -1
+		self.impedances_diff      = -1
+		self.impedances_average   = -1
+		self.impedances_timestamp = -1
+
+	# only a shrinking cell count has to clear the cells above it, the
+	# decoders overwrite all cells below it
+	def set_cell_count(self, count):
+		for i in range(count, self.cell_count):
+			self.cell_voltages[i] = -1.0
+		self.cell_count = count
+
+	def set_impedance_count(self, count):
+		for i in range(count, self.impedance_count):
+			self.cell_impedances[i] = -1.0
+		self.impedance_count = count
+
+
+bms_state = BmsState()
+
+# resets the values of the BmsState that a packet type carries
+STATE_RESETS = {
+	PACKET_STATUS_CELLS      : BmsState.reset_voltages,
+	PACKET_STATUS_BMS        : BmsState.reset_status,
+	PACKET_STATUS_IMPEDANCES : BmsState.reset_impedances
+}
 
-except Exception as e:
-	print(e);
-	print(traceback.format_exc())
-	
-	logging.info("Serial port failed at " + args.device)
 
-	# try /dev/ttyUSB1, if /dev/ttyUSB0 is
-	# blocked because of a shutdown
-	if (args.device == "/dev/ttyUSB0"):
-		try:
+# Text values are rendered from the raw values only when a consumer needs
+# them. The BMS repeats the same voltages every second, so each formatter
+# keeps the texts it built keyed on its raw arguments.
+def cached_text(formatter):
+	cache = {}
 
-			new_device = "/dev/ttyUSB1"
-			logging.info("Open serial port " + new_device)
-			serial_port = serial.Serial(new_device, 115200, timeout=1)
+	def render(*values):
+		text = cache.get(values)
+		if (text is None):
+			if (len(cache) >= TEXT_CACHE_SIZE):
+				cache.clear()
+			text = cache[values] = formatter(*values)
+		return text
 
-		except Exception as e:
+	render.cache = cache
+	return render
 
-			print(e);
-			print(traceback.format_exc())
-	
-			logging.info("Serial port failed at " + new_device)
 
-			quit()
+# A text that is only rendered on str(), e.g. as argument of a log call
+# that the logger level discards
+class LazyText(object):
 
-		else:
-			dbusservice['/Alarms/InternalFailure'] = 1
-			
+	__slots__ = ('formatter', 'values')
+
+	def __init__(self, formatter, *values):
+		self.formatter = formatter
+		self.values    = values
+
+	def __str__(self):
+		return self.formatter(*self.values)
+
+
+@cached_text
+def text_current(mode, value):
+	if (mode == -1):
+		return ""
+	elif (mode == 0x00):
+		return "-" + str(abs(value)) + "A"
 	else:
-		quit()
+		return str(value) + "A"
 
 
-serial_port.flushInput()
-logging.info(serial_port.name)
-if args.victron:
-	dbusservice['/Mgmt/Connection'] = serial_port.name
+@cached_text
+def text_temperature(value):
+	return str(value) + "C"
 
 
+@cached_text
+def text_soc(value):
+	return str(value) + "%"
 
 
-PACKET_HEADER             = 0x24
-PACKET_STATUS_CELLS       = 0x56
-PACKET_STATUS_BMS         = 0x57
-PACKET_STATUS_IMPEDANCES  = 0x58
+@cached_text
+def text_timestamp_seconds(seconds):
+	return datetime.datetime.fromtimestamp(seconds).strftime('%a %d.%m.%Y %H:%M:%S')
 
-PACKET_LENGTH_MINIMUM            = 10
-PACKET_LENGTH_STATUS_CELLS       = [29, 45, 61]
-PACKET_LENGTH_STATUS_BMS         = [19]
 
-# Special handling here: the impedances packet length is dynamically
-# and depends on how many cells are monitored. The minimum length of
-# the network packet with headers, command, length, currentmode1, current1
-# and checksum is 8 bytes. On 6 monitored cells the packet length will
-# be 8+(2*6) = 20 bytes. Therefore, the smallest possible and valid
-# impedances network packet will be 10 bytes
-PACKET_LENGTH_STATUS_IMPEDANCES  = 10
+# all frames of one second share the cached text
+def text_timestamp(value):
+	return text_timestamp_seconds(int(value))
 
 
-MIN_CELL_VOLTAGE   = 1.0
-MIN_CELL_IMPEDANCE = 0.0
+@cached_text
+def text_cell_voltage(value):
+	return "{:.3f}V".format(value)
 
-# Again special handling: Negative temperatures will result in
-# a buffer overflow we do handle this if temperature values
-# are retruned above 65000 which is about - 53,6 degree celsius
-MINUS_TEMPERATURE_OFFSET = 65000
 
-BMS_STATUS = {
-	'bms' : { 
-		'charged_end_voltage' : {
-			'value' : -1.000,
-			'text' : ""
-		},
-		'discharged_end_voltage' : {
-			'value' : -1.000,
-			'text' : ""
-		},
-		'charge_relay_status' : {
-			'value' : -1.000,
-			'text' : ""
-		},
-		'discharge_relay_status' : {
-			'value' : -1.000,
-			'text' : ""
-		},
-		'current_mode'        : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'current' : {
-			'value' : -1,
-			'text' : ""
-		},
+@cached_text
+def text_voltage_sum(value):
+	return "{:.2f}V".format(value)
+
+
+@cached_text
+def text_voltage_diff(value):
+	return "{:.0f}mV".format(value * 1000)
+
+
+@cached_text
+def text_impedance(value):
+	return "{:.1f}mOhm".format(value)
+
+
+@cached_text
+def text_capacity(value, unit):
+	return "{:.0f}".format(value) + unit
+
+
+def log_status_bms(state):
+	return ("[SOC|" + text_soc(state.soc) +
+		"][CHARGE RELAY|" + RELAY_STATUS_TEXT.get(state.charge_relay_status, "") +
+		"][DISCHARGE RELAY|" + RELAY_STATUS_TEXT.get(state.discharge_relay_status, "") +
+		"][MODE|" + CURRENT_MODE_TEXT.get(state.current_mode, "") +
+		"][CURRENT|" + text_current(state.current_mode, state.current) +
+		"][T1|" + text_temperature(state.sensor_t1) +
+		"][T2|" + text_temperature(state.sensor_t2) +
+		"][CHARGE END VOLTAGE|" + text_voltage_sum(state.charged_end_voltage) +
+		"][DISCHARGE END VOLTAGE|" + text_voltage_sum(state.discharged_end_voltage) + "]")
+
+
+def log_status_cells(state):
+	return ("[CAPACITYAH|" + text_capacity(state.battery_capacity_ah, "Ah") +
+		"][CAPACITYWH|" + text_capacity(state.battery_capacity_wh, "Wh") +
+		"][DIFF|" + text_voltage_diff(state.voltages_diff) +
+		"][SUM|" + text_voltage_sum(state.voltages_sum) +
+		"".join("][#" + str(i+1) + "|" + text_cell_voltage(state.cell_voltages[i]) for i in range(state.cell_count)) + "]")
+
+
+# the impedances line always lists 24 cells, missing ones stay empty
+def log_status_impedances(state):
+	return ("][MODE1|" + CURRENT_MODE1_TEXT.get(state.current_mode1, "") +
+		"][CURRENT1|" + text_current(state.current_mode1, state.current1) +
+		"][SUM|" + text_impedance(state.impedances_sum) +
+		"".join("][#" + str(i+1) + "|" + (text_impedance(state.cell_impedances[i]) if (i < state.impedance_count) else "") for i in range(MAX_CELL_COUNT)) + "]")
+
+
+def view_item(value, text, valid):
+	if valid:
+		return { 'value' : value, 'text' : text }
+	else:
+		return { 'value' : -1, 'text' : "" }
+
+
+def view_status_bms(state):
+	valid = (state.status_timestamp != -1)
+	return {
+		'charged_end_voltage'    : view_item(state.charged_end_voltage, text_voltage_sum(state.charged_end_voltage), valid),
+		'discharged_end_voltage' : view_item(state.discharged_end_voltage, text_voltage_sum(state.discharged_end_voltage), valid),
+		'charge_relay_status'    : view_item(state.charge_relay_status, RELAY_STATUS_TEXT.get(state.charge_relay_status, ""), valid),
+		'discharge_relay_status' : view_item(state.discharge_relay_status, RELAY_STATUS_TEXT.get(state.discharge_relay_status, ""), valid),
+		'current_mode'           : view_item(state.current_mode, CURRENT_MODE_TEXT.get(state.current_mode, ""), valid),
+		'current'                : view_item(state.current, text_current(state.current_mode, state.current), valid),
 		'temperature' : {
-			'sensor_t1' : {
-				'value' : -1.00,
-				'text'  : ""
-			},
-			'sensor_t2' : {
-				'value' : -1.00,
-				'text'  : ""
-			}
-		},
-		'soc' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'timestamp' : {
-			'value' : -1,
-			'text'  : ""
-		}
-	},
-	'voltages' : {
-		'cell1_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell2_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell3_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell4_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell5_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell6_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell7_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell8_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell9_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell10_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell11_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell12_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell13_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell14_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell15_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell16_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell17_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell18_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell19_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell20_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell21_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell22_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell23_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell24_voltage' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'agg_voltages' : {
-			'sum' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'max' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'min' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'diff' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'average' : {
-				'value' : -1,
-				'text'  : ""
-			}
+			'sensor_t1' : view_item(state.sensor_t1, text_temperature(state.sensor_t1), valid),
+			'sensor_t2' : view_item(state.sensor_t2, text_temperature(state.sensor_t2), valid)
 		},
-		'battery_capacity_wh' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'battery_capacity_ah' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'timestamp' : {
-			'value' : -1,
-			'text'  : ""
-		}
-	},
-	'impedances' : {
-		'current_mode1'    : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'current1'        : {
-			'value' : -1,
-			'text' : ""
-		},
-		'cell1_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell2_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell3_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell4_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell5_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell6_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell7_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell8_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell9_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell10_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell11_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell12_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell13_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell14_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell15_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell16_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell17_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell18_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell19_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell20_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell21_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell22_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell23_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'cell24_impedance' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'agg_impedances' : {
-			'sum' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'max' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'min' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'diff' : {
-				'value' : -1,
-				'text'  : ""
-			},
-			'average' : {
-				'value' : -1,
-				'text'  : ""
-			}
-		},
-		'battery_capacity_wh' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'battery_capacity_ah' : {
-			'value' : -1,
-			'text'  : ""
-		},
-		'timestamp' : {
-			'value' : -1,
-			'text'  : ""
-		}
+		'soc'                    : view_item(state.soc, text_soc(state.soc), valid),
+		'timestamp'              : view_item(state.status_timestamp, text_timestamp(state.status_timestamp), valid)
 	}
-}
 
 
-def reset_status_values():
-
-	BMS_STATUS['bms']['charged_end_voltage']['value'] = -1
-	BMS_STATUS['bms']['charged_end_voltage']['text']  = ""
-	BMS_STATUS['bms']['discharged_end_voltage']['value'] = -1
-	BMS_STATUS['bms']['discharged_end_voltage']['text']  = ""
-	BMS_STATUS['bms']['charge_relay_status']['value'] = -1
-	BMS_STATUS['bms']['charge_relay_status']['text']  = ""
-	BMS_STATUS['bms']['discharge_relay_status']['value'] = -1
-	BMS_STATUS['bms']['discharge_relay_status']['text']  = ""
-	BMS_STATUS['bms']['current_mode']['value'] = -1
-	BMS_STATUS['bms']['current_mode']['text']  = ""
-	BMS_STATUS['bms']['current']['value'] = -1
-	BMS_STATUS['bms']['current']['text']  = ""
-	BMS_STATUS['bms']['temperature']['sensor_t1']['value'] = -1
-	BMS_STATUS['bms']['temperature']['sensor_t1']['text']  = ""
-	BMS_STATUS['bms']['temperature']['sensor_t2']['value'] = -1
-	BMS_STATUS['bms']['temperature']['sensor_t2']['text']  = ""
-	BMS_STATUS['bms']['soc']['value'] = -1
-	BMS_STATUS['bms']['soc']['text']  = ""
-	BMS_STATUS['bms']['timestamp']['value'] = -1
-	BMS_STATUS['bms']['timestamp']['text']  = ""
-
-
-def reset_impedances_values():
-
-	BMS_STATUS['impedances']['current_mode1']['value'] = -1
-	BMS_STATUS['impedances']['current_mode1']['text']  = ""
-	BMS_STATUS['impedances']['current1']['value'] = -1
-	BMS_STATUS['impedances']['current1']['text']  = ""
-	BMS_STATUS['impedances']['cell1_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell1_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell2_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell2_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell3_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell3_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell4_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell4_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell5_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell5_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell6_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell6_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell7_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell7_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell8_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell8_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell9_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell9_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell10_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell10_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell11_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell11_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell12_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell12_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell13_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell13_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell14_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell14_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell15_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell15_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell16_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell16_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell17_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell17_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell18_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell18_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell19_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell19_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell20_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell20_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell21_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell21_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell22_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell22_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell23_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell23_impedance']['text']  = ""
-	BMS_STATUS['impedances']['cell24_impedance']['value'] = -1
-	BMS_STATUS['impedances']['cell24_impedance']['text']  = ""
-	BMS_STATUS['impedances']['agg_impedances']['sum']['value']     = -1
-	BMS_STATUS['impedances']['agg_impedances']['sum']['text']      = ""
-	BMS_STATUS['impedances']['agg_impedances']['max']['value']     = -1
-	BMS_STATUS['impedances']['agg_impedances']['max']['text']      = ""
-	BMS_STATUS['impedances']['agg_impedances']['min']['value']     = -1
-	BMS_STATUS['impedances']['agg_impedances']['min']['text']      = ""
-	BMS_STATUS['impedances']['agg_impedances']['diff']['value']    = -1
-	BMS_STATUS['impedances']['agg_impedances']['diff']['text']     = ""
-	BMS_STATUS['impedances']['agg_impedances']['average']['value'] = -1
-	BMS_STATUS['impedances']['agg_impedances']['average']['text']  = ""
-	BMS_STATUS['impedances']['battery_capacity_wh']['value'] = -1
-	BMS_STATUS['impedances']['battery_capacity_wh']['text']  = ""
-	BMS_STATUS['impedances']['battery_capacity_ah']['value'] = -1
-	BMS_STATUS['impedances']['battery_capacity_ah']['text']  = ""
-	BMS_STATUS['impedances']['timestamp']['value'] = -1
-	BMS_STATUS['impedances']['timestamp']['text']  = ""
-
-
-def reset_voltages_values():
-	BMS_STATUS['voltages']['cell1_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell1_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell2_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell2_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell3_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell3_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell4_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell4_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell5_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell5_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell6_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell6_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell7_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell7_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell8_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell8_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell9_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell9_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell10_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell10_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell11_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell11_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell12_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell12_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell13_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell13_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell14_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell14_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell15_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell15_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell16_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell16_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell17_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell17_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell18_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell18_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell19_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell19_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell20_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell20_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell21_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell21_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell22_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell22_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell23_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell23_voltage']['text']  = ""
-	BMS_STATUS['voltages']['cell24_voltage']['value'] = -1
-	BMS_STATUS['voltages']['cell24_voltage']['text']  = ""
-	BMS_STATUS['voltages']['agg_voltages']['sum']['value']     = -1
-	BMS_STATUS['voltages']['agg_voltages']['sum']['text']      = ""
-	BMS_STATUS['voltages']['agg_voltages']['max']['value']     = -1
-	BMS_STATUS['voltages']['agg_voltages']['max']['text']      = ""
-	BMS_STATUS['voltages']['agg_voltages']['min']['value']     = -1
-	BMS_STATUS['voltages']['agg_voltages']['min']['text']      = ""
-	BMS_STATUS['voltages']['agg_voltages']['diff']['value']    = -1
-	BMS_STATUS['voltages']['agg_voltages']['diff']['text']     = ""
-	BMS_STATUS['voltages']['agg_voltages']['average']['value'] = -1
-	BMS_STATUS['voltages']['agg_voltages']['average']['text']  = ""
-	BMS_STATUS['voltages']['battery_capacity_wh']['value'] = -1
-	BMS_STATUS['voltages']['battery_capacity_wh']['text']  = ""
-	BMS_STATUS['voltages']['battery_capacity_ah']['value'] = -1
-	BMS_STATUS['voltages']['battery_capacity_ah']['text']  = ""
-	BMS_STATUS['voltages']['timestamp']['value'] = -1
-	BMS_STATUS['voltages']['timestamp']['text']  = ""
-
-
-def debug_packet(packet):
-
-	string_output = ""
-	for packet_byte in packet:
-		byte_string = str(packet_byte) + " [" + hex(packet_byte) + "] "
-		string_output = string_output + byte_string
-	logging.debug(string_output);
-
-
-def get_header_position(packet):
-
-	# detect header position
-	previous_packet_byte = "0"
-	pos_iterator = -1
-	for packet_byte in packet:
-		pos_iterator += 1
-		if ((previous_packet_byte == PACKET_HEADER) and (packet_byte == PACKET_HEADER)):
+def view_status_cells(state):
+	valid = (state.voltages_timestamp != -1)
+	view = {}
+	for i in range(MAX_CELL_COUNT):
+		value = state.cell_voltages[i]
+		view['cell' + str(i+1) + '_voltage'] = view_item(value, text_cell_voltage(value), i < state.cell_count)
+
+	view['agg_voltages'] = {
+		'sum'     : view_item(state.voltages_sum, text_voltage_sum(state.voltages_sum), valid),
+		'max'     : view_item(state.voltages_max, text_cell_voltage(state.voltages_max), valid),
+		'min'     : view_item(state.voltages_min, text_cell_voltage(state.voltages_min), valid),
+		'diff'    : view_item(state.voltages_diff, text_voltage_diff(state.voltages_diff), valid),
+		'average' : view_item(state.voltages_average, text_cell_voltage(state.voltages_average), valid)
+	}
+	view['battery_capacity_wh'] = view_item(state.battery_capacity_wh, text_capacity(state.battery_capacity_wh, "Wh"), valid)
+	view['battery_capacity_ah'] = view_item(state.battery_capacity_ah, text_capacity(state.battery_capacity_ah, "Ah"), valid)
+	view['timestamp'] = view_item(state.voltages_timestamp, text_timestamp(state.voltages_timestamp), valid)
+	return view
+
+
+def view_status_impedances(state):
+	valid = (state.impedances_timestamp != -1)
+	view = {
+		'current_mode1' : view_item(state.current_mode1, CURRENT_MODE1_TEXT.get(state.current_mode1, ""), valid),
+		'current1'      : view_item(state.current1, text_current(state.current_mode1, state.current1), valid)
+	}
+	for i in range(MAX_CELL_COUNT):
+		value = state.cell_impedances[i]
+		view['cell' + str(i+1) + '_impedance'] = view_item(value, text_impedance(value), i < state.impedance_count)
+
+	view['agg_impedances'] = {
+		'sum'     : view_item(state.impedances_sum, text_impedance(state.impedances_sum), valid),
+		'max'     : view_item(state.impedances_max, text_impedance(state.impedances_max), valid),
+		'min'     : view_item(state.impedances_min, text_impedance(state.impedances_min), valid),
+		'diff'    : view_item(state.impedances_diff, text_impedance(state.impedances_diff), valid),
+		'average' : view_item(state.impedances_average, text_impedance(state.impedances_average), valid)
+	}
+	# the impedances frame carries no capacities, kept for the old layout
+	view['battery_capacity_wh'] = view_item(-1, "", False)
+	view['battery_capacity_ah'] = view_item(-1, "", False)
+	view['timestamp'] = view_item(state.impedances_timestamp, text_timestamp(state.impedances_timestamp), valid)
+	return view
+
+
+# Read only view with the nested dict layout of the former BMS_STATUS
+# tree. A group is built from the state on every access, so keep the
+# returned dict instead of indexing BMS_STATUS per value in a loop.
+class BmsStatusView(Mapping):
+
+	groups = {
+		'bms'        : view_status_bms,
+		'voltages'   : view_status_cells,
+		'impedances' : view_status_impedances
+	}
+
+	def __init__(self, state):
+		self.state = state
+
+	def __getitem__(self, group):
+		return self.groups[group](self.state)
+
+	def __iter__(self):
+		return iter(('bms', 'voltages', 'impedances'))
+
+	def __len__(self):
+		return len(self.groups)
+
+
+BMS_STATUS = BmsStatusView(bms_state)
+
+
+# Collects the D-Bus updates of the decoded frames. Paths whose value did
+# not change since the last publish are skipped, the remaining changes are
+# sent as one batch on flush(). Text paths are compared on their raw values
+# and only formatted on flush() if these changed.
+class DbusPublisher(object):
+
+	def __init__(self, service):
+		self.service       = service
+		self.published     = {}
+		self.pending       = {}
+		self.pending_texts = {}
+
+	def __setitem__(self, path, value):
+		if ((path in self.published) and (self.published[path] == value)):
+			self.pending.pop(path, None)
+		else:
+			self.pending[path] = value
+
+	def set_text(self, path, formatter, *values):
+		if ((path in self.published) and (self.published[path] == values)):
+			self.pending_texts.pop(path, None)
+		else:
+			self.pending_texts[path] = (formatter, values)
+
+	def has_pending(self):
+		return ((len(self.pending) > 0) or (len(self.pending_texts) > 0))
+
+	def flush(self):
+		if not self.has_pending():
+			return
+
+		# velib with service context support emits a single ItemsChanged
+		# signal for all changes, older versions one signal per path
+		if hasattr(self.service, '__enter__'):
+			with self.service as service:
+				self.send(service)
+		else:
+			self.send(self.service)
+
+		logging.debug("Published [%d paths]", len(self.pending) + len(self.pending_texts))
+		self.published.update(self.pending)
+		self.pending.clear()
+		for path, (formatter, values) in self.pending_texts.items():
+			self.published[path] = values
+		self.pending_texts.clear()
+
+	def send(self, service):
+		for path, value in self.pending.items():
+			service[path] = value
+		for path, (formatter, values) in self.pending_texts.items():
+			service[path] = formatter(*values)
+
+
+def debug_packet(packet, length=None):
+
+	# the byte dump is expensive, only build it if it is logged
+	if not logging.getLogger().isEnabledFor(logging.DEBUG):
+		return
+
+	logging.debug("".join([str(packet_byte) + " [" + hex(packet_byte) + "] " for packet_byte in packet[:length]]))
+
+
+# Minimum, average and maximum of one value over a digest interval
+class DigestSeries(object):
+
+	__slots__ = ('count', 'total', 'minimum', 'maximum')
+
+	def __init__(self):
+		self.count   = 0
+		self.total   = 0.0
+		self.minimum = 0.0
+		self.maximum = 0.0
+
+	def add(self, value):
+		if (self.count == 0):
+			self.minimum = value
+			self.maximum = value
+		elif (value < self.minimum):
+			self.minimum = value
+		elif (value > self.maximum):
+			self.maximum = value
+		self.count += 1
+		self.total += value
+
+	def text(self, digits, unit):
+		if (self.count == 0):
+			return "-"
+		value_format = "{:." + str(digits) + "f}"
+		return (value_format.format(self.minimum) + "/" + value_format.format(self.total / self.count) +
+			"/" + value_format.format(self.maximum) + unit)
+
+
+# Replaces the info line of every frame with one min/avg/max summary per
+# interval, the log is then written once per interval instead of three
+# times per second. A timer writes it, so the summary also shows when the
+# frames stop.
+class LogDigest(object):
+
+	def __init__(self, interval, label=""):
+		self.interval = interval
+		self.label    = label
+		self.reset(time.time())
+
+	def reset(self, now):
+		self.started      = now
+		self.frames       = dict.fromkeys(PACKET_DECODERS, 0)
+		self.soc          = DigestSeries()
+		self.current      = DigestSeries()
+		self.sensor_t1    = DigestSeries()
+		self.sensor_t2    = DigestSeries()
+		self.voltage      = DigestSeries()
+		self.cell_min     = DigestSeries()
+		self.cell_max     = DigestSeries()
+		self.cell_diff    = DigestSeries()
+		self.impedance    = DigestSeries()
+
+	def add_status_bms(self, state):
+		self.frames[PACKET_STATUS_BMS] += 1
+		self.soc.add(state.soc)
+		self.current.add(state.current)
+		self.sensor_t1.add(state.sensor_t1)
+		self.sensor_t2.add(state.sensor_t2)
+
+	def add_status_cells(self, state):
+		self.frames[PACKET_STATUS_CELLS] += 1
+		self.voltage.add(state.voltages_sum)
+		self.cell_min.add(state.voltages_min)
+		self.cell_max.add(state.voltages_max)
+		self.cell_diff.add(state.voltages_diff * 1000)
+
+	def add_status_impedances(self, state):
+		self.frames[PACKET_STATUS_IMPEDANCES] += 1
+		self.impedance.add(state.impedances_average)
+
+	def check(self, now):
+		if ((now - self.started) >= self.interval):
+			self.write(now)
+
+	def write(self, now):
+		logging.info("%sBMS Digest %s", self.label, LazyText(self.text, now))
+		self.reset(now)
+
+	def text(self, now):
+		return ("[" + str(int(round(now - self.started))) + "s" +
+			"][FRAMES|" + str(self.frames[PACKET_STATUS_BMS]) + "/" + str(self.frames[PACKET_STATUS_CELLS]) +
+			"/" + str(self.frames[PACKET_STATUS_IMPEDANCES]) +
+			"][SOC|" + self.soc.text(0, "%") +
+			"][CURRENT|" + self.current.text(1, "A") +
+			"][T1|" + self.sensor_t1.text(1, "C") +
+			"][T2|" + self.sensor_t2.text(1, "C") +
+			"][VOLTAGE|" + self.voltage.text(2, "V") +
+			"][CELL MIN|" + self.cell_min.text(3, "V") +
+			"][CELL MAX|" + self.cell_max.text(3, "V") +
+			"][DIFF|" + self.cell_diff.text(0, "mV") +
+			"][IMPEDANCE AVG|" + self.impedance.text(1, "mOhm") + "]")
+
+
+# position of the first of length timestamps that is not before value,
+# the timestamps are a ring that starts at first
+def history_search(timestamps, first, length, value):
+	size = len(timestamps)
+	low  = 0
+	high = length
+	while (low < high):
+		middle = (low + high) // 2
+		if (timestamps[(first + middle) % size] < value):
+			low = middle + 1
+		else:
+			high = middle
+	return low
+
+
+# Raw samples of a fixed number of channels, the oldest sample is
+# overwritten once the ring is full. Channels without a value hold -1.
+class HistoryRing(object):
+
+	def __init__(self, size, channels):
+		self.channels   = channels
+		self.timestamps = array.array('d', [0.0] * size)
+		self.values     = array.array('d', [-1.0] * (size * channels))
+		self.index      = 0
+		self.length     = 0
+
+	# values is an array('d') with one value per channel
+	def add(self, timestamp, values):
+		row = self.index * self.channels
+		self.timestamps[self.index] = timestamp
+		self.values[row:row + self.channels] = values
+		self.index += 1
+		if (self.index == len(self.timestamps)):
+			self.index = 0
+		if (self.length < len(self.timestamps)):
+			self.length += 1
+
+	# Yields (timestamp, value) of one channel or (timestamp, row) of all
+	# channels for the samples from start until before end. A row is a
+	# memoryview into the ring that is overwritten when the ring wraps.
+	def window(self, start, end, channel=None):
+		channels = self.channels
+		size     = len(self.timestamps)
+		first    = (self.index - self.length) % size
+		values   = memoryview(self.values)
+		for position in range(history_search(self.timestamps, first, self.length, start), self.length):
+			slot = (first + position) % size
+			timestamp = self.timestamps[slot]
+			if (timestamp >= end):
+				break
+			if (channel is None):
+				yield (timestamp, values[slot * channels:(slot + 1) * channels])
+			else:
+				yield (timestamp, self.values[(slot * channels) + channel])
+
+
+# Minimum, maximum and mean per channel and period, updated with every
+# sample. The oldest bucket is reused once all buckets are taken.
+class HistoryRollup(object):
+
+	def __init__(self, period, size, channels):
+		self.period   = period
+		self.channels = channels
+		self.starts   = array.array('d', [0.0] * size)
+		self.minimums = array.array('d', [0.0] * (size * channels))
+		self.maximums = array.array('d', [0.0] * (size * channels))
+		self.sums     = array.array('d', [0.0] * (size * channels))
+		self.counts   = array.array('I', [0] * (size * channels))
+		self.zero_sums   = array.array('d', [0.0] * channels)
+		self.zero_counts = array.array('I', [0] * channels)
+		self.index    = size - 1
+		self.length   = 0
+
+	# only the first count channels of values are valid
+	def add(self, timestamp, values, count):
+		start = timestamp - (timestamp % self.period)
+
+		# a clock set back keeps adding to the open bucket
+		if ((self.length == 0) or (start > self.starts[self.index])):
+			self.open(start)
+
+		minimums = self.minimums
+		maximums = self.maximums
+		sums     = self.sums
+		counts   = self.counts
+		row = self.index * self.channels
+		for channel in range(count):
+			value    = values[channel]
+			position = row + channel
+			if (counts[position] == 0):
+				minimums[position] = value
+				maximums[position] = value
+			elif (value < minimums[position]):
+				minimums[position] = value
+			elif (value > maximums[position]):
+				maximums[position] = value
+			sums[position]   += value
+			counts[position] += 1
+
+	def open(self, start):
+		self.index += 1
+		if (self.index == len(self.starts)):
+			self.index = 0
+		if (self.length < len(self.starts)):
+			self.length += 1
+
+		row = self.index * self.channels
+		self.starts[self.index] = start
+		self.sums[row:row + self.channels]   = self.zero_sums
+		self.counts[row:row + self.channels] = self.zero_counts
+
+	# Yields (start, minimum, maximum, mean) of one channel for the buckets
+	# that started from start until before end, buckets without a value of
+	# the channel are skipped. Without a channel the minimums and maximums
+	# are memoryview rows and the means a list, -1 for channels without value.
+	def buckets(self, start, end, channel=None):
+		channels = self.channels
+		size     = len(self.starts)
+		first    = (self.index - self.length + 1) % size
+		minimums = memoryview(self.minimums)
+		maximums = memoryview(self.maximums)
+		for position in range(history_search(self.starts, first, self.length, start), self.length):
+			slot = (first + position) % size
+			bucket_start = self.starts[slot]
+			if (bucket_start >= end):
+				break
+			row = slot * channels
+			if (channel is None):
+				means = [(self.sums[row + i] / self.counts[row + i]) if (self.counts[row + i] > 0) else -1
+					for i in range(channels)]
+				yield (bucket_start, minimums[row:row + channels], maximums[row:row + channels], means)
+			elif (self.counts[row + channel] > 0):
+				yield (bucket_start, self.minimums[row + channel], self.maximums[row + channel],
+					self.sums[row + channel] / self.counts[row + channel])
+
+
+# Raw samples of the last minutes with the rollups per minute and per hour
+class HistoryGroup(object):
+
+	def __init__(self, samples, channels):
+		self.samples = HistoryRing(samples, channels)
+		self.minutes = HistoryRollup(60, HISTORY_MINUTES, channels)
+		self.hours   = HistoryRollup(3600, HISTORY_HOURS, channels)
+
+	def add(self, timestamp, values, count):
+		self.samples.add(timestamp, values)
+		self.minutes.add(timestamp, values, count)
+		self.hours.add(timestamp, values, count)
+
+	# One CSV line per raw sample and per minute and hour bucket of every
+	# channel. Channels that hold -1 in a raw sample are skipped if missing
+	# is set, current and temperatures can be -1.
+	def write(self, output, kind, names, missing):
+		for (timestamp, row) in self.samples.window(0, float('inf')):
+			for (channel, name) in enumerate(names):
+				value = row[channel]
+				if ((not missing) or (value != -1)):
+					output.write("{},sample,{:.3f},{},{:.4f},{:.4f},{:.4f}\n".format(kind, timestamp, name, value, value, value))
+		for (period, rollup) in (('minute', self.minutes), ('hour', self.hours)):
+			for (channel, name) in enumerate(names):
+				for (start, minimum, maximum, mean) in rollup.buckets(0, float('inf'), channel):
+					output.write("{},{},{:.0f},{},{:.4f},{:.4f},{:.4f}\n".format(kind, period, start, name, minimum, maximum, mean))
+
+	def memory(self):
+		return sum(data.itemsize * len(data) for data in (
+			self.samples.timestamps, self.samples.values,
+			self.minutes.starts, self.minutes.minimums, self.minutes.maximums, self.minutes.sums, self.minutes.counts,
+			self.hours.starts, self.hours.minimums, self.hours.maximums, self.hours.sums, self.hours.counts))
+
+
+# In memory history of the cell voltages, the cell impedances and the
+# current and temperatures of the status frame. All buffers are allocated
+# up front, a frame costs one update of its group. Query it with e.g.
+# device.history.voltages.samples.window(start, end, cell) or
+# device.history.voltages.minutes.buckets(start, end), cells count from 0.
+class BmsHistory(object):
+
+	def __init__(self, minutes):
+		samples = max(minutes * 60 * HISTORY_SAMPLE_RATE, 1)
+		self.voltages      = HistoryGroup(samples, MAX_CELL_COUNT)
+		self.impedances    = HistoryGroup(samples, MAX_CELL_COUNT)
+		self.status        = HistoryGroup(samples, HISTORY_STATUS_CHANNELS)
+		self.status_values = array.array('d', [-1.0] * HISTORY_STATUS_CHANNELS)
+
+	def add_status_bms(self, state):
+		values = self.status_values
+		values[HISTORY_CURRENT]   = state.current
+		values[HISTORY_SENSOR_T1] = state.sensor_t1
+		values[HISTORY_SENSOR_T2] = state.sensor_t2
+		self.status.add(state.status_timestamp, values, HISTORY_STATUS_CHANNELS)
+
+	def add_status_cells(self, state):
+		self.voltages.add(state.voltages_timestamp, state.cell_voltages, state.cell_count)
+
+	def add_status_impedances(self, state):
+		self.impedances.add(state.impedances_timestamp, state.cell_impedances, state.impedance_count)
+
+	# Writes the whole history as CSV, see HistoryGroup.write(). The file
+	# is replaced at once, a reader never sees half of it.
+	def dump(self, filename):
+		cells = [str(cell + 1) for cell in range(MAX_CELL_COUNT)]
+		with open(filename + ".tmp", 'w') as output:
+			output.write("kind,period,time,channel,minimum,maximum,mean\n")
+			self.voltages.write(output, "voltages", cells, True)
+			self.impedances.write(output, "impedances", cells, True)
+			self.status.write(output, "status", HISTORY_STATUS_NAMES, False)
+		os.rename(filename + ".tmp", filename)
+
+	def memory(self):
+		return self.voltages.memory() + self.impedances.memory() + self.status.memory()
+
+
+# the blocks of a history file as (first, last, rows, cells, data), data
+# is a memoryview into the file content
+def store_blocks(content):
+	offset = 0
+	while ((offset + STORE_BLOCK.size) <= len(content)):
+		(first, last, rows, cells, size) = STORE_BLOCK.unpack_from(content, offset)
+		offset += STORE_BLOCK.size
+		if ((offset + size) > len(content)):
+			logging.info("History file truncated")
 			break
-		previous_packet_byte = packet_byte
+		yield (first, last, rows, cells, content[offset:offset + size])
+		offset += size
+
+
+# a column of a block in the byte order of this machine
+def store_column(data, typecode):
+	column = array.array(typecode)
+	column.frombytes(data)
+	if (sys.byteorder != 'little'):
+		column.byteswap()
+	return column
+
+
+# Timestamps and the columns of one or all cells of a block, only this
+# block is decompressed and copied
+def store_block_values(data, rows, cells, compressed, cell):
+	if compressed:
+		data = memoryview(zlib.decompress(data))
+	offset = rows * 8
+	timestamps = store_column(data[0:offset], 'd')
+	columns = [store_column(data[offset + (i * rows * 4):offset + ((i + 1) * rows * 4)], 'f')
+		for i in (range(cells) if (cell is None) else [cell])]
+	return (timestamps, columns)
+
+
+# Rows of one history kind collected until the next write
+class StoreBatch(object):
+
+	def __init__(self):
+		self.clear(0)
+
+	def clear(self, cells):
+		self.timestamps = array.array('d')
+		self.columns    = [array.array('f') for i in range(cells)]
+
+	def add(self, timestamp, values):
+		self.timestamps.append(timestamp)
+		for (column, value) in zip(self.columns, values):
+			column.append(value)
+
+	def block(self):
+		data = [self.timestamps] + self.columns
+		if (sys.byteorder != 'little'):
+			data = [array.array(column.typecode, column) for column in data]
+			for column in data:
+				column.byteswap()
+		size = sum(column.itemsize * len(column) for column in data)
+		return (STORE_BLOCK.pack(self.timestamps[0], self.timestamps[-1], len(self.timestamps), len(self.columns), size) +
+			b"".join(column.tobytes() for column in data))
+
+
+# Compresses one history file a block at a time, a block holds the rows
+# of one store interval. step() is called from the main loop until the
+# file is done, so a day file never blocks the serial reads.
+class SegmentCompressor(object):
+
+	def __init__(self, filename):
+		self.filename   = filename
+		self.compressed = filename[:-len(STORE_SUFFIX)] + STORE_COMPRESSED_SUFFIX
+		self.segment    = open(filename, 'rb')
+		self.target     = open(self.compressed + ".tmp", 'wb')
+		self.content    = None
+		self.view       = None
+		self.blocks     = iter(())
+		if (os.fstat(self.segment.fileno()).st_size > 0):
+			self.content = mmap.mmap(self.segment.fileno(), 0, access=mmap.ACCESS_READ)
+			self.view    = memoryview(self.content)
+			self.blocks  = store_blocks(self.view)
+
+	# compresses the next block, returns False once the file is replaced
+	def step(self):
+		for (first, last, rows, cells, data) in self.blocks:
+			packed = zlib.compress(data)
+			data.release()
+			self.target.write(STORE_BLOCK.pack(first, last, rows, cells, len(packed)) + packed)
+			return True
+
+		self.close()
+		os.rename(self.compressed + ".tmp", self.compressed)
+		os.remove(self.filename)
+		logging.info("History compressed " + self.compressed)
+		return False
+
+	def close(self):
+		# the block generator holds a view into the mapped file
+		self.blocks = None
+		if (self.view is not None):
+			self.view.release()
+			self.content.close()
+			self.view = None
+		self.segment.close()
+		self.target.close()
+
+	# the next start compresses the file again
+	def abort(self):
+		self.close()
+		os.remove(self.compressed + ".tmp")
+
+
+# Append only history of the cell voltages and impedances on disk, one
+# file per kind and day. The rows are kept in memory and written every
+# interval seconds, which saves flash writes. Past days are compressed
+# block by block from the main loop, see SegmentCompressor.
+# Query it with device.store.query("voltages", start, end, cell), cells count
+# from 0.
+class HistoryStore(object):
+
+	def __init__(self, directory, interval):
+		self.directory = directory
+		self.interval  = interval
+		self.batches   = dict((kind, StoreBatch()) for kind in STORE_KINDS)
+		self.day       = time.strftime(STORE_DAY_FORMAT)
+		self.written   = time.time()
+		self.pending    = []
+		self.compressor = None
+		self.compress_scheduled = False
+		self.failed     = False
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.compress_segments()
+
+	def add_status_cells(self, state):
+		self.add("voltages", state.voltages_timestamp, state.cell_voltages, state.cell_count)
+
+	def add_status_impedances(self, state):
+		self.add("impedances", state.impedances_timestamp, state.cell_impedances, state.impedance_count)
+
+	def add(self, kind, timestamp, values, count):
+		if self.failed:
+			return
+
+		day = time.strftime(STORE_DAY_FORMAT, time.localtime(timestamp))
+		if (day != self.day):
+			self.write()
+			self.day = day
+			self.compress_segments()
+
+		# all rows of a block have the same number of cells
+		batch = self.batches[kind]
+		if (count != len(batch.columns)):
+			self.write_batch(kind)
+			batch.clear(count)
+		batch.add(timestamp, values)
+
+		if (((timestamp - self.written) >= self.interval) or (timestamp < self.written)):
+			self.write()
+			self.written = timestamp
+
+	def segment(self, kind, day, suffix=STORE_SUFFIX):
+		return os.path.join(self.directory, kind + "-" + day + suffix)
+
+	def write_batch(self, kind):
+		batch = self.batches[kind]
+		if ((len(batch.timestamps) == 0) or self.failed):
+			return
+		try:
+			with open(self.segment(kind, self.day), 'ab') as segment:
+				segment.write(batch.block())
+		except OSError as e:
+			self.fail(e)
+			return
+		batch.clear(len(batch.columns))
+
+	def write(self):
+		for kind in STORE_KINDS:
+			self.write_batch(kind)
+
+	# Queues the files of all days except the current one for compression,
+	# also the ones left behind by an earlier run. With the main loop a
+	# GLib idle callback compresses them, the serial events come first,
+	# without it the loop calls compress_step() once per pass.
+	def compress_segments(self):
+		try:
+			filenames = sorted(os.listdir(self.directory))
+		except OSError as e:
+			self.fail(e)
+			return
+
+		for filename in filenames:
+			if (filename.endswith(STORE_SUFFIX) and not filename.endswith("-" + self.day + STORE_SUFFIX)):
+				filename = os.path.join(self.directory, filename)
+				if ((filename not in self.pending) and ((self.compressor is None) or (filename != self.compressor.filename))):
+					self.pending.append(filename)
+
+		if ((len(self.pending) > 0) and args.victron and (not self.compress_scheduled)):
+			self.compress_scheduled = True
+			gobject.idle_add(self.compress_step)
+
+	# compresses one block, returns False once nothing is left
+	def compress_step(self):
+		if ((self.compressor is None) and (len(self.pending) == 0)):
+			self.compress_scheduled = False
+			return False
 
-	return pos_iterator
+		try:
+			if (self.compressor is None):
+				self.compressor = SegmentCompressor(self.pending.pop(0))
+			if not self.compressor.step():
+				self.compressor = None
+		except OSError as e:
+			self.fail(e)
+			self.compress_scheduled = False
+			return False
+		return True
+
+	# A full or read only disk stops the history files with one warning,
+	# the BMS values are still read and published.
+	def fail(self, e):
+		logging.warning("History files in " + self.directory + " disabled: " + str(e))
+		self.failed  = True
+		self.pending = []
+		for batch in self.batches.values():
+			batch.clear(len(batch.columns))
+		if (self.compressor is not None):
+			try:
+				self.compressor.abort()
+			except OSError:
+				pass
+			self.compressor = None
+
+	# Yields (timestamp, value) of one cell or (timestamp, values) of all
+	# cells from start until before end. The files are mapped and only
+	# the blocks within the window are read, the rows not written yet are
+	# included.
+	def query(self, kind, start, end, cell=None):
+		first_day = time.strftime(STORE_DAY_FORMAT, time.localtime(start))
+		last_day  = time.strftime(STORE_DAY_FORMAT, time.localtime(end))
+		segments  = []
+		for filename in os.listdir(self.directory):
+			for suffix in (STORE_SUFFIX, STORE_COMPRESSED_SUFFIX):
+				if (filename.startswith(kind + "-") and filename.endswith(suffix)):
+					day = filename[len(kind) + 1:-len(suffix)]
+					if (first_day <= day <= last_day):
+						segments.append((day, os.path.join(self.directory, filename), suffix == STORE_COMPRESSED_SUFFIX))
+
+		for (day, filename, compressed) in sorted(segments):
+			with open(filename, 'rb') as segment:
+				if (os.fstat(segment.fileno()).st_size == 0):
+					continue
+				with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as content:
+					for row in self.query_segment(content, compressed, start, end, cell):
+						yield row
+
+		batch = self.batches[kind]
+		for (i, timestamp) in enumerate(batch.timestamps):
+			if (start <= timestamp < end):
+				if (cell is None):
+					yield (timestamp, tuple(column[i] for column in batch.columns))
+				elif (cell < len(batch.columns)):
+					yield (timestamp, batch.columns[cell][i])
+
+	def query_segment(self, content, compressed, start, end, cell):
+		rows_found = []
+		with memoryview(content) as view:
+			for (first, last, rows, cells, data) in store_blocks(view):
+				if ((last >= start) and (first < end) and ((cell is None) or (cell < cells))):
+					rows_found.append(store_block_values(data, rows, cells, compressed, cell))
+				data.release()
+
+		for (timestamps, columns) in rows_found:
+			for (i, timestamp) in enumerate(timestamps):
+				if (start <= timestamp < end):
+					if (cell is None):
+						yield (timestamp, tuple(column[i] for column in columns))
+					else:
+						yield (timestamp, columns[0][i])
 
+	def close(self):
+		self.write()
+		if (self.compressor is not None):
+			self.compressor.abort()
+			self.compressor = None
 
-def get_voltage_value(byte1, byte2):
-	return float((float(byte1 * 256) + float(byte2)) / 1000)
 
+def get_temperature_value(value):
+	if (value >= MINUS_TEMPERATURE_OFFSET): # temperature below 0 degree celsius
+		return (-1) * (((256 * 256) - value) / 10.0)
+	else:
+		return value / 10.0
+
+
+# Sum, minimum and maximum of the first count cells with the index of the
+# lowest and highest cell in one pass, cells below minimum_value are
+# skipped. On equal values the first cell wins. Returns None if no cell
+# is valid.
+def cell_aggregates(values, count, minimum_value):
+	total     = 0.0
+	valid     = 0
+	minimum   = 0.0
+	maximum   = 0.0
+	min_index = -1
+	max_index = -1
+
+	for i in range(count):
+		value = values[i]
+		if (value < minimum_value):
+			continue
+		total += value
+		valid += 1
+		if (min_index == -1):
+			minimum   = value
+			maximum   = value
+			min_index = i
+			max_index = i
+		elif (value < minimum):
+			minimum   = value
+			min_index = i
+		elif (value > maximum):
+			maximum   = value
+			max_index = i
+
+	if (valid == 0):
+		return None
+	return (total, minimum, maximum, min_index, max_index, valid)
+
+
+def aggregate_voltages(device):
+	state     = device.state
+	publisher = device.publisher
+
+	aggregates = cell_aggregates(state.cell_voltages, state.cell_count, MIN_CELL_VOLTAGE)
+	if (aggregates is None):
+		logging.debug("Packet Status Cells without valid cell, skip aggregates")
+		return
+
+	(state.voltages_sum, state.voltages_min, state.voltages_max, state.voltages_min_index, state.voltages_max_index, valid) = aggregates
+	state.voltages_diff    = state.voltages_max - state.voltages_min
+	state.voltages_average = float("{:.3f}".format(state.voltages_sum / valid))
+
+	if args.victron:
+		publisher.set_text("/Voltages/Sum",  text_voltage_sum,  state.voltages_sum)
+		publisher.set_text("/Voltages/Max",  text_cell_voltage, state.voltages_max)
+		publisher.set_text("/Voltages/Min",  text_cell_voltage, state.voltages_min)
+		publisher.set_text("/Voltages/Diff", text_voltage_diff, state.voltages_diff)
+		publisher.set_text("/Voltages/Avg",  text_cell_voltage, state.voltages_average)
+		publisher["/Raw/Voltages/Sum"]  = state.voltages_sum
+		publisher["/Raw/Voltages/Max"]  = state.voltages_max
+		publisher["/Raw/Voltages/Min"]  = state.voltages_min
+		publisher["/Raw/Voltages/Diff"] = state.voltages_diff
+		publisher["/Raw/Voltages/Avg"]  = state.voltages_average
+		publisher["/Voltages/MinCellIndex"] = state.voltages_min_index + 1
+		publisher["/Voltages/MaxCellIndex"] = state.voltages_max_index + 1
+
+
+def aggregate_impedances(device):
+	state     = device.state
+	publisher = device.publisher
+
+	aggregates = cell_aggregates(state.cell_impedances, state.impedance_count, MIN_CELL_IMPEDANCE)
+	if (aggregates is None):
+		logging.debug("Packet Impedances without valid cell, skip aggregates")
+		return
+
+	(state.impedances_sum, state.impedances_min, state.impedances_max, state.impedances_min_index, state.impedances_max_index, valid) = aggregates
+	state.impedances_diff    = state.impedances_max - state.impedances_min
+	state.impedances_average = float("{:.3f}".format(state.impedances_sum / valid))
+
+	if args.victron:
+		publisher.set_text("/Impedances/Sum",  text_impedance, state.impedances_sum)
+		publisher.set_text("/Impedances/Max",  text_impedance, state.impedances_max)
+		publisher.set_text("/Impedances/Min",  text_impedance, state.impedances_min)
+		publisher.set_text("/Impedances/Diff", text_impedance, state.impedances_diff)
+		publisher.set_text("/Impedances/Avg",  text_impedance, state.impedances_average)
+		publisher["/Raw/Impedances/Sum"]  = state.impedances_sum
+		publisher["/Raw/Impedances/Max"]  = state.impedances_max
+		publisher["/Raw/Impedances/Min"]  = state.impedances_min
+		publisher["/Raw/Impedances/Diff"] = state.impedances_diff
+		publisher["/Raw/Impedances/Avg"]  = state.impedances_average
+		publisher["/Impedances/MinCellIndex"] = state.impedances_min_index + 1
+		publisher["/Impedances/MaxCellIndex"] = state.impedances_max_index + 1
+
+
+def parse_status_bms(device, packet):
+	state     = device.state
+	publisher = device.publisher
+
+	if (len(packet) != PACKET_LENGTH_STATUS_BMS[0]):
+		logging.debug("Packet Status BMS length unknown, skip")
+		return
+
+	(charged_end_voltage, bms_current_mode, current, sensor_t1, sensor_t2, soc,
+		discharged_end_voltage, bms_charge_relay_status, bms_discharge_relay_status) = STATUS_BMS_LAYOUT.unpack_from(packet)
+
+	# all fields are overwritten, unknown modes and relay states become -1
+	state.charged_end_voltage    = charged_end_voltage / 1000.0
+	state.discharged_end_voltage = discharged_end_voltage / 1000.0
+	state.current_mode           = bms_current_mode if (bms_current_mode in CURRENT_MODE_TEXT) else -1
+	state.current                = current / 10.0
+	state.sensor_t1              = get_temperature_value(sensor_t1)
+	state.sensor_t2              = get_temperature_value(sensor_t2)
+	state.soc                    = soc
+	state.charge_relay_status    = bms_charge_relay_status if (bms_charge_relay_status in RELAY_STATUS_TEXT) else -1
+	state.discharge_relay_status = bms_discharge_relay_status if (bms_discharge_relay_status in RELAY_STATUS_TEXT) else -1
+	state.status_timestamp       = time.time()
+
+	# discharge current is negative
+	if (bms_current_mode == 0x00):
+		state.current = -1 * state.current
+
+	if args.victron:
+		publisher.set_text("/Info/ChargeEndVoltage",    text_voltage_sum, state.charged_end_voltage)
+		publisher.set_text("/Info/DischargeEndVoltage", text_voltage_sum, state.discharged_end_voltage)
+		publisher.set_text("/Info/Current",             text_current, state.current_mode, state.current)
+		publisher.set_text("/Info/Temp/Sensor1",        text_temperature, state.sensor_t1)
+		publisher.set_text("/Info/Temp/Sensor2",        text_temperature, state.sensor_t2)
+		publisher.set_text("/Info/Soc",                 text_soc, state.soc)
+		publisher.set_text("/Info/UpdateTimestamp",     text_timestamp, state.status_timestamp)
+		publisher["/Info/CurrentMode"]                  = CURRENT_MODE_TEXT.get(state.current_mode, "")
+		publisher["/Info/ChargeRelayStatus"]            = RELAY_STATUS_TEXT.get(state.charge_relay_status, "")
+		publisher["/Info/DischargeRelayStatus"]         = RELAY_STATUS_TEXT.get(state.discharge_relay_status, "")
+		publisher["/Raw/Info/ChargeEndVoltage"]         = state.charged_end_voltage
+		publisher["/Raw/Info/DischargeEndVoltage"]      = state.discharged_end_voltage
+		publisher["/Raw/Info/CurrentMode"]              = state.current_mode
+		publisher["/Raw/Info/Current"]                  = state.current
+		publisher["/Raw/Info/Temp/Sensor1"]             = state.sensor_t1
+		publisher["/Raw/Info/Temp/Sensor2"]             = state.sensor_t2
+		publisher["/Raw/Info/Soc"]                      = state.soc
+		publisher["/Raw/Info/ChargeRelayStatus"]        = state.charge_relay_status
+		publisher["/Raw/Info/DischargeRelayStatus"]     = state.discharge_relay_status
+		publisher["/Raw/Info/UpdateTimestamp"]          = state.status_timestamp
+
+	# the line is only built if the logger emits it
+	if (device.history is not None):
+		device.history.add_status_bms(state)
+	if (device.aggregator is not None):
+		device.aggregator.add_status_bms(device)
+
+	if (device.log_digest is None):
+		logging.info("%sBMS Status %s", device.label, LazyText(log_status_bms, state))
+	else:
+		device.log_digest.add_status_bms(state)
 
-def get_current_value(byte1, byte2):
-	return float((float(byte1 * 256) + float(byte2)) / 10)
 
+def parse_status_cells(device, packet):
+	state     = device.state
+	publisher = device.publisher
+	packet_length = len(packet)
 
-def get_current1_value(byte1, byte2):
-	return float((float(byte1) + float(byte2 * 256)) / 10)
+	if (packet_length not in PACKET_LENGTH_STATUS_CELLS):
+		logging.debug("Packet Status Cells length unknown, skip")
+		return
 
+	(cell_count, voltages_layout, capacity_layout) = STATUS_CELLS_LAYOUTS[packet_length]
+	cell_values = voltages_layout.unpack_from(packet)
 
-def get_temperature_value(byte1, byte2):
-	if (((byte1 * 256) + byte2) >= MINUS_TEMPERATURE_OFFSET): # temperature below 0 degree celsius
-		return (-1) * float(((256 * 256) - (float(byte1 * 256) + float(byte2))) / 10)
+	# cell voltages BMS8/BMS16/BMS24
+	cell_voltages = state.cell_voltages
+	state.set_cell_count(cell_count)
+	for i in range(cell_count):
+		cell_voltages[i] = cell_values[i] / 1000.0
+
+	if args.victron:
+		add_cell_paths(device, cell_count)
+		for i in range(cell_count):
+			publisher.set_text(CELL_VOLTAGE_PATHS[i], text_cell_voltage, cell_voltages[i])
+			publisher[CELL_VOLTAGE_RAW_PATHS[i]] = cell_voltages[i]
+
+
+	if stage_timers.enabled:
+		stage_timers.call(STAGE_AGGREGATE, aggregate_voltages, device)
 	else:
-		return float((float(byte1 * 256) + float(byte2)) / 10)
-	
-def get_battery_capacity(byte1, byte2, byte3, byte4):
-	return float((float(byte1) + float(byte2 * 256) + float(byte3 * 256 * 256) + float(byte4 * 256 * 256 * 256)) / 1000)
+		aggregate_voltages(device)
+
+
+	# get battery capacity
+	(battery_capacity_wh, battery_capacity_ah) = capacity_layout.unpack_from(packet, 4 + (2 * cell_count))
+	state.battery_capacity_wh = battery_capacity_wh / 1000.0
+	state.battery_capacity_ah = battery_capacity_ah / 1000.0
+	state.voltages_timestamp  = time.time()
+
+	if args.victron:
+		publisher.set_text("/Voltages/BatteryCapacityWH", text_capacity, state.battery_capacity_wh, "Wh")
+		publisher.set_text("/Voltages/BatteryCapacityAH", text_capacity, state.battery_capacity_ah, "Ah")
+		publisher.set_text("/Voltages/UpdateTimestamp",   text_timestamp, state.voltages_timestamp)
+		publisher["/Raw/Voltages/BatteryCapacityWH"]      = state.battery_capacity_wh
+		publisher["/Raw/Voltages/BatteryCapacityAH"]      = state.battery_capacity_ah
+		publisher["/Raw/Voltages/UpdateTimestamp"]        = state.voltages_timestamp
+
+	if (device.history is not None):
+		device.history.add_status_cells(state)
+	if (device.store is not None):
+		device.store.add_status_cells(state)
+	if (device.aggregator is not None):
+		device.aggregator.add_status_cells(device)
+
+	if (device.log_digest is None):
+		logging.info("%sBMS Voltages %s", device.label, LazyText(log_status_cells, state))
+	else:
+		device.log_digest.add_status_cells(state)
 
 
-def get_cell_impedance(byte1, byte2):
-	return float((float(byte1) + float(byte2 * 256)) / 10)
+def parse_status_impedances(device, packet):
+	state     = device.state
+	publisher = device.publisher
+	packet_length = len(packet)
 
+	if (packet_length not in STATUS_IMPEDANCES_LAYOUTS):
+		logging.debug("Packet Impedances length unknown, skip")
+		return
 
+	(cell_count, impedances_layout) = STATUS_IMPEDANCES_LAYOUTS[packet_length]
+	logging.debug("Packet Impedances, detected cells: #%d", cell_count)
 
-def parse_packet(packet):
-	logging.debug("Parse Packet [" + str(len(packet)) + "] bytes")
-	debug_packet(packet)
+	cell_values = impedances_layout.unpack_from(packet)
+	(bms_current_mode1, current1) = cell_values[0:2]
 
-	while (len(packet) >= PACKET_LENGTH_MINIMUM): 
-		header_position = get_header_position(packet)
+	# Chargery protocol manual:
+	# Current 1 (A), It is instant current when measure cell impedance
+	# Current mode 1 means battery is in charging or discharging when cell impedance is measured
+	state.current_mode1 = bms_current_mode1 if (bms_current_mode1 in CURRENT_MODE1_TEXT) else -1
+	state.current1      = current1 / 10.0
 
-		# now parse the packet	
-		if ((header_position == -1) or (header_position == len(packet) - 1)):
-			logging.debug("Packet Invalid")
-			packet = ""
-		else:
-			# strip packet
-			packet = packet[(header_position - 1):]
-			
-			if (len(packet) >= 4): 
-				if ((packet[0] == PACKET_HEADER) and (packet[1] == PACKET_HEADER)):
-					packet_length = packet[3]
-					logging.debug("Packet Length [" + str (packet_length) + " bytes]")
-					debug_packet(packet)
-		
-					if (packet[2] == PACKET_STATUS_BMS):
-					
-						if (len(packet) < PACKET_LENGTH_STATUS_BMS[0]):
-							logging.debug("Packet Status BMS too short, skip")
-							packet = ""
-						else:
-							# delete old data
-							reset_status_values()
-
-							# checksum value
-							checksum = packet[packet_length-1]
-							checksum_check = 0
-
-							# calculate checksum
-							for i in range(packet_length-1):
-								checksum_check = checksum_check + packet[i]
-							checksum_check = checksum_check % 256
-							logging.debug("Packet Checksum : " + str(checksum) + "|" + str(checksum_check))
-							
-							# data integrity does match
-							if (checksum == checksum_check):
-
-								# charge end voltage
-								BMS_STATUS['bms']['charged_end_voltage']['value'] = get_voltage_value(packet[4], packet[5])
-								BMS_STATUS['bms']['charged_end_voltage']['text'] = "{:.2f}".format(BMS_STATUS['bms']['charged_end_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Info/ChargeEndVoltage"] = BMS_STATUS['bms']['charged_end_voltage']['text']
-									dbusservice["/Raw/Info/ChargeEndVoltage"] = BMS_STATUS['bms']['charged_end_voltage']['value']
-
-								# actual current
-								BMS_STATUS['bms']['current']['value'] = get_current_value(packet[7], packet[8])
-
-								# charge mode
-								bms_current_mode = packet[6]
-								if (bms_current_mode == 0x00):
-									BMS_STATUS['bms']['current_mode']['value'] = 0
-									BMS_STATUS['bms']['current_mode']['text']  = "Discharge"
-									BMS_STATUS['bms']['current']['text'] = "-" + str(BMS_STATUS['bms']['current']['value']) + "A"
-									BMS_STATUS['bms']['current']['value'] = -1 * BMS_STATUS['bms']['current']['value']
-								elif (bms_current_mode == 0x01):
-									BMS_STATUS['bms']['current_mode']['value'] = 1
-									BMS_STATUS['bms']['current_mode']['text']  = "Charge"
-									BMS_STATUS['bms']['current']['text'] = str(BMS_STATUS['bms']['current']['value']) + "A"
-								elif (bms_current_mode == 0x02):
-									BMS_STATUS['bms']['current_mode']['value'] = 2
-									BMS_STATUS['bms']['current_mode']['text']  = "Storage"
-									BMS_STATUS['bms']['current']['text'] = str(BMS_STATUS['bms']['current']['value']) + "A"
-								else:
-									BMS_STATUS['bms']['current_mode']['value'] = -1
-									BMS_STATUS['bms']['current_mode']['text']  = ""
-									BMS_STATUS['bms']['current']['text'] = ""
-								
-								if args.victron:
-									dbusservice["/Info/CurrentMode"] = BMS_STATUS['bms']['current_mode']['text']
-									dbusservice["/Info/Current"]     = BMS_STATUS['bms']['current']['text']
-									dbusservice["/Raw/Info/CurrentMode"] = BMS_STATUS['bms']['current_mode']['value']
-									dbusservice["/Raw/Info/Current"]     = BMS_STATUS['bms']['current']['value']
-
-								# current temperatures
-								BMS_STATUS['bms']['temperature']['sensor_t1']['value'] = get_temperature_value(packet[9], packet[10])
-								BMS_STATUS['bms']['temperature']['sensor_t1']['text'] = str(BMS_STATUS['bms']['temperature']['sensor_t1']['value']) + "C"
-								BMS_STATUS['bms']['temperature']['sensor_t2']['value'] = get_temperature_value(packet[11], packet[12])
-								BMS_STATUS['bms']['temperature']['sensor_t2']['text'] = str(BMS_STATUS['bms']['temperature']['sensor_t2']['value']) + "C"
-
-								if args.victron:
-									dbusservice["/Info/Temp/Sensor1"] = BMS_STATUS['bms']['temperature']['sensor_t1']['text']
-									dbusservice["/Info/Temp/Sensor2"] = BMS_STATUS['bms']['temperature']['sensor_t2']['text']
-									dbusservice["/Raw/Info/Temp/Sensor1"] = BMS_STATUS['bms']['temperature']['sensor_t1']['value']
-									dbusservice["/Raw/Info/Temp/Sensor2"] = BMS_STATUS['bms']['temperature']['sensor_t2']['value']
-
-								# soc value
-								BMS_STATUS['bms']['soc']['value'] = packet[13]
-								BMS_STATUS['bms']['soc']['text'] = str(packet[13]) + "%"
-								if args.victron:
-									dbusservice["/Info/Soc"] = BMS_STATUS['bms']['soc']['text']
-									dbusservice["/Raw/Info/Soc"] = BMS_STATUS['bms']['soc']['value']
-
-								# discharge end voltage
-								BMS_STATUS['bms']['discharged_end_voltage']['value'] = get_voltage_value(packet[14], packet[15])
-								BMS_STATUS['bms']['discharged_end_voltage']['text'] = "{:.2f}".format(BMS_STATUS['bms']['discharged_end_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Info/DischargeEndVoltage"] = BMS_STATUS['bms']['discharged_end_voltage']['text']
-									dbusservice["/Raw/Info/DischargeEndVoltage"] = BMS_STATUS['bms']['discharged_end_voltage']['value']
-
-								# charge relay status
-								bms_charge_relay_status = packet[16]
-								if (bms_charge_relay_status == 0x00):
-									BMS_STATUS['bms']['charge_relay_status']['value'] = 0
-									BMS_STATUS['bms']['charge_relay_status']['text']  = "On"
-								elif (bms_charge_relay_status == 0x01):
-									BMS_STATUS['bms']['charge_relay_status']['value'] = 1
-									BMS_STATUS['bms']['charge_relay_status']['text']  = "Off"
-								else:
-									BMS_STATUS['bms']['charge_relay_status']['value'] = -1
-									BMS_STATUS['bms']['charge_relay_status']['text']  = ""
-
-								if args.victron:
-									dbusservice["/Info/ChargeRelayStatus"] = BMS_STATUS['bms']['charge_relay_status']['text']
-									dbusservice["/Raw/Info/ChargeRelayStatus"] = BMS_STATUS['bms']['charge_relay_status']['value']
-
-
-								# discharge relay status
-								bms_discharge_relay_status = packet[17]
-								if (bms_discharge_relay_status == 0x00):
-									BMS_STATUS['bms']['discharge_relay_status']['value'] = 0
-									BMS_STATUS['bms']['discharge_relay_status']['text']  = "On"
-								elif (bms_discharge_relay_status == 0x01):
-									BMS_STATUS['bms']['discharge_relay_status']['value'] = 1
-									BMS_STATUS['bms']['discharge_relay_status']['text']  = "Off"
-								else:
-									BMS_STATUS['bms']['discharge_relay_status']['value'] = -1
-									BMS_STATUS['bms']['discharge_relay_status']['text']  = ""
-
-								if args.victron:
-									dbusservice["/Info/DischargeRelayStatus"] = BMS_STATUS['bms']['discharge_relay_status']['text']
-									dbusservice["/Raw/Info/DischargeRelayStatus"] = BMS_STATUS['bms']['discharge_relay_status']['value']
-
-								
-								# update timestamp
-								current_date = datetime.datetime.now()
-								BMS_STATUS['bms']['timestamp']['value'] = time.time()
-								BMS_STATUS['bms']['timestamp']['text']  = current_date.strftime('%a %d.%m.%Y %H:%M:%S')
-								if args.victron:
-									dbusservice["/Info/UpdateTimestamp"] = BMS_STATUS['bms']['timestamp']['text']
-									dbusservice["/Raw/Info/UpdateTimestamp"] = BMS_STATUS['bms']['timestamp']['value']
-
-								# print (BMS_STATUS)
-								logging.info("BMS Status [SOC|" + BMS_STATUS['bms']['soc']['text'] +
-									"][CHARGE RELAY|" + BMS_STATUS['bms']['charge_relay_status']['text'] + 
-									"][DISCHARGE RELAY|" + BMS_STATUS['bms']['discharge_relay_status']['text'] + 
-									"][MODE|" + BMS_STATUS['bms']['current_mode']['text'] + 
-									"][CURRENT|" + BMS_STATUS['bms']['current']['text'] + 
-									"][T1|" + BMS_STATUS['bms']['temperature']['sensor_t1']['text'] + 
-									"][T2|" + BMS_STATUS['bms']['temperature']['sensor_t1']['text'] + 
-									"][CHARGE END VOLTAGE|" + BMS_STATUS['bms']['charged_end_voltage']['text'] + 
-									"][DISCHARGE END VOLTAGE|" + BMS_STATUS['bms']['discharged_end_voltage']['text'] + "]") 
-
-							else:
-								logging.info("Packet Checksum wrong, skip packet")
-
-							# strip packet
-							packet = packet[packet_length:]
-			
-					elif (packet[2] == PACKET_STATUS_CELLS):
-
-						if (len(packet) < PACKET_LENGTH_STATUS_CELLS[0]):
-							logging.debug("Packet Status Cells too short, skip")
-							packet = ""
-						else:
-							# delete old data
-							reset_voltages_values()
-
-							# checksum value
-							checksum = -1
-							checksum_check = 0
-
-							if (packet_length == PACKET_LENGTH_STATUS_CELLS[0]): # packet from BMS8
-								logging.debug("Packet Status Cells BMS8")
-
-								if (len(packet) < PACKET_LENGTH_STATUS_CELLS[0]):
-									logging.debug("Packet Status Cells too short, skip")
-									packet = ""
-								else:
-									checksum = packet[packet_length-1]
-
-									# calculate checksum
-									for i in range(packet_length-1):
-										checksum_check = checksum_check + packet[i]
-									checksum_check = checksum_check % 256
-									logging.debug("Packet Checksum BMS8: " + str(checksum) + "|" + str(checksum_check))
-
-							elif (packet_length == PACKET_LENGTH_STATUS_CELLS[1]): # packet from BMS16
-								logging.debug("Packet Status Cells BMS16")
-
-								if (len(packet) < PACKET_LENGTH_STATUS_CELLS[1]):
-									logging.debug("Packet Status Cells too short, skip")
-									packet = ""
-								else:
-									checksum = packet[packet_length-1]
-
-									# calculate checksum
-									for i in range(packet_length-1):
-										checksum_check = checksum_check + packet[i]
-									checksum_check = checksum_check % 256
-									logging.debug("Packet Checksum BMS16: " + str(checksum) + "|" + str(checksum_check))
-							
-							elif (packet_length == PACKET_LENGTH_STATUS_CELLS[2]): # packet from BMS24 
-								logging.debug("Packet Status Cells BMS24")
-
-								if (len(packet) < PACKET_LENGTH_STATUS_CELLS[2]):
-									logging.debug("Packet Status Cells too short, skip")
-									packet = ""
-								else:
-									checksum = packet[packet_length-1]
-
-									# calculate checksum
-									for i in range(packet_length-1):
-										checksum_check = checksum_check + packet[i]
-									checksum_check = checksum_check % 256
-									logging.debug("Packet Checksum BMS24: " + str(checksum) + "|" + str(checksum_check))
-
-
-							# data integrity does match
-							if (checksum == checksum_check):
-
-								# cell voltages BMS8/BMS16/BMS24
-								BMS_STATUS['voltages']['cell1_voltage']['value'] = get_voltage_value(packet[4], packet[5])
-								BMS_STATUS['voltages']['cell1_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell1_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell1"] = BMS_STATUS['voltages']['cell1_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell1"] = BMS_STATUS['voltages']['cell1_voltage']['value']
-
-								BMS_STATUS['voltages']['cell2_voltage']['value'] = get_voltage_value(packet[6], packet[7])
-								BMS_STATUS['voltages']['cell2_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell2_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell2"] = BMS_STATUS['voltages']['cell2_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell2"] = BMS_STATUS['voltages']['cell2_voltage']['value']
-
-								BMS_STATUS['voltages']['cell3_voltage']['value'] = get_voltage_value(packet[8], packet[9])
-								BMS_STATUS['voltages']['cell3_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell3_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell3"] = BMS_STATUS['voltages']['cell3_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell3"] = BMS_STATUS['voltages']['cell3_voltage']['value']
-
-								BMS_STATUS['voltages']['cell4_voltage']['value'] = get_voltage_value(packet[10], packet[11])
-								BMS_STATUS['voltages']['cell4_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell4_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell4"] = BMS_STATUS['voltages']['cell4_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell4"] = BMS_STATUS['voltages']['cell4_voltage']['value']
-
-								BMS_STATUS['voltages']['cell5_voltage']['value'] = get_voltage_value(packet[12], packet[13])
-								BMS_STATUS['voltages']['cell5_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell5_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell5"] = BMS_STATUS['voltages']['cell5_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell5"] = BMS_STATUS['voltages']['cell5_voltage']['value']
-
-								BMS_STATUS['voltages']['cell6_voltage']['value'] = get_voltage_value(packet[14], packet[15])
-								BMS_STATUS['voltages']['cell6_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell6_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell6"] = BMS_STATUS['voltages']['cell6_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell6"] = BMS_STATUS['voltages']['cell6_voltage']['value']
-
-								BMS_STATUS['voltages']['cell7_voltage']['value'] = get_voltage_value(packet[16], packet[17])
-								BMS_STATUS['voltages']['cell7_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell7_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell7"] = BMS_STATUS['voltages']['cell7_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell7"] = BMS_STATUS['voltages']['cell7_voltage']['value']
-
-								BMS_STATUS['voltages']['cell8_voltage']['value'] = get_voltage_value(packet[18], packet[19])
-								BMS_STATUS['voltages']['cell8_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell8_voltage']['value']) + "V"
-								if args.victron:
-									dbusservice["/Voltages/Cell8"] = BMS_STATUS['voltages']['cell8_voltage']['text']
-									dbusservice["/Raw/Voltages/Cell8"] = BMS_STATUS['voltages']['cell8_voltage']['value']
-
-								if ((packet_length == PACKET_LENGTH_STATUS_CELLS[1]) or (packet_length == PACKET_LENGTH_STATUS_CELLS[2])): # packet from BMS16/BMS24
-
-									BMS_STATUS['voltages']['cell9_voltage']['value'] = get_voltage_value(packet[20], packet[21])
-									BMS_STATUS['voltages']['cell9_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell9_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell9"] = BMS_STATUS['voltages']['cell9_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell9"] = BMS_STATUS['voltages']['cell9_voltage']['value']
-
-									BMS_STATUS['voltages']['cell10_voltage']['value'] = get_voltage_value(packet[22], packet[23])
-									BMS_STATUS['voltages']['cell10_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell10_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell10"] = BMS_STATUS['voltages']['cell10_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell10"] = BMS_STATUS['voltages']['cell10_voltage']['value']
-
-									BMS_STATUS['voltages']['cell11_voltage']['value'] = get_voltage_value(packet[24], packet[25])
-									BMS_STATUS['voltages']['cell11_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell11_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell11"] = BMS_STATUS['voltages']['cell11_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell11"] = BMS_STATUS['voltages']['cell11_voltage']['value']
-
-									BMS_STATUS['voltages']['cell12_voltage']['value'] = get_voltage_value(packet[26], packet[27])
-									BMS_STATUS['voltages']['cell12_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell12_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell12"] = BMS_STATUS['voltages']['cell12_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell12"] = BMS_STATUS['voltages']['cell12_voltage']['value']
-
-									BMS_STATUS['voltages']['cell13_voltage']['value'] = get_voltage_value(packet[28], packet[29])
-									BMS_STATUS['voltages']['cell13_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell13_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell13"] = BMS_STATUS['voltages']['cell13_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell13"] = BMS_STATUS['voltages']['cell13_voltage']['value']
-
-									BMS_STATUS['voltages']['cell14_voltage']['value'] = get_voltage_value(packet[30], packet[31])
-									BMS_STATUS['voltages']['cell14_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell14_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell14"] = BMS_STATUS['voltages']['cell14_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell14"] = BMS_STATUS['voltages']['cell14_voltage']['value']
-
-									BMS_STATUS['voltages']['cell15_voltage']['value'] = get_voltage_value(packet[32], packet[33])
-									BMS_STATUS['voltages']['cell15_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell15_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell15"] = BMS_STATUS['voltages']['cell15_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell15"] = BMS_STATUS['voltages']['cell15_voltage']['value']
-
-									BMS_STATUS['voltages']['cell16_voltage']['value'] = get_voltage_value(packet[34], packet[35])
-									BMS_STATUS['voltages']['cell16_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell16_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell16"] = BMS_STATUS['voltages']['cell16_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell16"] = BMS_STATUS['voltages']['cell16_voltage']['value']
-
-
-								if (packet_length == PACKET_LENGTH_STATUS_CELLS[2]): # packet from BMS24
-
-									BMS_STATUS['voltages']['cell17_voltage']['value'] = get_voltage_value(packet[36], packet[37])
-									BMS_STATUS['voltages']['cell17_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell17_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell17"] = BMS_STATUS['voltages']['cell17_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell17"] = BMS_STATUS['voltages']['cell17_voltage']['value']
-
-									BMS_STATUS['voltages']['cell18_voltage']['value'] = get_voltage_value(packet[38], packet[39])
-									BMS_STATUS['voltages']['cell18_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell18_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell18"] = BMS_STATUS['voltages']['cell18_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell18"] = BMS_STATUS['voltages']['cell18_voltage']['value']
-
-									BMS_STATUS['voltages']['cell19_voltage']['value'] = get_voltage_value(packet[40], packet[41])
-									BMS_STATUS['voltages']['cell19_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell19_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell19"] = BMS_STATUS['voltages']['cell19_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell19"] = BMS_STATUS['voltages']['cell19_voltage']['value']
-
-									BMS_STATUS['voltages']['cell20_voltage']['value'] = get_voltage_value(packet[42], packet[43])
-									BMS_STATUS['voltages']['cell20_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell20_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell20"] = BMS_STATUS['voltages']['cell20_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell20"] = BMS_STATUS['voltages']['cell20_voltage']['value']
-
-									BMS_STATUS['voltages']['cell21_voltage']['value'] = get_voltage_value(packet[44], packet[45])
-									BMS_STATUS['voltages']['cell21_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell21_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell21"] = BMS_STATUS['voltages']['cell21_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell21"] = BMS_STATUS['voltages']['cell21_voltage']['value']
-
-									BMS_STATUS['voltages']['cell22_voltage']['value'] = get_voltage_value(packet[46], packet[47])
-									BMS_STATUS['voltages']['cell22_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell22_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell22"] = BMS_STATUS['voltages']['cell22_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell22"] = BMS_STATUS['voltages']['cell22_voltage']['value']
-
-									BMS_STATUS['voltages']['cell23_voltage']['value'] = get_voltage_value(packet[48], packet[49])
-									BMS_STATUS['voltages']['cell23_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell23_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell23"] = BMS_STATUS['voltages']['cell23_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell23"] = BMS_STATUS['voltages']['cell23_voltage']['value']
-
-									BMS_STATUS['voltages']['cell24_voltage']['value'] = get_voltage_value(packet[50], packet[51])
-									BMS_STATUS['voltages']['cell24_voltage']['text'] = "{:.3f}".format(BMS_STATUS['voltages']['cell24_voltage']['value']) + "V"
-									if args.victron:
-										dbusservice["/Voltages/Cell24"] = BMS_STATUS['voltages']['cell24_voltage']['text']
-										dbusservice["/Raw/Voltages/Cell24"] = BMS_STATUS['voltages']['cell24_voltage']['value']
-								
-									
-
-								# get min/max voltages to calculate the diff
-								cell_voltages = []
-
-								if (BMS_STATUS['voltages']['cell1_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell1_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell2_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell2_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell3_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell3_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell4_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell4_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell5_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell5_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell6_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell6_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell7_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell7_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell8_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell8_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell9_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell9_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell10_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell10_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell11_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell11_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell12_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell12_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell13_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell13_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell14_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell14_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell15_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell15_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell16_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell16_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell17_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell17_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell18_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell18_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell19_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell19_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell20_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell20_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell21_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell21_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell22_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell22_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell23_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell23_voltage']['value'])
-								if (BMS_STATUS['voltages']['cell24_voltage']['value'] >= MIN_CELL_VOLTAGE):
-									cell_voltages.append(BMS_STATUS['voltages']['cell24_voltage']['value'])
-									
-								BMS_STATUS['voltages']['agg_voltages']['sum']['value']      = sum(cell_voltages)
-								BMS_STATUS['voltages']['agg_voltages']['sum']['text']       = "{:.2f}".format(BMS_STATUS['voltages']['agg_voltages']['sum']['value']) + "V" 
-								BMS_STATUS['voltages']['agg_voltages']['max']['value']      = max(cell_voltages)
-								BMS_STATUS['voltages']['agg_voltages']['max']['text']       = "{:.3f}".format(BMS_STATUS['voltages']['agg_voltages']['max']['value']) + "V" 
-								BMS_STATUS['voltages']['agg_voltages']['min']['value']      = min(cell_voltages)
-								BMS_STATUS['voltages']['agg_voltages']['min']['text']       = "{:.3f}".format(BMS_STATUS['voltages']['agg_voltages']['min']['value']) + "V" 
-								BMS_STATUS['voltages']['agg_voltages']['diff']['value']     = BMS_STATUS['voltages']['agg_voltages']['max']['value'] - BMS_STATUS['voltages']['agg_voltages']['min']['value']
-								BMS_STATUS['voltages']['agg_voltages']['diff']['text']      = "{:.0f}".format(BMS_STATUS['voltages']['agg_voltages']['diff']['value'] * 1000) + "mV"
-								BMS_STATUS['voltages']['agg_voltages']['average']['value']  = float("{:.3f}".format(sum(cell_voltages)/len(cell_voltages)))
-								BMS_STATUS['voltages']['agg_voltages']['average']['text']   = "{:.3f}".format(BMS_STATUS['voltages']['agg_voltages']['average']['value']) + "V" 
-
-								if args.victron:
-									dbusservice["/Voltages/Sum"]      = BMS_STATUS['voltages']['agg_voltages']['sum']['text']
-									dbusservice["/Raw/Voltages/Sum"]  = BMS_STATUS['voltages']['agg_voltages']['sum']['value']
-									dbusservice["/Voltages/Max"]      = BMS_STATUS['voltages']['agg_voltages']['max']['text']
-									dbusservice["/Raw/Voltages/Max"]  = BMS_STATUS['voltages']['agg_voltages']['max']['value']
-									dbusservice["/Voltages/Min"]      = BMS_STATUS['voltages']['agg_voltages']['min']['text']
-									dbusservice["/Raw/Voltages/Min"]  = BMS_STATUS['voltages']['agg_voltages']['min']['value']
-									dbusservice["/Voltages/Diff"]     = BMS_STATUS['voltages']['agg_voltages']['diff']['text']
-									dbusservice["/Raw/Voltages/Diff"] = BMS_STATUS['voltages']['agg_voltages']['diff']['value']
-									dbusservice["/Voltages/Avg"]      = BMS_STATUS['voltages']['agg_voltages']['average']['text']
-									dbusservice["/Raw/Voltages/Avg"]  = BMS_STATUS['voltages']['agg_voltages']['average']['value']
-
-
-								if (packet_length == PACKET_LENGTH_STATUS_CELLS[0]): # packet from BMS8
-
-									# get battery capacity
-									BMS_STATUS['voltages']['battery_capacity_wh']['value'] = get_battery_capacity(packet[20], packet[21], packet[22], packet[23])
-									BMS_STATUS['voltages']['battery_capacity_wh']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_wh']['value']) + "Wh"
-									if args.victron:
-										dbusservice["/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['value']
-
-									BMS_STATUS['voltages']['battery_capacity_ah']['value'] = get_battery_capacity(packet[24], packet[25], packet[26], packet[27])
-									BMS_STATUS['voltages']['battery_capacity_ah']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_ah']['value']) + "Ah"
-									if args.victron:
-										dbusservice["/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['value']
-
-
-								elif (packet_length == PACKET_LENGTH_STATUS_CELLS[1]): # packet from BMS16
-
-									# get battery capacity
-									BMS_STATUS['voltages']['battery_capacity_wh']['value'] = get_battery_capacity(packet[36], packet[37], packet[38], packet[39])
-									BMS_STATUS['voltages']['battery_capacity_wh']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_wh']['value']) + "Wh"
-									if args.victron:
-										dbusservice["/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['value']
-
-									BMS_STATUS['voltages']['battery_capacity_ah']['value'] = get_battery_capacity(packet[40], packet[41], packet[42], packet[43])
-									BMS_STATUS['voltages']['battery_capacity_ah']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_ah']['value']) + "Ah"
-									if args.victron:
-										dbusservice["/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['value']
-
-
-								elif (packet_length == PACKET_LENGTH_STATUS_CELLS[2]): # packet from BMS24
-
-									# get battery capacity
-									BMS_STATUS['voltages']['battery_capacity_wh']['value'] = get_battery_capacity(packet[52], packet[53], packet[54], packet[55])
-									BMS_STATUS['voltages']['battery_capacity_wh']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_wh']['value']) + "Wh"
-									if args.victron:									
-										dbusservice["/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityWH"] = BMS_STATUS['voltages']['battery_capacity_wh']['value']
-
-									BMS_STATUS['voltages']['battery_capacity_ah']['value'] = get_battery_capacity(packet[56], packet[57], packet[58], packet[59])
-									BMS_STATUS['voltages']['battery_capacity_ah']['text'] = "{:.0f}".format(BMS_STATUS['voltages']['battery_capacity_ah']['value']) + "Ah"
-									if args.victron:
-										dbusservice["/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['text']
-										dbusservice["/Raw/Voltages/BatteryCapacityAH"] = BMS_STATUS['voltages']['battery_capacity_ah']['value']
-
-
-								
-								# update timestamp
-								current_date = datetime.datetime.now()
-								BMS_STATUS['voltages']['timestamp']['value'] = time.time()
-								BMS_STATUS['voltages']['timestamp']['text']  = current_date.strftime('%a %d.%m.%Y %H:%M:%S')
-								if args.victron:
-									dbusservice["/Voltages/UpdateTimestamp"] = BMS_STATUS['voltages']['timestamp']['text']
-									dbusservice["/Raw/Voltages/UpdateTimestamp"] = BMS_STATUS['voltages']['timestamp']['value']
-									
-
-								# print (BMS_STATUS)
-								if (packet_length == PACKET_LENGTH_STATUS_CELLS[0]): # packet from BMS8
-								
-									logging.info("BMS Voltages " +
-										"[CAPACITYAH|" + BMS_STATUS['voltages']['battery_capacity_ah']['text'] +
-										"][CAPACITYWH|" + BMS_STATUS['voltages']['battery_capacity_wh']['text'] +
-										"][DIFF|" + BMS_STATUS['voltages']['agg_voltages']['diff']['text'] +
-										"][SUM|" + BMS_STATUS['voltages']['agg_voltages']['sum']['text'] +
-										"][#1|"  + BMS_STATUS['voltages']['cell1_voltage']['text'] +
-										"][#2|"  + BMS_STATUS['voltages']['cell2_voltage']['text'] + 
-										"][#3|"  + BMS_STATUS['voltages']['cell3_voltage']['text'] + 
-										"][#4|"  + BMS_STATUS['voltages']['cell4_voltage']['text'] +
-										"][#5|"  + BMS_STATUS['voltages']['cell5_voltage']['text'] +
-										"][#6|"  + BMS_STATUS['voltages']['cell6_voltage']['text'] +
-										"][#7|"  + BMS_STATUS['voltages']['cell7_voltage']['text'] +
-										"][#8|"  + BMS_STATUS['voltages']['cell8_voltage']['text'] + "]")
-
-								elif (packet_length == PACKET_LENGTH_STATUS_CELLS[1]): # packet from BMS16
-
-									logging.info("BMS Voltages " +
-										"[CAPACITYAH|" + BMS_STATUS['voltages']['battery_capacity_ah']['text'] +
-										"][CAPACITYWH|" + BMS_STATUS['voltages']['battery_capacity_wh']['text'] +
-										"][DIFF|" + BMS_STATUS['voltages']['agg_voltages']['diff']['text'] +
-										"][SUM|"  + BMS_STATUS['voltages']['agg_voltages']['sum']['text'] +
-										"][#1|"   + BMS_STATUS['voltages']['cell1_voltage']['text'] +
-										"][#2|"   + BMS_STATUS['voltages']['cell2_voltage']['text'] + 
-										"][#3|"   + BMS_STATUS['voltages']['cell3_voltage']['text'] + 
-										"][#4|"   + BMS_STATUS['voltages']['cell4_voltage']['text'] +
-										"][#5|"   + BMS_STATUS['voltages']['cell5_voltage']['text'] +
-										"][#6|"   + BMS_STATUS['voltages']['cell6_voltage']['text'] +
-										"][#7|"   + BMS_STATUS['voltages']['cell7_voltage']['text'] +
-										"][#8|"   + BMS_STATUS['voltages']['cell8_voltage']['text'] +
-										"][#9|"   + BMS_STATUS['voltages']['cell9_voltage']['text'] + 
-										"][#10|"  + BMS_STATUS['voltages']['cell10_voltage']['text'] + 
-										"][#11|"  + BMS_STATUS['voltages']['cell11_voltage']['text'] +
-										"][#12|"  + BMS_STATUS['voltages']['cell12_voltage']['text'] +
-										"][#13|"  + BMS_STATUS['voltages']['cell13_voltage']['text'] +
-										"][#14|"  + BMS_STATUS['voltages']['cell14_voltage']['text'] +
-										"][#15|"  + BMS_STATUS['voltages']['cell15_voltage']['text'] +
-										"][#16|"  + BMS_STATUS['voltages']['cell16_voltage']['text'] + "]")
-								
-
-								elif (packet_length == PACKET_LENGTH_STATUS_CELLS[2]): # packet from BMS24
-
-									logging.info("BMS Voltages " +
-										"[CAPACITYAH|" + BMS_STATUS['voltages']['battery_capacity_ah']['text'] +
-										"][CAPACITYWH|" + BMS_STATUS['voltages']['battery_capacity_wh']['text'] +
-										"][DIFF|" + BMS_STATUS['voltages']['agg_voltages']['diff']['text'] +
-										"][SUM|"  + BMS_STATUS['voltages']['agg_voltages']['sum']['text'] +
-										"][#1|"   + BMS_STATUS['voltages']['cell1_voltage']['text'] +
-										"][#2|"   + BMS_STATUS['voltages']['cell2_voltage']['text'] + 
-										"][#3|"   + BMS_STATUS['voltages']['cell3_voltage']['text'] + 
-										"][#4|"   + BMS_STATUS['voltages']['cell4_voltage']['text'] +
-										"][#5|"   + BMS_STATUS['voltages']['cell5_voltage']['text'] +
-										"][#6|"   + BMS_STATUS['voltages']['cell6_voltage']['text'] +
-										"][#7|"   + BMS_STATUS['voltages']['cell7_voltage']['text'] +
-										"][#8|"   + BMS_STATUS['voltages']['cell8_voltage']['text'] +
-										"][#9|"   + BMS_STATUS['voltages']['cell9_voltage']['text'] + 
-										"][#10|"  + BMS_STATUS['voltages']['cell10_voltage']['text'] + 
-										"][#11|"  + BMS_STATUS['voltages']['cell11_voltage']['text'] +
-										"][#12|"  + BMS_STATUS['voltages']['cell12_voltage']['text'] +
-										"][#13|"  + BMS_STATUS['voltages']['cell13_voltage']['text'] +
-										"][#14|"  + BMS_STATUS['voltages']['cell14_voltage']['text'] +
-										"][#15|"  + BMS_STATUS['voltages']['cell15_voltage']['text'] +
-										"][#16|"  + BMS_STATUS['voltages']['cell16_voltage']['text'] + 
-										"][#17|"  + BMS_STATUS['voltages']['cell17_voltage']['text'] +
-										"][#18|"  + BMS_STATUS['voltages']['cell18_voltage']['text'] +
-										"][#19|"  + BMS_STATUS['voltages']['cell19_voltage']['text'] +
-										"][#20|"  + BMS_STATUS['voltages']['cell20_voltage']['text'] +
-										"][#21|"  + BMS_STATUS['voltages']['cell21_voltage']['text'] +
-										"][#22|"  + BMS_STATUS['voltages']['cell22_voltage']['text'] +
-										"][#23|"  + BMS_STATUS['voltages']['cell23_voltage']['text'] +
-										"][#24|"  + BMS_STATUS['voltages']['cell24_voltage']['text'] + "]")
-
-							else:
-								logging.debug("Packet Checksum wrong, skip packet")
-
-							# strip packet
-							packet = packet[packet_length:]
-
-					elif (packet[2] == PACKET_STATUS_IMPEDANCES):
-
-						if (len(packet) < PACKET_LENGTH_STATUS_IMPEDANCES):
-							logging.debug("Packet Impedances Cells too short, skip")
-							packet = ""
+	if args.victron:
+		publisher["/Impedances/CurrentMode1"] = CURRENT_MODE1_TEXT.get(state.current_mode1, "")
+		publisher["/Raw/Impedances/CurrentMode1"] = state.current_mode1
+		publisher.set_text("/Impedances/Current1", text_current, state.current_mode1, state.current1)
+		publisher["/Raw/Impedances/Current1"] = state.current1
+
+	cell_impedances = state.cell_impedances
+	state.set_impedance_count(cell_count)
+	for i in range(cell_count):
+		cell_impedances[i] = cell_values[i+2] / 10.0
+
+	if args.victron:
+		add_cell_paths(device, cell_count)
+		for i in range(cell_count):
+			publisher.set_text(CELL_IMPEDANCE_PATHS[i], text_impedance, cell_impedances[i])
+			publisher[CELL_IMPEDANCE_RAW_PATHS[i]] = cell_impedances[i]
+
+
+	if stage_timers.enabled:
+		stage_timers.call(STAGE_AGGREGATE, aggregate_impedances, device)
+	else:
+		aggregate_impedances(device)
+
+
+	# update timestamp
+	state.impedances_timestamp = time.time()
+	if args.victron:
+		publisher.set_text("/Impedances/UpdateTimestamp", text_timestamp, state.impedances_timestamp)
+		publisher["/Raw/Impedances/UpdateTimestamp"] = state.impedances_timestamp
+
+	if (device.history is not None):
+		device.history.add_status_impedances(state)
+	if (device.store is not None):
+		device.store.add_status_impedances(state)
+
+	if (device.log_digest is None):
+		logging.info("%sBMS Impedances %s", device.label, LazyText(log_status_impedances, state))
+	else:
+		device.log_digest.add_status_impedances(state)
+
+
+
+PACKET_DECODERS = {
+	PACKET_STATUS_CELLS      : parse_status_cells,
+	PACKET_STATUS_BMS        : parse_status_bms,
+	PACKET_STATUS_IMPEDANCES : parse_status_impedances
+}
+
+
+# The BMS sends its frames continuously, so a serial read will cut
+# frames at arbitrary positions. The framer keeps the unconsumed tail of
+# every read and completes the frame with the next read. The decoders are
+# called with the device the data was read from.
+class PacketFramer(object):
+
+	def __init__(self, device=None, decoders=PACKET_DECODERS):
+		self.device          = device
+		self.decoders        = decoders
+		self.buffer          = bytearray(RECEIVE_BUFFER_SIZE)
+		self.view            = memoryview(self.buffer)
+		self.filled          = 0
+		self.bytes_carried   = 0
+		self.bytes_dropped   = 0
+		self.resyncs         = 0
+		self.frames          = 0
+		self.checksum_errors = 0
+		self.truncated       = 0
+		self.bytes_received  = 0
+		self.frame_counts    = dict.fromkeys(decoders, 0)
+		self.frame_times     = dict.fromkeys(decoders, 0.0)
+		self.arrival         = 0.0
+		self.arrivals        = {}
+
+	def drop(self, count):
+		if (count > 0):
+			self.bytes_dropped += count
+			self.resyncs += 1
+
+	# Free part of the receive buffer for at most count bytes. The serial
+	# port is read into it and received() parses the bytes in place.
+	def receive_view(self, count):
+		return self.view[self.filled:min(self.filled + count, RECEIVE_BUFFER_SIZE)]
+
+	# arrival is the monotonic time of the serial read, frames completed by
+	# this data are stamped with it in arrivals until they are published
+	def received(self, count, arrival=None):
+		self.arrival = time.monotonic() if (arrival is None) else arrival
+		self.bytes_received += count
+		self.filled += count
+		logging.debug("Parse Packet [%d] bytes", self.filled)
+		debug_packet(self.buffer, self.filled)
+
+		# the incomplete frame left over moves to the start of the buffer
+		consumed = self.parse(self.buffer, self.filled)
+		carried  = self.filled - consumed
+		if ((consumed > 0) and (carried > 0)):
+			self.view[:carried] = self.view[consumed:self.filled]
+		self.filled = carried
+
+		self.bytes_carried = carried
+		logging.debug("Framer [CARRIED|%d bytes][DROPPED|%d bytes][RESYNCS|%d]", self.bytes_carried, self.bytes_dropped, self.resyncs)
+
+	# the carried bytes of an incomplete frame can not be completed after
+	# the serial port was lost
+	def discard(self):
+		self.drop(self.filled)
+		self.filled        = 0
+		self.bytes_carried = 0
+
+	# Copies data into the receive buffer and parses it, for the replay and
+	# data that was not read from the serial port
+	def feed(self, data, arrival=None):
+		with memoryview(data) as source:
+			offset = 0
+			while (offset < len(source)):
+				view = self.receive_view(len(source) - offset)
+				count = len(view)
+				view[:] = source[offset:offset + count]
+				self.received(count, arrival)
+				offset += count
+
+	# Walks the buffer with a cursor and hands every complete frame with a
+	# valid checksum to its decoder as a memoryview, nothing is copied.
+	# Only the first packet_size bytes are parsed, by default all of them.
+	# Returns the number of bytes consumed, the rest is an incomplete frame.
+	def parse(self, packet, packet_size=None):
+		decoders      = self.decoders
+		device        = self.device
+		packet_size   = len(packet) if (packet_size is None) else packet_size
+		cursor        = 0
+
+		with memoryview(packet) as view:
+			while (cursor < packet_size):
+				header_position = packet.find(PACKET_HEADER_BYTES, cursor, packet_size)
+
+				if (header_position == -1):
+					# no header found, keep a trailing header byte as it could
+					# be the first half of the next header
+					if (packet[packet_size - 1] == PACKET_HEADER):
+						self.drop(packet_size - 1 - cursor)
+						cursor = packet_size - 1
+					else:
+						self.drop(packet_size - cursor)
+						cursor = packet_size
+					break
+
+				# resync to the header
+				self.drop(header_position - cursor)
+				cursor = header_position
+
+				if ((packet_size - cursor) < 4):
+					break
+
+				packet_type   = packet[cursor + 2]
+				packet_length = packet[cursor + 3]
+				decoder = decoders.get(packet_type)
+				if ((decoder is None) or (packet_length < PACKET_LENGTH_MINIMUM) or (packet_length > PACKET_LENGTH_MAXIMUM)):
+					logging.debug("Packet Header invalid, resync")
+					self.drop(1)
+					cursor += 1
+					continue
+
+				# frame incomplete, wait for the next read
+				packet_end = cursor + packet_length
+				if (packet_end > packet_size):
+					break
+
+				with view[cursor:packet_end] as frame:
+					checksum = frame[packet_length - 1]
+					if (((sum(frame) - checksum) & 0xFF) == checksum):
+						if stage_timers.enabled:
+							stage_timers.call(STAGE_DECODE, decoder, device, frame)
 						else:
-							# delete old data
-							reset_impedances_values()
-
-							cell_count = int((packet_length - 8) / 2);
-							logging.debug("Packet Impedances, detected cells: #" + str(cell_count))
-
-							# checksum value
-							checksum = packet[packet_length-1]
-							checksum_check = 0
-
-							# calculate checksum
-							for i in range(packet_length-1):
-								checksum_check = checksum_check + packet[i]
-							checksum_check = checksum_check % 256
-							logging.debug("Packet Checksum BMS: " + str(checksum) + "|" + str(checksum_check))
-
-
-							# data integrity does match
-							if (checksum == checksum_check):
-
-								# Chargery protocol manual:
-								# Current 1 (A), It is instant current when measure cell impedance								
-								BMS_STATUS['impedances']['current1']['value'] = get_current1_value(packet[5], packet[6])
-
-								# Chargery protocol manual:
-								# Current mode 1 means battery is in charging or discharging when cell impedance is measured
-								bms_current_mode1 = packet[4]
-								if (bms_current_mode1 == 0x00):
-									BMS_STATUS['impedances']['current_mode1']['value'] = 0
-									BMS_STATUS['impedances']['current_mode1']['text']  = "Discharge"
-									BMS_STATUS['impedances']['current1']['text'] = "-" + str(BMS_STATUS['impedances']['current1']['value']) + "A"
-								elif (bms_current_mode1 == 0x01):
-									BMS_STATUS['impedances']['current_mode1']['value'] = 1
-									BMS_STATUS['impedances']['current_mode1']['text']  = "Charge"
-									BMS_STATUS['impedances']['current1']['text'] = str(BMS_STATUS['impedances']['current1']['value']) + "A"
-								else:
-									BMS_STATUS['impedances']['current_mode1']['value'] = -1
-									BMS_STATUS['impedances']['current_mode1']['text']  = ""
-									BMS_STATUS['impedances']['current1']['text'] = ""
-								if args.victron:
-									dbusservice["/Impedances/CurrentMode1"] = BMS_STATUS['impedances']['current_mode1']['text']
-									dbusservice["/Raw/Impedances/CurrentMode1"] = BMS_STATUS['impedances']['current_mode1']['value']
-									dbusservice["/Impedances/Current1"] = BMS_STATUS['impedances']['current1']['text']
-									dbusservice["/Raw/Impedances/Current1"] = BMS_STATUS['impedances']['current1']['value']
-
-								for i in range(1, cell_count+1):
-									BMS_STATUS['impedances']['cell'+str(i)+'_impedance']['value'] = get_cell_impedance(packet[7+(2*(i-1))], packet[8+(2*(i-1))])
-									BMS_STATUS['impedances']['cell'+str(i)+'_impedance']['text'] = "{:.1f}".format(BMS_STATUS['impedances']['cell'+str(i)+'_impedance']['value']) + "mOhm"
-
-									if args.victron:
-										dbusservice["/Impedances/Cell"+str(i)] = BMS_STATUS['impedances']['cell'+str(i)+'_impedance']['text']
-										dbusservice["/Raw/Impedances/Cell"+str(i)] = BMS_STATUS['impedances']['cell'+str(i)+'_impedance']['value']
-
-
-								
-								# get min/max impedances to calculate the diff
-								cell_impedances = []
-
-								if (BMS_STATUS['impedances']['cell1_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell1_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell2_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell2_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell3_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell3_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell4_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell4_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell5_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell5_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell6_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell6_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell7_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell7_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell8_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell8_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell9_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell9_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell10_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell10_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell11_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell11_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell12_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell12_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell13_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell13_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell14_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell14_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell15_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell15_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell16_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell16_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell17_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell17_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell18_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell18_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell19_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell19_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell20_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell20_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell21_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell21_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell22_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell22_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell23_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell23_impedance']['value'])
-								if (BMS_STATUS['impedances']['cell24_impedance']['value'] >= MIN_CELL_IMPEDANCE):
-									cell_impedances.append(BMS_STATUS['impedances']['cell24_impedance']['value'])
-									
-								BMS_STATUS['impedances']['agg_impedances']['sum']['value']      = sum(cell_impedances)
-								BMS_STATUS['impedances']['agg_impedances']['sum']['text']       = "{:.1f}".format(BMS_STATUS['impedances']['agg_impedances']['sum']['value']) + "mOhm" 
-								BMS_STATUS['impedances']['agg_impedances']['max']['value']      = max(cell_impedances)
-								BMS_STATUS['impedances']['agg_impedances']['max']['text']       = "{:.1f}".format(BMS_STATUS['impedances']['agg_impedances']['max']['value']) + "mOhm" 
-								BMS_STATUS['impedances']['agg_impedances']['min']['value']      = min(cell_impedances)
-								BMS_STATUS['impedances']['agg_impedances']['min']['text']       = "{:.1f}".format(BMS_STATUS['impedances']['agg_impedances']['min']['value']) + "mOhm" 
-								BMS_STATUS['impedances']['agg_impedances']['diff']['value']     = BMS_STATUS['impedances']['agg_impedances']['max']['value'] - BMS_STATUS['impedances']['agg_impedances']['min']['value']
-								BMS_STATUS['impedances']['agg_impedances']['diff']['text']      = "{:.1f}".format(BMS_STATUS['impedances']['agg_impedances']['diff']['value']) + "mOhm"
-								BMS_STATUS['impedances']['agg_impedances']['average']['value']  = float("{:.3f}".format(sum(cell_impedances)/len(cell_impedances))) 
-								BMS_STATUS['impedances']['agg_impedances']['average']['text']   = "{:.1f}".format(BMS_STATUS['impedances']['agg_impedances']['average']['value']) + "mOhm" 
-
-								if args.victron:
-									dbusservice["/Impedances/Sum"]      = BMS_STATUS['impedances']['agg_impedances']['sum']['text']
-									dbusservice["/Raw/Impedances/Sum"]  = BMS_STATUS['impedances']['agg_impedances']['sum']['value']
-									dbusservice["/Impedances/Max"]      = BMS_STATUS['impedances']['agg_impedances']['max']['text']
-									dbusservice["/Raw/Impedances/Max"]  = BMS_STATUS['impedances']['agg_impedances']['max']['value']
-									dbusservice["/Impedances/Min"]      = BMS_STATUS['impedances']['agg_impedances']['min']['text']
-									dbusservice["/Raw/Impedances/Min"]  = BMS_STATUS['impedances']['agg_impedances']['min']['value']
-									dbusservice["/Impedances/Diff"]     = BMS_STATUS['impedances']['agg_impedances']['diff']['text']
-									dbusservice["/Raw/Impedances/Diff"] = BMS_STATUS['impedances']['agg_impedances']['diff']['value']
-									dbusservice["/Impedances/Avg"]      = BMS_STATUS['impedances']['agg_impedances']['average']['text']
-									dbusservice["/Raw/Impedances/Avg"]  = BMS_STATUS['impedances']['agg_impedances']['average']['value']
-
-
-								# update timestamp
-								current_date = datetime.datetime.now()
-								BMS_STATUS['impedances']['timestamp']['value'] = time.time()
-								BMS_STATUS['impedances']['timestamp']['text']  = current_date.strftime('%a %d.%m.%Y %H:%M:%S')
-								if args.victron:
-									dbusservice["/Impedances/UpdateTimestamp"] = BMS_STATUS['impedances']['timestamp']['text']
-									dbusservice["/Raw/Impedances/UpdateTimestamp"] = BMS_STATUS['impedances']['timestamp']['value']
-
-								logging.info("BMS Impedances " +
-									"][MODE1|" + BMS_STATUS['impedances']['current_mode1']['text'] +
-									"][CURRENT1|" + BMS_STATUS['impedances']['current1']['text'] +
-									"][SUM|"  + BMS_STATUS['impedances']['agg_impedances']['sum']['text'] +
-									"][#1|"   + BMS_STATUS['impedances']['cell1_impedance']['text'] +
-									"][#2|"   + BMS_STATUS['impedances']['cell2_impedance']['text'] +
-									"][#3|"   + BMS_STATUS['impedances']['cell3_impedance']['text'] +
-									"][#4|"   + BMS_STATUS['impedances']['cell4_impedance']['text'] +
-									"][#5|"   + BMS_STATUS['impedances']['cell5_impedance']['text'] +
-									"][#6|"   + BMS_STATUS['impedances']['cell6_impedance']['text'] +
-									"][#7|"   + BMS_STATUS['impedances']['cell7_impedance']['text'] +
-									"][#8|"   + BMS_STATUS['impedances']['cell8_impedance']['text'] +
-									"][#9|"   + BMS_STATUS['impedances']['cell9_impedance']['text'] +
-									"][#10|"  + BMS_STATUS['impedances']['cell10_impedance']['text'] +
-									"][#11|"  + BMS_STATUS['impedances']['cell11_impedance']['text'] +
-									"][#12|"  + BMS_STATUS['impedances']['cell12_impedance']['text'] +
-									"][#13|"  + BMS_STATUS['impedances']['cell13_impedance']['text'] +
-									"][#14|"  + BMS_STATUS['impedances']['cell14_impedance']['text'] +
-									"][#15|"  + BMS_STATUS['impedances']['cell15_impedance']['text'] +
-									"][#16|"  + BMS_STATUS['impedances']['cell16_impedance']['text'] +
-									"][#17|"  + BMS_STATUS['impedances']['cell17_impedance']['text'] +
-									"][#18|"  + BMS_STATUS['impedances']['cell18_impedance']['text'] +
-									"][#19|"  + BMS_STATUS['impedances']['cell19_impedance']['text'] +
-									"][#20|"  + BMS_STATUS['impedances']['cell20_impedance']['text'] +
-									"][#21|"  + BMS_STATUS['impedances']['cell21_impedance']['text'] +
-									"][#22|"  + BMS_STATUS['impedances']['cell22_impedance']['text'] +
-									"][#23|"  + BMS_STATUS['impedances']['cell23_impedance']['text'] +
-									"][#24|"  + BMS_STATUS['impedances']['cell24_impedance']['text'] + "]")
-
-							else:
-								logging.debug("Packet Checksum wrong, skip packet")
-
-							# strip packet
-							packet = packet[packet_length:]
-						
+							decoder(device, frame)
+						self.frames += 1
+						self.frame_counts[packet_type] += 1
+						self.frame_times[packet_type] = self.arrival
+						if (packet_type not in self.arrivals):
+							self.arrivals[packet_type] = self.arrival
+						cursor = packet_end
 					else:
-						# debug_packet(packet)
-						logging.debug("Packet Unknown [1]")
-						packet = ""
-				
-				else:
-					logging.debug("Packet Unknown [2]")
-					packet = ""
+						# the length byte may be corrupt as well, so only
+						# skip the header and resync. A header inside the
+						# frame means it was cut off by the next one.
+						if (packet.find(PACKET_HEADER_BYTES, cursor + 2, packet_end) != -1):
+							logging.debug("Packet truncated, skip packet")
+							self.truncated += 1
+						else:
+							logging.debug("Packet Checksum wrong, skip packet")
+							self.checksum_errors += 1
+						self.drop(1)
+						cursor += 1
+
+		return cursor
+
+
+
+# Rolling window of the latest latencies of one packet type, the
+# percentiles are only computed when they are published or dumped
+class LatencyHistogram(object):
+
+	def __init__(self, size=LATENCY_SAMPLES):
+		self.samples = array.array('d', [0.0] * size)
+		self.count   = 0
+		self.index   = 0
+
+	def add(self, latency):
+		self.samples[self.index] = latency
+		self.index += 1
+		if (self.index == len(self.samples)):
+			self.index = 0
+		if (self.count < len(self.samples)):
+			self.count += 1
+
+	def percentiles(self, ranks):
+		if (self.count == 0):
+			return [-1] * len(ranks)
+		window = sorted(self.samples[:self.count])
+		return [window[max(int(math.ceil((rank / 100.0) * self.count)) - 1, 0)] for rank in ranks]
+
+
+# End-to-end latency per packet type, from the serial read that completed
+# a frame until its values were published on D-Bus (or decoded without
+# --victron). With polling the time the data waited in the serial buffer
+# before the read is not included.
+class LatencyTracker(object):
+
+	def __init__(self, framer, label=""):
+		self.framer     = framer
+		self.label      = label
+		self.histograms = dict((packet_type, LatencyHistogram()) for packet_type in PACKET_NAMES)
+
+	def published(self, now):
+		arrivals = self.framer.arrivals
+		if (len(arrivals) == 0):
+			return
+		for (packet_type, arrival) in arrivals.items():
+			if (packet_type in self.histograms):
+				self.histograms[packet_type].add(now - arrival)
+		arrivals.clear()
+
+	def dump(self):
+		for (packet_type, name) in sorted(PACKET_NAMES.items()):
+			histogram = self.histograms[packet_type]
+			logging.info(self.label + "Latency [" + name.upper() + "|" + str(histogram.count) + " frames]" +
+				"".join(["[P" + str(rank) + "|" + "{:.2f}".format(value * 1000) + "ms]"
+					for (rank, value) in zip(LATENCY_PERCENTILES, histogram.percentiles(LATENCY_PERCENTILES))]))
+
+
+
+# Wall clock time spent per processing stage. The timers are switched on
+# and off at runtime with SIGUSR2 or /Diagnostics/StageTimers, while they
+# are off the hot path only checks the enabled flag.
+class StageTimers(object):
+
+	def __init__(self):
+		self.enabled = False
+		self.reset()
+
+	def reset(self):
+		self.totals = array.array('d', [0.0] * len(STAGE_NAMES))
+		self.counts = array.array('L', [0] * len(STAGE_NAMES))
+
+	def enable(self, enabled):
+		if (enabled == self.enabled):
+			return
+		if enabled:
+			self.reset()
+		else:
+			self.dump()
+		self.enabled = enabled
+		logging.info("Stage timers " + ("enabled" if enabled else "disabled"))
+
+	def call(self, stage, function, *arguments):
+		started = time.perf_counter()
+		result = function(*arguments)
+		self.totals[stage] += time.perf_counter() - started
+		self.counts[stage] += 1
+		return result
+
+	# microseconds per call of every stage. The stages are nested, framing
+	# contains decode and decode contains aggregate, the nested time is
+	# subtracted so every stage only counts its own work
+	def averages(self):
+		own = list(self.totals)
+		own[STAGE_FRAMING] -= self.totals[STAGE_DECODE]
+		own[STAGE_DECODE]  -= self.totals[STAGE_AGGREGATE]
+		return [((own[stage] * 1000000) / self.counts[stage]) if (self.counts[stage] > 0) else -1
+			for stage in range(len(STAGE_NAMES))]
+
+	def dump(self):
+		logging.info("Stage timers " + "".join(["[" + name.upper() + "|" + "{:.1f}".format(average) + "us x " + str(count) + "]"
+			for (name, average, count) in zip(STAGE_NAMES, self.averages(), self.counts)]))
+
+
+stage_timers = StageTimers()
+
+
+def dump_latency(signum, frame):
+	for device in devices:
+		device.latency.dump()
+	if stage_timers.enabled:
+		stage_timers.dump()
+
+	if (args.history_dump is not None):
+		for device in devices:
+			filename = (args.history_dump + "." + os.path.basename(device.name)) if (len(devices) > 1) else args.history_dump
+			logging.info(device.label + "History to " + filename)
+			device.history.dump(filename)
+
+
+def toggle_stage_timers(signum, frame):
+	stage_timers.enable(not stage_timers.enabled)
+
+
+# kill -TERM (daemontools restart, shutdown) writes the rows of the
+# history files that are still in memory before the driver ends
+def stop_driver(signum, frame):
+	logging.info("Stopping on signal " + str(signum))
+	for device in devices:
+		device.close()
+	if (mainloop is not None):
+		mainloop.quit()
+	else:
+		sys.exit(0)
+
+
+def handle_stage_timers_change(path, value):
+	stage_timers.enable(bool(value))
+	return True
+
+
+# Runs the driver under cProfile. Every interval the stats are written to
+# FILE and a new profile is started, the previous files are kept as
+# FILE.1 up to FILE.<PROFILE_FILES-1>.
+class ProfileWriter(object):
+
+	def __init__(self, filename, interval):
+		self.filename   = filename
+		self.interval   = interval
+		self.next_write = time.monotonic() + interval
+		self.profile    = cProfile.Profile()
+		self.profile.enable()
+
+	def write(self):
+		self.profile.disable()
+		for i in range(PROFILE_FILES - 1, 0, -1):
+			older = self.filename if (i == 1) else (self.filename + "." + str(i - 1))
+			if os.path.exists(older):
+				os.rename(older, self.filename + "." + str(i))
+		self.profile.dump_stats(self.filename)
+		logging.info("Profile stats written to " + self.filename)
+
+		self.next_write = time.monotonic() + self.interval
+		self.profile    = cProfile.Profile()
+		self.profile.enable()
+
+		# keep the GLib timeout running
+		return True
+
+	def check(self):
+		if (time.monotonic() >= self.next_write):
+			self.write()
+
+
+# Publisher stage of one BMS. The decoders only collect the updates in the
+# DbusPublisher, they are sent to D-Bus from a GLib idle callback, which
+# runs once no serial event is pending. A busy D-Bus so never delays
+# draining the serial port. The DbusPublisher keeps only the latest value
+# of every path, the queue therefore holds at most one snapshot per packet
+# type: a frame whose type is still queued replaces the older snapshot,
+# which is counted as dropped. Updates without a frame (diagnostics,
+# stale packet types, a lost port) are sent the same way.
+class PublishQueue(object):
+
+	def __init__(self, device):
+		self.device     = device
+		self.scheduled  = False
+		self.frames     = 0
+		self.high_water = 0
+		self.dropped    = 0
+
+	# the framer keeps the arrival of every decoded, unpublished packet type
+	def depth(self):
+		return len(self.device.framer.arrivals)
+
+	def schedule(self):
+		depth = self.depth()
+		if (depth > self.high_water):
+			self.high_water = depth
+		if (((depth > 0) or self.device.publisher.has_pending()) and (not self.scheduled)):
+			self.scheduled = True
+			gobject.idle_add(self.run)
+
+	def run(self):
+		self.scheduled = False
+		self.publish()
+
+		# one shot, the next decoded frame schedules it again
+		return False
+
+	def publish(self):
+		device = self.device
+		framer = device.framer
+
+		# all frames beyond one per packet type were replaced unpublished
+		self.dropped += (framer.frames - self.frames) - len(framer.arrivals)
+		self.frames   = framer.frames
+
+		if args.victron:
+			if stage_timers.enabled:
+				stage_timers.call(STAGE_PUBLISH, device.publisher.flush)
 			else:
-				logging.debug("Packet too short, skip")
-				packet = ""
+				device.publisher.flush()
+			if (aggregator is not None):
+				aggregator.publisher.flush()
+		device.latency.published(time.monotonic())
+
+
+# Link health of the driver. The framer and the serial read only update
+# integer counters, the rates are derived from them when the diagnostics
+# are published every DIAGNOSTICS_INTERVAL seconds.
+class Diagnostics(object):
+
+	def __init__(self, framer, latency, queue, label=""):
+		self.framer            = framer
+		self.latency           = latency
+		self.queue             = queue
+		self.label             = label
+		self.serial_high_water = 0
+		self.last_update       = time.monotonic()
+		self.last_bytes        = framer.bytes_received
+		self.last_frames       = dict(framer.frame_counts)
+
+	def update(self, now, publisher):
+		elapsed = max(now - self.last_update, 0.000001)
+
+		bytes_per_second = (self.framer.bytes_received - self.last_bytes) / elapsed
+		frames_per_second = {}
+		for (packet_type, frame_count) in self.framer.frame_counts.items():
+			frames_per_second[packet_type] = (frame_count - self.last_frames[packet_type]) / elapsed
+
+		self.last_update = now
+		self.last_bytes  = self.framer.bytes_received
+		self.last_frames = dict(self.framer.frame_counts)
 
+		if args.victron:
+			publisher["/Diagnostics/BytesPerSecond"]        = round(bytes_per_second, 1)
+			publisher["/Diagnostics/BytesReceived"]         = self.framer.bytes_received
+			publisher["/Diagnostics/BytesDropped"]          = self.framer.bytes_dropped
+			publisher["/Diagnostics/Resyncs"]               = self.framer.resyncs
+			publisher["/Diagnostics/ChecksumErrors"]        = self.framer.checksum_errors
+			publisher["/Diagnostics/TruncatedFrames"]       = self.framer.truncated
+			publisher["/Diagnostics/SerialBufferHighWater"] = self.serial_high_water
+			publisher["/Diagnostics/PublishQueue/Depth"]     = self.queue.depth()
+			publisher["/Diagnostics/PublishQueue/HighWater"] = self.queue.high_water
+			publisher["/Diagnostics/PublishQueue/Dropped"]   = self.queue.dropped
+			for (packet_type, name) in PACKET_NAMES.items():
+				publisher["/Diagnostics/Frames/" + name]          = self.framer.frame_counts[packet_type]
+				publisher["/Diagnostics/FramesPerSecond/" + name] = round(frames_per_second[packet_type], 2)
+
+				# latency percentiles in ms
+				histogram = self.latency.histograms[packet_type]
+				for (rank, value) in zip(LATENCY_PERCENTILES, histogram.percentiles(LATENCY_PERCENTILES)):
+					publisher["/Diagnostics/Latency/" + name + "/P" + str(rank)] = round(value * 1000, 2) if (value >= 0) else -1
+
+			publisher["/Diagnostics/StageTimers"] = 1 if stage_timers.enabled else 0
+			if stage_timers.enabled:
+				for (name, average) in zip(STAGE_NAMES, stage_timers.averages()):
+					publisher["/Diagnostics/Stages/" + name] = round(average, 1)
+
+		logging.debug("%sDiagnostics [%.0f bytes/s][%d frames][RESYNCS|%d][CHECKSUM ERRORS|%d][TRUNCATED|%d][DROPPED|%d bytes][HIGH WATER|%d bytes][DROPPED SNAPSHOTS|%d]",
+			self.label, bytes_per_second, self.framer.frames, self.framer.resyncs, self.framer.checksum_errors,
+			self.framer.truncated, self.framer.bytes_dropped, self.serial_high_water, self.queue.dropped)
+
+
+# Backoff and statistics of the reconnects of one serial port, times are
+# monotonic. due is the time of the next attempt.
+class SerialReconnect(object):
+
+	def __init__(self):
+		self.delay        = RECONNECT_DELAY
+		self.attempts     = 0
+		self.lost_at      = -1
+		self.due          = 0
+		self.count        = 0
+		self.recover_time = -1
+
+	def lost(self, now):
+		self.lost_at  = now
+		self.delay    = RECONNECT_DELAY
+		self.attempts = 0
+		self.due      = now + self.delay
+
+	def failed(self, now):
+		self.attempts += 1
+		self.delay = min(self.delay * 2, RECONNECT_DELAY_MAX)
+		self.due   = now + self.delay
+
+	def recovered(self, now):
+		self.attempts    += 1
+		self.count       += 1
+		self.recover_time = now - self.lost_at
+
+
+# Staleness of the values per packet type. Every tick compares the serial
+# read time of the last frame per packet type, which the framer keeps in
+# frame_times, with the deadline, so a tick costs the same for any number
+# of cells. Before the first frame the deadline counts from the start. A
+# packet type without a frame for deadline seconds is stale: its values
+# are reset and its paths set to -1 once, /Alarms/BmsCable is raised and
+# /Connected is 0 while all packet types are stale. The next frame clears
+# it again.
+class StaleWatchdog(object):
+
+	def __init__(self, device, deadline):
+		self.device      = device
+		self.deadline    = deadline
+		self.started     = time.monotonic()
+		self.last        = dict.fromkeys(PACKET_NAMES, self.started)
+		self.stale       = dict.fromkeys(PACKET_NAMES, False)
+		self.stale_count = 0
+
+	def silent(self):
+		return (self.stale_count == len(self.stale))
+
+	def check(self, now):
+		device      = self.device
+		frame_times = device.framer.frame_times
+
+		for (packet_type, name) in PACKET_NAMES.items():
+			last = max(frame_times[packet_type], self.started)
+			if self.stale[packet_type]:
+				# last is the frame before the packet type went stale
+				if (last > self.last[packet_type]):
+					self.stale[packet_type] = False
+					self.stale_count -= 1
+					logging.info(device.label + "Fresh [" + name.upper() + "] after " + "{:.0f}".format(last - self.last[packet_type]) + "s")
+			elif ((now - last) >= self.deadline):
+				self.last[packet_type]  = last
+				self.stale[packet_type] = True
+				self.stale_count += 1
+				logging.info(device.label + "Stale [" + name.upper() + "] no frame for " + "{:.0f}".format(now - last) + "s")
+				self.invalidate(packet_type)
 
+		if args.victron:
+			publisher = device.publisher
+			for (packet_type, name) in PACKET_NAMES.items():
+				publisher["/Diagnostics/Stale/" + name] = 1 if self.stale[packet_type] else 0
+			publisher["/Alarms/BmsCable"] = 2 if (self.stale_count > 0) else 0
+			publisher["/Connected"]       = device_connected(device)
+			device.queue.schedule()
+
+	def invalidate(self, packet_type):
+		device = self.device
+		STATE_RESETS[packet_type](device.state)
+
+		# the aggregate leaves the values of this pack out until its next frame
+		if (device.aggregator is not None):
+			if (packet_type == PACKET_STATUS_CELLS):
+				device.aggregator.add_status_cells(device)
+			elif (packet_type == PACKET_STATUS_BMS):
+				device.aggregator.remove_status_bms(device)
 
-def handle_serial_data():
+		if args.victron:
+			publisher = device.publisher
+			for path in PACKET_PATHS[packet_type]:
+				publisher[path] = -1
+			for cell_paths in PACKET_CELL_PATHS[packet_type]:
+				for path in cell_paths[:device.cell_paths]:
+					publisher[path] = -1
+
+
+# Everything that belongs to one BMS: the serial port, the decoded state,
+# the framer with its latencies and diagnostics, the D-Bus service and the
+# optional log digest, history and history files. Several devices share
+# the main loop and the stage timers, every one has its publisher stage.
+# The label prefixes the log lines
+# if more than one BMS is driven.
+class BmsDevice(object):
+
+	def __init__(self, name, number=0, state=None, label=""):
+		self.name        = name
+		self.number      = number
+		self.label       = label
+		self.connection  = driver['connection'][:-2] + "{:02d}".format(number + 1)
+		self.instance    = driver['instance'] + number
+		self.state       = BmsState() if (state is None) else state
+		self.framer      = PacketFramer(self)
+		self.latency     = LatencyTracker(self.framer, label)
+		self.queue       = PublishQueue(self)
+		self.diagnostics = Diagnostics(self.framer, self.latency, self.queue, label)
+		self.serial_port = None
+		self.reconnect   = SerialReconnect()
+		self.dbusservice = None
+		self.publisher   = None
+		self.recorder    = None
+		self.log_digest  = None
+		self.history     = None
+		self.store       = None
+		self.aggregator  = None
+		self.watchdog    = None
+		self.cell_paths  = 0
+
+	def close(self):
+		if (self.serial_port is not None):
+			self.serial_port.close()
+			self.serial_port = None
+		if (self.recorder is not None):
+			self.recorder.close()
+			self.recorder = None
+		if (self.store is not None):
+			self.store.close()
+			self.store = None
+
+
+# the first BMS decodes into bms_state, which BMS_STATUS shows
+bms_device = BmsDevice(None, 0, bms_state)
+devices    = [bms_device]
+
+
+# One battery made of parallel packs, every BMS is one pack. A status or
+# cells frame only updates the values of its pack and the combined values
+# are derived from the per pack values, the other packs are only rescanned
+# if the pack with the lowest or highest cell moved away from it.
+class PackAggregator(object):
+
+	def __init__(self, devices):
+		self.devices   = devices
+		self.publisher = None
+		pack_count = len(devices)
+		self.currents          = array.array('d', [0.0] * pack_count)
+		self.socs              = array.array('d', [-1.0] * pack_count)
+		self.capacities        = array.array('d', [0.0] * pack_count)
+		self.cell_minimums     = array.array('d', [-1.0] * pack_count)
+		self.cell_maximums     = array.array('d', [-1.0] * pack_count)
+		self.minimum_cells     = [-1] * pack_count
+		self.maximum_cells     = [-1] * pack_count
+		self.charge_relays     = [-1] * pack_count
+		self.discharge_relays  = [-1] * pack_count
+		self.current           = 0.0
+		self.soc               = -1
+		self.cell_minimum      = -1
+		self.cell_maximum      = -1
+		self.minimum_pack      = -1
+		self.maximum_pack      = -1
+		self.charge_relay      = -1
+		self.discharge_relay   = -1
+		for device in devices:
+			device.aggregator = self
+
+	def add_status_bms(self, device):
+		pack  = device.number
+		state = device.state
+
+		self.current += state.current - self.currents[pack]
+		self.currents[pack] = state.current
+		self.socs[pack]     = state.soc
+		self.update_capacity(pack, state)
+		self.charge_relays[pack]    = state.charge_relay_status
+		self.discharge_relays[pack] = state.discharge_relay_status
+		self.charge_relay    = self.worst_relay(self.charge_relays)
+		self.discharge_relay = self.worst_relay(self.discharge_relays)
+		self.publish_status()
+
+	# The status of a pack whose status frames stopped: its current leaves
+	# the sum, its SOC and relays become unknown, so /Io/AllowToCharge and
+	# /Io/AllowToDischarge are 0 until its next status frame
+	def remove_status_bms(self, device):
+		pack = device.number
+
+		self.current -= self.currents[pack]
+		self.currents[pack] = 0.0
+		self.socs[pack]     = -1
+		self.update_capacity(pack, device.state)
+		self.charge_relays[pack]    = -1
+		self.discharge_relays[pack] = -1
+		self.charge_relay    = self.worst_relay(self.charge_relays)
+		self.discharge_relay = self.worst_relay(self.discharge_relays)
+		self.publish_status()
+
+	# A pack without valid cell voltages (no cells frame yet or reset by
+	# the watchdog) keeps -1 and is left out of the minimum and maximum
+	def add_status_cells(self, device):
+		pack  = device.number
+		state = device.state
+		valid = ((state.voltages_min >= 0) and (state.voltages_max >= 0))
+
+		self.update_capacity(pack, state)
+		self.cell_minimums[pack] = state.voltages_min if valid else -1
+		self.cell_maximums[pack] = state.voltages_max if valid else -1
+		self.minimum_cells[pack] = state.voltages_min_index
+		self.maximum_cells[pack] = state.voltages_max_index
+
+		if (valid and ((self.minimum_pack == -1) or (state.voltages_min <= self.cell_minimum))):
+			self.minimum_pack = pack
+			self.cell_minimum = state.voltages_min
+		elif (self.minimum_pack == pack):
+			packs = self.packs_with_cells()
+			self.minimum_pack = min(packs, key=self.cell_minimums.__getitem__) if (len(packs) > 0) else -1
+			self.cell_minimum = self.cell_minimums[self.minimum_pack] if (len(packs) > 0) else -1
+
+		if (valid and ((self.maximum_pack == -1) or (state.voltages_max >= self.cell_maximum))):
+			self.maximum_pack = pack
+			self.cell_maximum = state.voltages_max
+		elif (self.maximum_pack == pack):
+			packs = self.packs_with_cells()
+			self.maximum_pack = max(packs, key=self.cell_maximums.__getitem__) if (len(packs) > 0) else -1
+			self.cell_maximum = self.cell_maximums[self.maximum_pack] if (len(packs) > 0) else -1
+
+		self.publish_cells()
+
+	def packs_with_cells(self):
+		return [pack for pack in range(len(self.devices)) if (self.cell_minimums[pack] != -1)]
+
+	# The SOC of the packs is weighted by their full capacity, derived from
+	# the remaining capacity and the SOC. Packs without a known capacity
+	# count with the average one.
+	def update_capacity(self, pack, state):
+		if ((state.soc > 0) and (state.battery_capacity_ah > 0)):
+			self.capacities[pack] = state.battery_capacity_ah * 100.0 / state.soc
+
+		weights = 0.0
+		total   = 0.0
+		known   = [capacity for capacity in self.capacities if (capacity > 0)]
+		default = (sum(known) / len(known)) if (len(known) > 0) else 1.0
+		for (soc, capacity) in zip(self.socs, self.capacities):
+			if (soc >= 0):
+				weight   = capacity if (capacity > 0) else default
+				weights += weight
+				total   += soc * weight
+		self.soc = round(total / weights, 1) if (weights > 0) else -1
+
+	# a relay that is off in one pack is off for the battery
+	def worst_relay(self, relays):
+		if (0x01 in relays):
+			return 0x01
+		elif (-1 in relays):
+			return -1
+		return 0x00
+
+	def publish_status(self):
+		logging.debug("Aggregate [CURRENT|%.1fA][SOC|%.1f%%][CHARGE RELAY|%d][DISCHARGE RELAY|%d]",
+			self.current, self.soc, self.charge_relay, self.discharge_relay)
+		if (self.publisher is None):
+			return
+
+		publisher = self.publisher
+		current   = round(self.current, 1)
+		publisher.set_text("/Info/Current",     text_current, 0x01 if (current >= 0) else 0x00, abs(current))
+		publisher.set_text("/Info/Soc",         text_soc, self.soc)
+		publisher["/Info/ChargeRelayStatus"]    = RELAY_STATUS_TEXT.get(self.charge_relay, "")
+		publisher["/Info/DischargeRelayStatus"] = RELAY_STATUS_TEXT.get(self.discharge_relay, "")
+		publisher["/Raw/Info/Current"]              = current
+		publisher["/Raw/Info/Soc"]                  = self.soc
+		publisher["/Raw/Info/ChargeRelayStatus"]    = self.charge_relay
+		publisher["/Raw/Info/DischargeRelayStatus"] = self.discharge_relay
+		publisher["/Dc/0/Current"]       = current
+		publisher["/Soc"]                = self.soc
+		publisher["/Io/AllowToCharge"]    = 1 if (self.charge_relay == 0x00) else 0
+		publisher["/Io/AllowToDischarge"] = 1 if (self.discharge_relay == 0x00) else 0
+
+	# pack and cell of a pack, counting from 1 like on D-Bus, -1 without a
+	# pack with valid cells
+	def cell_position(self, pack, cells):
+		if (pack == -1):
+			return (-1, -1)
+		return (pack + 1, cells[pack] + 1)
+
+	def publish_cells(self):
+		(minimum_pack, minimum_cell) = self.cell_position(self.minimum_pack, self.minimum_cells)
+		(maximum_pack, maximum_cell) = self.cell_position(self.maximum_pack, self.maximum_cells)
+		logging.debug("Aggregate [CELL MIN|%.3fV PACK %d CELL %d][CELL MAX|%.3fV PACK %d CELL %d]",
+			self.cell_minimum, minimum_pack, minimum_cell, self.cell_maximum, maximum_pack, maximum_cell)
+		if (self.publisher is None):
+			return
+
+		publisher = self.publisher
+		publisher.set_text("/Voltages/Min", text_cell_voltage, self.cell_minimum)
+		publisher.set_text("/Voltages/Max", text_cell_voltage, self.cell_maximum)
+		publisher["/Voltages/MinPack"]    = minimum_pack
+		publisher["/Voltages/MinCell"]    = minimum_cell
+		publisher["/Voltages/MaxPack"]    = maximum_pack
+		publisher["/Voltages/MaxCell"]    = maximum_cell
+		publisher["/Raw/Voltages/Min"]    = self.cell_minimum
+		publisher["/Raw/Voltages/Max"]    = self.cell_maximum
+		publisher["/System/MinCellVoltage"]    = self.cell_minimum
+		publisher["/System/MaxCellVoltage"]    = self.cell_maximum
+		publisher["/System/MinVoltageCellId"]  = ("P" + str(minimum_pack) + "C" + str(minimum_cell)) if (minimum_pack != -1) else ""
+		publisher["/System/MaxVoltageCellId"]  = ("P" + str(maximum_pack) + "C" + str(maximum_cell)) if (maximum_pack != -1) else ""
+
+
+aggregator = None
+mainloop   = None
+
+
+def check_watchdogs():
+	now = time.monotonic()
+	for device in devices:
+		device.watchdog.check(now)
+
+	# keep the GLib timeout running
+	return True
+
+
+def write_log_digests():
+	now = time.time()
+	for device in devices:
+		device.log_digest.write(now)
+
+	# keep the GLib timeout running
+	return True
+
+
+def publish_diagnostics():
+	now = time.monotonic()
+	for device in devices:
+		device.diagnostics.update(now, device.publisher)
+		device.queue.schedule()
+
+	# keep the GLib timeout running
+	return True
+
+
+class CaptureRecorder(object):
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.capture  = open(filename, 'ab')
+		if (self.capture.tell() == 0):
+			self.capture.write(CAPTURE_MAGIC)
+
+	# a failed write stops the recording with one warning, the serial
+	# data is still decoded
+	def write(self, data):
+		if (self.capture is None):
+			return
+		try:
+			self.capture.write(CAPTURE_RECORD.pack(time.time(), len(data)))
+			self.capture.write(data)
+			self.capture.flush()
+		except OSError as e:
+			logging.warning("Record to " + self.filename + " stopped: " + str(e))
+			self.close()
+
+	def close(self):
+		if (self.capture is None):
+			return
+		try:
+			self.capture.close()
+		except OSError:
+			pass
+		self.capture = None
+
+
+def read_capture(filename):
+	with open(filename, 'rb') as capture:
+		if (capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC):
+			raise ValueError("No capture file: " + filename)
+
+		while True:
+			record = capture.read(CAPTURE_RECORD.size)
+			if (len(record) < CAPTURE_RECORD.size):
+				break
+			(timestamp, data_length) = CAPTURE_RECORD.unpack(record)
+			data = capture.read(data_length)
+			if (len(data) < data_length):
+				logging.info("Capture file truncated")
+				break
+			yield (timestamp, data)
+
+
+# Feeds recorded serial chunks through the framer and the decoders. The
+# delays between the chunks are kept, divided by speed. Without speed
+# the chunks are fed as fast as possible.
+def replay_chunks(device, chunks, speed=None):
+	framer        = device.framer
+	frames_before = framer.frames
+	byte_count    = 0
+	first_timestamp = None
+	replay_start  = time.time()
+
+	for (timestamp, data) in chunks:
+		if (speed is not None):
+			if (first_timestamp is None):
+				first_timestamp = timestamp
+			delay = ((timestamp - first_timestamp) / speed) - (time.time() - replay_start)
+			if (delay > 0):
+				time.sleep(delay)
+
+		framer.feed(data)
+		device.queue.publish()
+		byte_count += len(data)
+		if (device.log_digest is not None):
+			device.log_digest.check(time.time())
+
+	elapsed = time.time() - replay_start
+	frame_count = framer.frames - frames_before
+	logging.info("Replay [BYTES|" + str(byte_count) + "][FRAMES|" + str(frame_count) +
+		"][CHECKSUM ERRORS|" + str(framer.checksum_errors) + "][TRUNCATED|" + str(framer.truncated) + "][DROPPED|" + str(framer.bytes_dropped) + " bytes]" +
+		"[TIME|" + "{:.3f}".format(elapsed) + "s][RATE|" + "{:.0f}".format(frame_count / max(elapsed, 0.000001)) + " frames/s]")
+
+	return frame_count
+
+
+# Replays the stored example packets in small chunks, so frames are
+# also completed across reads
+def test_packets(device):
+	stream = bytearray()
+	for packet in TEST_PACKETS:
+		stream += bytearray.fromhex(packet)
+
+	chunks = [(0, stream[i:i+7]) for i in range(0, len(stream), 7)]
+	frame_count = replay_chunks(device, chunks)
+
+	if (frame_count == len(TEST_PACKETS)):
+		logging.info("Test passed [" + str(frame_count) + " of " + str(len(TEST_PACKETS)) + " packets decoded]")
+		return True
+	else:
+		logging.info("Test failed [" + str(frame_count) + " of " + str(len(TEST_PACKETS)) + " packets decoded]")
+		return False
+
+
+# Reads the serial port into view without a temporary object, returns
+# the number of bytes read. pyserial's readinto() reads a new bytes
+# object and copies it, so on POSIX the fd of the port is read directly.
+def read_serial(serial_port, view):
+	if (hasattr(serial_port, 'fd') and hasattr(os, 'readv')):
+		return os.readv(serial_port.fd, [view])
+	return serial_port.readinto(view)
+
+
+def handle_serial_data(device):
+	serial_port = device.serial_port
+	framer      = device.framer
 	try:
-		serial_packet = bytearray()
-
-		if (serial_port.in_waiting > 0):
-			logging.debug("Data Waiting [" + str(serial_port.in_waiting) + " bytes]")
-
-		if (serial_port.in_waiting >= (PACKET_LENGTH_MINIMUM * 2)):
-			data_buffer_array = serial_port.read(serial_port.in_waiting)
-			logging.debug("Data Received [" + str(len(data_buffer_array)) + " bytes]")
-			for data_buffer in data_buffer_array:
-				serial_packet.append(data_buffer)
-				
-			if (len(serial_packet) > 0):
-				parse_packet(serial_packet)
-				
-			data_buffer_array = bytearray()
-			serial_packet = bytearray()
-
-		if args.victron:	
-			# recheck every second
-			gobject.timeout_add(1000, handle_serial_data)
-		
+		try:
+			bytes_waiting = serial_port.in_waiting
+		except (OSError, serial.SerialException) as e:
+			return serial_port_failed(device, e)
+
+		if (bytes_waiting > 0):
+			if (bytes_waiting > device.diagnostics.serial_high_water):
+				device.diagnostics.serial_high_water = bytes_waiting
+
+			# more than the free part of the receive buffer is read in parts
+			while (bytes_waiting > 0):
+				receive_view = framer.receive_view(bytes_waiting)
+				try:
+					if stage_timers.enabled:
+						byte_count = stage_timers.call(STAGE_READ, read_serial, serial_port, receive_view)
+					else:
+						byte_count = read_serial(serial_port, receive_view)
+				except (OSError, serial.SerialException) as e:
+					return serial_port_failed(device, e)
+				arrival = time.monotonic()
+				logging.debug("%sData Received [%d bytes]", device.label, byte_count)
+				if (byte_count == 0):
+					break
+				bytes_waiting -= byte_count
+
+				if (device.recorder is not None):
+					device.recorder.write(receive_view[:byte_count])
+
+				if stage_timers.enabled:
+					stage_timers.call(STAGE_FRAMING, framer.received, byte_count, arrival)
+				else:
+					framer.received(byte_count, arrival)
+
+			# with the main loop the values are published once the
+			# pending serial events are handled
+			if args.victron:
+				device.queue.schedule()
+			else:
+				device.queue.publish()
 
 	except KeyboardInterrupt:
 		if not args.victron:
@@ -1667,18 +2456,464 @@ def handle_serial_data():
 		print(e);
 		print(traceback.format_exc())
 
+		# the reconnect adds a new GLib timeout or io watch
+		lose_serial_port(device)
+		return False
+
+	# keep the GLib timeout or io watch running
+	return True
+
+
+# the expected hangup of a port that went away, eg EIO of a USB adapter,
+# only the reads of the port end up here
+def serial_port_failed(device, e):
+	logging.warning(device.label + "Serial port " + device.name + " failed: " + str(e))
+	lose_serial_port(device)
+	return False
+
+
+def handle_serial_event(fd, condition, device):
+	return handle_serial_data(device)
+
+
+def watch_serial_port(device):
+	if args.event_driven:
+		# wake up on every serial arrival, the framer completes
+		# partial frames with the following reads
+		gobject.io_add_watch(device.serial_port.fileno(), gobject.PRIORITY_DEFAULT, gobject.IO_IN | gobject.IO_ERR | gobject.IO_HUP, handle_serial_event, device)
+	else:
+		# recheck every second
+		gobject.timeout_add(1000, handle_serial_data, device)
+
+
+# /Connected is 0 while the serial port is lost or no packet type is fresh
+def device_connected(device):
+	if (device.serial_port is None):
+		return 0
+	if ((device.watchdog is not None) and device.watchdog.silent()):
+		return 0
+	return 1
+
+
+# Closes a failed serial port and reopens it later, the D-Bus service
+# stays registered with /Connected 0 until the port is back
+def lose_serial_port(device):
+	reconnect = device.reconnect
+	reconnect.lost(time.monotonic())
+	logging.info(device.label + "Serial port " + device.name + " lost, reconnect in " + str(reconnect.delay) + "s")
+
+	try:
+		device.serial_port.close()
+	except Exception:
+		pass
+	device.serial_port = None
+	device.framer.discard()
+
+	if args.victron:
+		device.publisher["/Connected"] = 0
+		device.queue.schedule()
+		gobject.timeout_add(reconnect.delay * 1000, reconnect_serial_port, device)
+
+
+def reconnect_serial_port(device):
+	reconnect = device.reconnect
+	now = time.monotonic()
+	if not open_serial_port(device):
+		reconnect.failed(now)
+		logging.info(device.label + "Reconnect failed [ATTEMPTS|" + str(reconnect.attempts) + "], next in " + str(reconnect.delay) + "s")
+		if args.victron:
+			gobject.timeout_add(reconnect.delay * 1000, reconnect_serial_port, device)
+		return False
+
+	reconnect.recovered(now)
+	logging.info(device.label + "Serial port reconnected [RECONNECTS|" + str(reconnect.count) + "][ATTEMPTS|" + str(reconnect.attempts) +
+		"][RECOVERED|" + "{:.1f}".format(reconnect.recover_time) + "s]")
+
+	if args.victron:
+		device.publisher["/Connected"]                    = device_connected(device)
+		device.publisher["/Diagnostics/Reconnects"]       = reconnect.count
+		device.publisher["/Diagnostics/ReconnectSeconds"] = round(reconnect.recover_time, 1)
+		device.queue.schedule()
+		watch_serial_port(device)
+
+	# one shot, a failed attempt added the next timeout
+	return False
+
+
+# Listens on all candidate ports at once for frames with a valid checksum,
+# every port has its own framer that only counts the frames. The probe
+# ends once count ports sent a frame or after timeout seconds. Returns
+# the ports with Chargery frames in the order of their first frame.
+def probe_serial_ports(names, count, timeout):
+	decoders = dict((packet_type, lambda device, frame: None) for packet_type in PACKET_DECODERS)
+	started  = time.monotonic()
+
+	probes = []
+	for name in names:
+		try:
+			port = serial.Serial(name, 115200, timeout=0)
+			port.flushInput()
+		except Exception as e:
+			logging.info("Probe [" + name + "] open failed: " + str(e))
+			continue
+		probes.append((port, PacketFramer(decoders=decoders)))
+
+	found     = []
+	listening = dict(probes)
+	while ((len(found) < count) and (len(listening) > 0)):
+		remaining = started + timeout - time.monotonic()
+		if (remaining <= 0):
+			break
+
+		(readable, writable, errors) = select.select(list(listening), [], [], remaining)
+		for port in readable:
+			framer = listening[port]
+			try:
+				bytes_waiting = port.in_waiting
+				byte_count = read_serial(port, framer.receive_view(bytes_waiting)) if (bytes_waiting > 0) else 0
+			except Exception as e:
+				logging.info("Probe [" + port.name + "] read failed: " + str(e))
+				byte_count = 0
+
+			# readable without data, the port was closed or failed
+			if (byte_count == 0):
+				del listening[port]
+				continue
+
+			framer.received(byte_count)
+			if (framer.frames > 0):
+				found.append(port.name)
+				del listening[port]
+				logging.info("Probe [" + port.name + "] Chargery frame after " + "{:.3f}".format(time.monotonic() - started) + "s")
+
+	for (port, framer) in probes:
+		logging.info("Probe [" + port.name + "][" + ("CHARGERY" if (framer.frames > 0) else "NO FRAMES") + "][FRAMES|" + str(framer.frames) +
+			"][CHECKSUM ERRORS|" + str(framer.checksum_errors) + "][BYTES|" + str(framer.bytes_received) + "]")
+		port.close()
+
+	logging.info("Probe of " + str(len(probes)) + " ports in " + "{:.3f}".format(time.monotonic() - started) + "s, found " +
+		(", ".join(found) if found else "none"))
+	return found
+
+
+# Several services in one process need a private bus connection each, as
+# they export the same paths
+def service_bus(private):
+	if not private:
+		return None
+	import dbus
+	return dbus.SessionBus(private=True) if ('DBUS_SESSION_BUS_ADDRESS' in os.environ) else dbus.SystemBus(private=True)
+
+
+# Registers the D-Bus service of one BMS
+def create_service(device, private):
+	from vedbus import VeDbusService
+
+	dbusservice = VeDbusService(device.connection, service_bus(private))
+	device.dbusservice = dbusservice
+	device.publisher   = DbusPublisher(dbusservice)
+
+	# Create the management objects, as specified in the ccgx dbus-api document
+	dbusservice.add_path('/Mgmt/ProcessName', __file__)
+	dbusservice.add_path('/Mgmt/ProcessVersion', 'Unknown and Python ' + platform.python_version())
+	dbusservice.add_path('/Mgmt/Connection', device.connection)
+
+	# Create the mandatory objects
+	dbusservice.add_path('/DeviceInstance',  device.instance)
+	dbusservice.add_path('/ProductId',       driver['id'])
+	dbusservice.add_path('/ProductName',     driver['name'])
+	dbusservice.add_path('/FirmwareVersion', driver['version'])
+	dbusservice.add_path('/HardwareVersion', driver['version'])
+	dbusservice.add_path('/Serial',          driver['serial'])
+	dbusservice.add_path('/Connected',       1)
+
+	# Create alarms, diagnostics and the chargery bms paths
+	for (path, value) in SERVICE_PATHS:
+		dbusservice.add_path(path, value)
+	dbusservice.add_path('/Diagnostics/StageTimers', 0, writeable=True, onchangecallback=handle_stage_timers_change)
+
+	# Create device list
+	dbusservice.add_path('/Devices/0/DeviceInstance',  device.instance)
+	dbusservice.add_path('/Devices/0/FirmwareVersion', driver['version'])
+	dbusservice.add_path('/Devices/0/ProductId',       driver['id'])
+	dbusservice.add_path('/Devices/0/ProductName',     driver['name'])
+	dbusservice.add_path('/Devices/0/ServiceName',     driver['servicename'])
+	dbusservice.add_path('/Devices/0/VregLink',        "(API)")
+
+
+# Adds the voltage and impedance paths of the cells above the ones already
+# registered. A BMS8 only gets 8 cells instead of the 24 of a BMS24, the
+# impedances frame can show its cells before the first cells frame.
+def add_cell_paths(device, cell_count):
+	if (cell_count <= device.cell_paths):
+		return
+	for i in range(device.cell_paths, cell_count):
+		device.dbusservice.add_path(CELL_VOLTAGE_PATHS[i],       -1)
+		device.dbusservice.add_path(CELL_IMPEDANCE_PATHS[i],     -1)
+		device.dbusservice.add_path(CELL_VOLTAGE_RAW_PATHS[i],   -1)
+		device.dbusservice.add_path(CELL_IMPEDANCE_RAW_PATHS[i], -1)
+	logging.info("%sCell paths added for %d cells", device.label, cell_count)
+	device.cell_paths = cell_count
+
+
+# Registers the service of the combined battery
+def create_aggregate_service(aggregator, instance):
+	from vedbus import VeDbusService
+
+	dbusservice = VeDbusService(AGGREGATE_CONNECTION, service_bus(True))
+	aggregator.publisher = DbusPublisher(dbusservice)
+
+	dbusservice.add_path('/Mgmt/ProcessName', __file__)
+	dbusservice.add_path('/Mgmt/ProcessVersion', 'Unknown and Python ' + platform.python_version())
+	# without -d (--test, --replay) the devices have no port name
+	dbusservice.add_path('/Mgmt/Connection', ", ".join(device.connection if (device.name is None) else device.name for device in aggregator.devices))
+
+	dbusservice.add_path('/DeviceInstance',  instance)
+	dbusservice.add_path('/ProductId',       driver['id'])
+	dbusservice.add_path('/ProductName',     AGGREGATE_NAME)
+	dbusservice.add_path('/FirmwareVersion', driver['version'])
+	dbusservice.add_path('/HardwareVersion', driver['version'])
+	dbusservice.add_path('/Serial',          driver['serial'])
+	dbusservice.add_path('/Connected',       1)
+	dbusservice.add_path('/System/NrOfBatteries', len(aggregator.devices))
+
+	dbusservice.add_path('/Info/Soc',                      -1)
+	dbusservice.add_path('/Info/Current',                  -1)
+	dbusservice.add_path('/Info/ChargeRelayStatus',        -1)
+	dbusservice.add_path('/Info/DischargeRelayStatus',     -1)
+	dbusservice.add_path('/Voltages/Min',                  -1)
+	dbusservice.add_path('/Voltages/Max',                  -1)
+	dbusservice.add_path('/Voltages/MinPack',              -1)
+	dbusservice.add_path('/Voltages/MinCell',              -1)
+	dbusservice.add_path('/Voltages/MaxPack',              -1)
+	dbusservice.add_path('/Voltages/MaxCell',              -1)
+	dbusservice.add_path('/Raw/Info/Soc',                  -1)
+	dbusservice.add_path('/Raw/Info/Current',              -1)
+	dbusservice.add_path('/Raw/Info/ChargeRelayStatus',    -1)
+	dbusservice.add_path('/Raw/Info/DischargeRelayStatus', -1)
+	dbusservice.add_path('/Raw/Voltages/Min',              -1)
+	dbusservice.add_path('/Raw/Voltages/Max',              -1)
+
+	# the paths of the Victron battery API
+	dbusservice.add_path('/Dc/0/Current',            None)
+	dbusservice.add_path('/Soc',                     None)
+	dbusservice.add_path('/Io/AllowToCharge',        None)
+	dbusservice.add_path('/Io/AllowToDischarge',     None)
+	dbusservice.add_path('/System/MinCellVoltage',   None)
+	dbusservice.add_path('/System/MaxCellVoltage',   None)
+	dbusservice.add_path('/System/MinVoltageCellId', None)
+	dbusservice.add_path('/System/MaxVoltageCellId', None)
+
+
+# Opens the serial port of the device, returns False if it failed. The
+# fallback to /dev/ttyUSB1 is only used at the start of a single BMS,
+# with several BMS or on a reconnect it could take the port of another.
+def open_serial_port(device, fallback=False):
+	try:
+
+		logging.info("Open serial port " + device.name)
+		device.serial_port = serial.Serial(device.name, 115200, timeout=1)
+
+	except Exception as e:
+		print(e);
+		print(traceback.format_exc())
+
+		logging.info("Serial port failed at " + device.name)
+
+		# try /dev/ttyUSB1, if /dev/ttyUSB0 is
+		# blocked because of a shutdown
+		if (fallback and (device.name == "/dev/ttyUSB0")):
+			try:
+
+				new_device = "/dev/ttyUSB1"
+				logging.info("Open serial port " + new_device)
+				device.serial_port = serial.Serial(new_device, 115200, timeout=1)
+
+			except Exception as e:
+
+				print(e);
+				print(traceback.format_exc())
+
+				logging.info("Serial port failed at " + new_device)
+
+				return False
+
+			else:
+				if args.victron:
+					device.publisher['/Alarms/InternalFailure'] = 1
+
+		else:
+			return False
+
+
+	device.serial_port.flushInput()
+	logging.info(device.serial_port.name)
+	if args.victron:
+		device.publisher['/Mgmt/Connection'] = device.serial_port.name
+		device.queue.schedule()
+	return True
+
+
+def main():
+	global args, bms_device, devices, aggregator, profile_writer, mainloop
+
+	args = parser.parse_args()
+	if ((args.device is None) and (args.replay is None) and (not args.test) and (args.probe is None)):
+		parser.error('the following arguments are required: -d/--device')
+	if ((args.history_dump is not None) and (args.history == 0)):
+		parser.error('--history-dump needs --history')
+
+	logging.info("Starting Chargery BMS driver " + str(driver['version']))
+
+	if args.debug: # switch to debug level
+		logger = logging.getLogger()
+		logger.setLevel(logging.DEBUG)
+
+	# the found ports are driven as if they were given with -d
+	if (args.probe is not None):
+		if (args.device is not None):
+			candidates = args.device
+		else:
+			candidates = sorted(name for pattern in PROBE_PATTERNS for name in glob.glob(pattern))
+		args.device = probe_serial_ports(candidates, args.probe, args.probe_time)
+		if (len(args.device) == 0):
+			sys.exit(1)
+
+	# one BMS per -d, they share this process and its main loop
+	several = ((args.device is not None) and (len(args.device) > 1))
+	if (args.device is not None):
+		devices = [BmsDevice(name, number, bms_state if (number == 0) else None, ("[" + os.path.basename(name) + "] ") if several else "")
+			for (number, name) in enumerate(args.device)]
+		bms_device = devices[0]
+
+	if args.aggregate:
+		logging.info("Aggregate of " + str(len(devices)) + " BMS")
+		aggregator = PackAggregator(devices)
+
+	if (args.log_digest > 0):
+		logging.info("Log digest every " + str(args.log_digest) + "s")
+		for device in devices:
+			device.log_digest = LogDigest(args.log_digest, device.label)
+
+	if (args.history > 0):
+		for device in devices:
+			device.history = BmsHistory(args.history)
+		logging.info("History of " + str(args.history) + " minutes, " + str(devices[0].history.memory() // 1024) + " KiB per BMS")
+
+	# with several BMS every one gets a sub directory
+	if (args.store is not None):
+		logging.info("History files in " + args.store + " written every " + str(args.store_interval) + "s")
+		for device in devices:
+			device.store = HistoryStore(os.path.join(args.store, os.path.basename(device.name)) if several else args.store, args.store_interval)
+
+	# kill -USR1 dumps the latency percentiles to the log and the history
+	# to --history-dump, kill -USR2 switches the stage timers on and off,
+	# kill -TERM writes the history files and stops the driver
+	signal.signal(signal.SIGUSR1, dump_latency)
+	signal.signal(signal.SIGUSR2, toggle_stage_timers)
+	signal.signal(signal.SIGTERM, stop_driver)
+
+	profile_writer = None
+	if (args.profile is not None):
+		logging.info("Profile to " + args.profile + " every " + str(args.profile_interval) + "s")
+		profile_writer = ProfileWriter(args.profile, args.profile_interval)
+
+
+	# victron stuff should be used
+	if args.victron:
+
+		# Victron packages
+		sys.path.insert(1, os.path.join(os.path.dirname(__file__), './ext/velib_python'))
+
+
+		from dbus.mainloop.glib import DBusGMainLoop
+		DBusGMainLoop(set_as_default=True)
+
+		for device in devices:
+			create_service(device, several or args.aggregate)
+		if (aggregator is not None):
+			create_aggregate_service(aggregator, driver['instance'] + len(devices))
+
+		gobject.timeout_add(DIAGNOSTICS_INTERVAL * 1000, publish_diagnostics)
+		if (profile_writer is not None):
+			gobject.timeout_add(args.profile_interval * 1000, profile_writer.write)
+
+
+	if (args.test or (args.replay is not None)):
+		if args.test:
+			passed = test_packets(devices[0])
+		else:
+			if args.max:
+				passed = replay_chunks(devices[0], read_capture(args.replay)) > 0
+			else:
+				passed = replay_chunks(devices[0], read_capture(args.replay), args.speed) > 0
+
+		if (profile_writer is not None):
+			profile_writer.write()
+
+		for device in devices:
+			device.close()
+
+		# keep the replayed values on D-Bus until the driver is stopped
 		if args.victron:
-			dbusservice['/Alarms/InternalFailure'] = 1
+			mainloop = gobject.MainLoop()
+			mainloop.run()
+
+		sys.exit(0 if passed else 1)
+
+
+	# with several BMS every one gets its own capture file
+	if (args.record is not None):
+		logging.info("Record serial data to " + args.record)
+		for device in devices:
+			device.recorder = CaptureRecorder((args.record + "." + os.path.basename(device.name)) if several else args.record)
+
 
-		serial_port.close()
-		quit()
+	# a port that can not be opened at the start ends the driver, so the
+	# serial-starter can try the other drivers, later it is reconnected
+	for device in devices:
+		if not open_serial_port(device, len(devices) == 1):
+			for other_device in devices:
+				other_device.close()
+			quit()
+
+
+	if (args.stale > 0):
+		logging.info("Stale after " + str(args.stale) + "s without a frame")
+		for device in devices:
+			device.watchdog = StaleWatchdog(device, args.stale)
 
 
-if args.victron:
-	gobject.timeout_add(1000, handle_serial_data)
-	mainloop = gobject.MainLoop()
-	mainloop.run()
-else:
-	while True:
-		handle_serial_data()
-		time.sleep(1)
+	if args.victron:
+		for device in devices:
+			watch_serial_port(device)
+		if (args.stale > 0):
+			gobject.timeout_add(STALE_CHECK_INTERVAL * 1000, check_watchdogs)
+		if (args.log_digest > 0):
+			gobject.timeout_add_seconds(args.log_digest, write_log_digests)
+		mainloop = gobject.MainLoop()
+		mainloop.run()
+	else:
+		while True:
+			if args.event_driven:
+				select.select([device.serial_port for device in devices if (device.serial_port is not None)], [], [], STALE_CHECK_INTERVAL)
+			else:
+				time.sleep(STALE_CHECK_INTERVAL)
+			now = time.monotonic()
+			for device in devices:
+				if (device.serial_port is not None):
+					handle_serial_data(device)
+				elif (now >= device.reconnect.due):
+					reconnect_serial_port(device)
+				if (device.watchdog is not None):
+					device.watchdog.check(now)
+				if (device.log_digest is not None):
+					device.log_digest.check(time.time())
+				if (device.store is not None):
+					device.store.compress_step()
+			if (profile_writer is not None):
+				profile_writer.check()
+
+
+if __name__ == "__main__":
+	main()
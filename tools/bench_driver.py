@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# Benchmark suite for the driver: end-to-end throughput on valid,
+# interleaved, corrupted and truncated streams, time per frame for every
+# stage and memory allocations per frame. Results are printed as a table
+# and can be written as JSON to compare driver versions.
+#
+#	python tools/bench_driver.py [--json FILE] [--frames N] [--rounds N]
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../driver'))
+import chargerybms
+import frames
+
+
+# Stands in for the VeDbusService, stores the values like velib does
+class BenchmarkService(dict):
+
+	def add_path(self, path, value, **options):
+		self[path] = value
+
+
+def setup_driver(victron):
+	options = ['-d', 'benchmark']
+	if victron:
+		options.append('--victron')
+	chargerybms.args = chargerybms.parser.parse_args(options)
+	chargerybms.bms_device.dbusservice = BenchmarkService()
+	chargerybms.bms_device.publisher   = chargerybms.DbusPublisher(chargerybms.bms_device.dbusservice)
+	chargerybms.bms_device.cell_paths  = 0
+
+
+def best_time(function, rounds):
+	best = None
+	for i in range(rounds):
+		start = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - start
+		if ((best is None) or (elapsed < best)):
+			best = elapsed
+	return best
+
+
+def feed_stream(stream, chunk_size):
+	framer = chargerybms.PacketFramer(chargerybms.bms_device)
+	for chunk in frames.chunks(stream, chunk_size):
+		framer.feed(chunk)
+		if chargerybms.args.victron:
+			chargerybms.bms_device.publisher.flush()
+	return framer
+
+
+def bench_scenarios(rnd, frame_count, rounds, chunk_size):
+	cycles = max(1, frame_count // 3)
+	streams = []
+	for kind in sorted(frames.packet_kinds()):
+		streams.append(('valid_' + kind, frames.stream_valid(rnd, kind, frame_count)))
+	streams.append(('interleaved24', frames.stream_interleaved(rnd, 24, cycles)))
+	streams.append(('corrupted24', frames.stream_corrupted(rnd, 24, cycles)))
+	streams.append(('truncated24', frames.stream_truncated(rnd, 24, cycles)))
+
+	results = {}
+	for (name, (stream, expected)) in streams:
+		framer = feed_stream(stream, chunk_size)
+		elapsed = best_time(lambda: feed_stream(stream, chunk_size), rounds)
+		results[name] = {
+			'bytes'           : len(stream),
+			'frames_expected' : expected,
+			'frames_decoded'  : framer.frames,
+			'checksum_errors' : framer.checksum_errors,
+			'bytes_dropped'   : framer.bytes_dropped,
+			'frames_per_s'    : framer.frames / elapsed,
+			'us_per_frame'    : (elapsed * 1000000) / max(framer.frames, 1)
+		}
+	return results
+
+
+def bench_stages(rnd, frame_count, rounds):
+	results = {}
+	generators = frames.packet_kinds()
+	no_decoders = dict((packet_type, lambda device, frame: None) for packet_type in chargerybms.PACKET_DECODERS)
+
+	for kind in sorted(generators):
+		packets = [generators[kind](rnd) for i in range(frame_count)]
+		stream = b''.join(packets)
+		decoder = chargerybms.PACKET_DECODERS[bytearray(packets[0])[2]]
+		aggregate = None
+		if kind.startswith('cells'):
+			aggregate = chargerybms.aggregate_voltages
+		elif kind.startswith('impedances'):
+			aggregate = chargerybms.aggregate_impedances
+
+		def framing_checksum():
+			chargerybms.PacketFramer(decoders=no_decoders).parse(stream)
+
+		def checksum():
+			for packet in packets:
+				view = memoryview(packet)
+				(sum(view) - view[-1]) & 0xFF
+
+		def decode():
+			for packet in packets:
+				decoder(chargerybms.bms_device, memoryview(packet))
+
+		def decode_publish():
+			for packet in packets:
+				decoder(chargerybms.bms_device, memoryview(packet))
+				chargerybms.bms_device.publisher.flush()
+
+		def aggregate_only():
+			for packet in packets:
+				aggregate(chargerybms.bms_device)
+
+		time_framing_checksum = best_time(framing_checksum, rounds)
+		time_checksum = best_time(checksum, rounds)
+
+		setup_driver(False)
+		time_decode = best_time(decode, rounds)
+		time_aggregate = 0.0
+		if (aggregate is not None):
+			time_aggregate = best_time(aggregate_only, rounds)
+
+		setup_driver(True)
+		time_publish = best_time(decode_publish, rounds) - time_decode
+
+		results[kind] = {
+			'framing_us'   : ((time_framing_checksum - time_checksum) * 1000000) / frame_count,
+			'checksum_us'  : (time_checksum * 1000000) / frame_count,
+			'decode_us'    : ((time_decode - time_aggregate) * 1000000) / frame_count,
+			'aggregate_us' : (time_aggregate * 1000000) / frame_count,
+			'publish_us'   : (max(time_publish, 0.0) * 1000000) / frame_count
+		}
+	return results
+
+
+# Summed peak bytes of handle() for every packet, traced by tracemalloc
+def peak_loop(packets, handle):
+	gc.collect()
+	tracemalloc.start()
+	peak_total = 0
+	for packet in packets:
+		current = tracemalloc.get_traced_memory()[0]
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		handle(packet)
+		peak_total += tracemalloc.get_traced_memory()[1] - current
+	tracemalloc.stop()
+	return peak_total
+
+
+# Memory blocks still allocated after handle() for every packet, counted
+# without tracemalloc since its traces are blocks as well
+def blocks_loop(packets, handle):
+	gc.collect()
+	blocks_start = sys.getallocatedblocks()
+	for packet in packets:
+		handle(packet)
+	gc.collect()
+	return sys.getallocatedblocks() - blocks_start
+
+
+# Peak memory allocated while a frame is decoded and published, and the
+# number of memory blocks still allocated afterwards (should be 0). The
+# peak of an empty loop is the bookkeeping of tracemalloc, it is
+# subtracted. The random values never repeat, so the text caches would
+# grow by a few blocks per frame until TEXT_CACHE_SIZE, they keep one
+# entry during the measurement.
+def bench_allocations(rnd, frame_count):
+	results = {}
+	generators = frames.packet_kinds()
+	setup_driver(True)
+	text_cache_size = chargerybms.TEXT_CACHE_SIZE
+	chargerybms.TEXT_CACHE_SIZE = 1
+
+	for kind in sorted(generators):
+		packets = [generators[kind](rnd) for i in range(frame_count)]
+		framer = chargerybms.PacketFramer(chargerybms.bms_device)
+
+		def feed_publish(packet):
+			framer.feed(packet)
+			chargerybms.bms_device.publisher.flush()
+
+		# warm up, the first frame creates the state and the published values,
+		# the second one leaves one entry in each text cache
+		feed_publish(packets[0])
+		feed_publish(packets[1])
+
+		baseline = peak_loop(packets, lambda packet: None)
+		results[kind] = {
+			'peak_bytes_per_frame' : (peak_loop(packets, feed_publish) - baseline) / float(frame_count),
+			'net_blocks_per_frame' : blocks_loop(packets, feed_publish) / float(frame_count)
+		}
+
+	chargerybms.TEXT_CACHE_SIZE = text_cache_size
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Chargery BMS driver benchmark suite')
+	parser.add_argument('--frames', type=int, default=300, help='frames per measurement (default 300)')
+	parser.add_argument('--rounds', type=int, default=3, help='rounds per measurement, the best one is reported')
+	parser.add_argument('--chunk', type=int, default=64, help='serial read size in bytes for the stream scenarios')
+	parser.add_argument('--seed', type=int, default=1, help='random seed for the generated frames')
+	parser.add_argument('--json', metavar='FILE', help='write the results as JSON, - for stdout')
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+	rnd = random.Random(args.seed)
+
+	setup_driver(True)
+	results = {
+		'driver_version' : chargerybms.driver['version'],
+		'python'         : platform.python_version(),
+		'machine'        : platform.machine(),
+		'frames'         : args.frames,
+		'chunk'          : args.chunk,
+		'seed'           : args.seed,
+		'scenarios'      : bench_scenarios(rnd, args.frames, args.rounds, args.chunk),
+		'stages'         : bench_stages(rnd, args.frames, args.rounds),
+		'allocations'    : bench_allocations(rnd, args.frames)
+	}
+
+	if (args.json == '-'):
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		return
+
+	print("{:<20} {:>8} {:>8} {:>12} {:>10}".format("scenario", "decoded", "expected", "frames/s", "us/frame"))
+	for (name, result) in sorted(results['scenarios'].items()):
+		print("{:<20} {:>8} {:>8} {:>12.0f} {:>10.1f}".format(name, result['frames_decoded'], result['frames_expected'], result['frames_per_s'], result['us_per_frame']))
+	print("")
+	print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage us/frame", "framing", "checksum", "decode", "aggregate", "publish"))
+	for (name, result) in sorted(results['stages'].items()):
+		print("{:<20} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, result['framing_us'], result['checksum_us'], result['decode_us'], result['aggregate_us'], result['publish_us']))
+	print("")
+	print("{:<20} {:>16} {:>16}".format("allocations", "peak bytes/frame", "net blocks/frame"))
+	for (name, result) in sorted(results['allocations'].items()):
+		print("{:<20} {:>16.0f} {:>16.2f}".format(name, result['peak_bytes_per_frame'], result['net_blocks_per_frame']))
+
+	if (args.json is not None):
+		with open(args.json, 'w') as output:
+			json.dump(results, output, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Framing benchmark: compares the old re-slicing parse loop with the
+# cursor based PacketFramer on a 64 KiB burst of BMS24 frames.
+#
+#	python tools/bench_framer.py [--size BYTES] [--rounds N]
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../driver'))
+import chargerybms
+import frames
+
+
+def build_burst(size):
+	rnd = random.Random(1)
+	sequence = frames.interleaved(rnd, 24)
+	burst = sequence * (size // len(sequence))
+	return bytearray(burst), (size // len(sequence)) * 3
+
+
+# Copy of the framing loop of parse_packet() before the framer rewrite,
+# the decoding is replaced by a counter to measure framing only.
+def legacy_get_header_position(packet):
+	previous_packet_byte = "0"
+	pos_iterator = -1
+	for packet_byte in packet:
+		pos_iterator += 1
+		if ((previous_packet_byte == chargerybms.PACKET_HEADER) and (packet_byte == chargerybms.PACKET_HEADER)):
+			break
+		previous_packet_byte = packet_byte
+	return pos_iterator
+
+
+def legacy_parse_packet(packet):
+	frame_count = 0
+	while (len(packet) >= chargerybms.PACKET_LENGTH_MINIMUM):
+		header_position = legacy_get_header_position(packet)
+		if ((header_position == -1) or (header_position == len(packet) - 1)):
+			packet = ""
+		else:
+			packet = packet[(header_position - 1):]
+			packet_length = packet[3]
+			checksum = packet[packet_length-1]
+			checksum_check = 0
+			for i in range(packet_length-1):
+				checksum_check = checksum_check + packet[i]
+			checksum_check = checksum_check % 256
+			if (checksum == checksum_check):
+				frame_count += 1
+			packet = packet[packet_length:]
+	return frame_count
+
+
+def run(label, function, burst, frame_count, rounds):
+	best = None
+	for i in range(rounds):
+		start = time.perf_counter()
+		function(burst)
+		elapsed = time.perf_counter() - start
+		if ((best is None) or (elapsed < best)):
+			best = elapsed
+	print("{:<28} {:>12.0f} frames/s {:>10.1f} us/frame".format(label, frame_count / best, (best * 1000000) / frame_count))
+	return frame_count / best
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Chargery BMS framing benchmark')
+	parser.add_argument('--size', type=int, default=64 * 1024, help='burst size in bytes (default 64 KiB)')
+	parser.add_argument('--rounds', type=int, default=5, help='rounds per measurement, the best one is reported')
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+	chargerybms.args = chargerybms.parser.parse_args(['-d', 'benchmark'])
+
+	burst, frame_count = build_burst(args.size)
+	print("burst: " + str(len(burst)) + " bytes, " + str(frame_count) + " frames")
+
+	counting = {}
+	for packet_type in chargerybms.PACKET_DECODERS:
+		counting[packet_type] = lambda device, frame: None
+
+	before = run("legacy parse_packet", legacy_parse_packet, burst, frame_count, args.rounds)
+	after  = run("PacketFramer.parse", lambda data: chargerybms.PacketFramer(decoders=counting).parse(data), burst, frame_count, args.rounds)
+	run("PacketFramer.parse + decode", lambda data: chargerybms.PacketFramer(chargerybms.bms_device).parse(data), burst, frame_count, args.rounds)
+
+	print("framing speedup: {:.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+	main()
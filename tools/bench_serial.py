@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# Serial read benchmark: a child process writes interleaved BMS24 frames
+# into a pty at the byte rate of the baud rate, the driver reads and
+# frames them like with --event-driven, or every --poll seconds like
+# without it. Compares the former read path
+# (pyserial read() and a growing bytearray) with the reads straight into
+# the receive buffer of the PacketFramer. Reports bytes/s, CPU time per
+# read and the heap bytes allocated per read (tracemalloc peak).
+#
+#	python tools/bench_serial.py [--baud BAUD] [--seconds N] [--poll SECONDS]
+
+import argparse
+import fcntl
+import logging
+import os
+import random
+import select
+import struct
+import sys
+import termios
+import time
+import tracemalloc
+import tty
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../driver'))
+import chargerybms
+import frames
+
+
+# 8N1, ten bits per byte
+BITS_PER_BYTE = 10
+
+# the writer sends one slice every 10 ms
+WRITE_INTERVAL = 0.01
+
+
+# Stands in for the pyserial port on the slave side of the pty, in_waiting
+# is the FIONREAD ioctl like pyserial's posix implementation
+class PtyPort(object):
+
+	def __init__(self, fd):
+		self.fd = fd
+
+	@property
+	def in_waiting(self):
+		return struct.unpack('I', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+	# copy of the posix read() of pyserial without the select()
+	def read(self, size):
+		read = bytearray()
+		while (len(read) < size):
+			read.extend(os.read(self.fd, size - len(read)))
+		return bytes(read)
+
+	def readinto(self, view):
+		data = self.read(len(view))
+		view[:len(data)] = data
+		return len(data)
+
+
+# Read and framing before the receive buffer: the data is read into a new
+# bytes object, appended to the carried bytes and the consumed bytes are
+# cut off the front.
+class LegacyReader(object):
+
+	def __init__(self, framer):
+		self.framer = framer
+		self.buffer = bytearray()
+
+	# copy of the former PacketFramer.feed()
+	def read(self, port, bytes_waiting):
+		data = port.read(bytes_waiting)
+		self.framer.arrival = time.monotonic()
+		self.framer.bytes_received += len(data)
+		self.buffer.extend(data)
+		logging.debug("Parse Packet [%d] bytes", len(self.buffer))
+		chargerybms.debug_packet(self.buffer)
+
+		consumed = self.framer.parse(self.buffer)
+		if (consumed > 0):
+			del self.buffer[:consumed]
+
+		self.framer.bytes_carried = len(self.buffer)
+		logging.debug("Framer [CARRIED|%d bytes][DROPPED|%d bytes][RESYNCS|%d]", self.framer.bytes_carried, self.framer.bytes_dropped, self.framer.resyncs)
+		return len(data)
+
+
+class BufferReader(object):
+
+	def __init__(self, framer):
+		self.framer = framer
+
+	def read(self, port, bytes_waiting):
+		total = 0
+		while (bytes_waiting > 0):
+			view = self.framer.receive_view(bytes_waiting)
+			byte_count = chargerybms.read_serial(port, view)
+			if (byte_count == 0):
+				break
+			self.framer.received(byte_count)
+			bytes_waiting -= byte_count
+			total += byte_count
+		return total
+
+
+def write_paced(fd, baud, seconds):
+	rnd = random.Random(1)
+	stream = bytearray()
+	while (len(stream) < 65536):
+		stream += frames.interleaved(rnd, 24)
+
+	slice_size = int((baud / BITS_PER_BYTE) * WRITE_INTERVAL)
+	started = time.monotonic()
+	position = 0
+	sent = 0
+	while (time.monotonic() - started < seconds):
+		if ((position + slice_size) > len(stream)):
+			position = 0
+		os.write(fd, stream[position:position + slice_size])
+		position += slice_size
+		sent += slice_size
+		# keep the average byte rate, not the slice interval
+		delay = started + ((sent / (baud / BITS_PER_BYTE))) - time.monotonic()
+		if (delay > 0):
+			time.sleep(delay)
+
+
+def run(label, reader_class, baud, seconds, poll, trace):
+	master, slave = os.openpty()
+	tty.setraw(slave)
+
+	writer = os.fork()
+	if (writer == 0):
+		os.close(slave)
+		try:
+			write_paced(master, baud, seconds)
+		finally:
+			os._exit(0)
+	os.close(master)
+
+	counting = {}
+	for packet_type in chargerybms.PACKET_DECODERS:
+		counting[packet_type] = lambda device, frame: None
+	framer = chargerybms.PacketFramer(decoders=counting)
+	reader = reader_class(framer)
+	port   = PtyPort(slave)
+
+	reads = 0
+	allocated = 0
+	cpu = 0.0
+	started = time.monotonic()
+	while True:
+		if (poll > 0):
+			time.sleep(poll)
+		(readable, writable, errors) = select.select([slave], [], [], 0.5)
+		if not readable:
+			break
+		try:
+			bytes_waiting = port.in_waiting
+		except OSError:
+			break
+		if (bytes_waiting == 0):
+			# writer closed the pty
+			break
+
+		if trace:
+			if hasattr(tracemalloc, 'reset_peak'):
+				tracemalloc.reset_peak()
+			(before, peak) = tracemalloc.get_traced_memory()
+		cpu_before = time.process_time()
+		reader.read(port, bytes_waiting)
+		cpu += time.process_time() - cpu_before
+		if trace:
+			(current, peak) = tracemalloc.get_traced_memory()
+			allocated += peak - before
+		reads += 1
+	elapsed = time.monotonic() - started
+
+	os.waitpid(writer, 0)
+	os.close(slave)
+
+	print("{:<10} {:>10.0f} bytes/s {:>8d} frames {:>7d} reads {:>8.1f} us cpu/read {:>8.0f} bytes alloc/read".format(
+		label, framer.bytes_received / elapsed, framer.frames, reads, (cpu * 1000000) / max(reads, 1),
+		(allocated / max(reads, 1)) if trace else float('nan')))
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Chargery BMS serial read benchmark')
+	parser.add_argument('--baud', type=int, default=115200, help='byte rate of the writer as baud rate, 8N1 (default 115200)')
+	parser.add_argument('--seconds', type=int, default=3, help='seconds per measurement (default 3)')
+	parser.add_argument('--poll', type=float, default=0, help='read every POLL seconds instead of on every arrival')
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+	chargerybms.args = chargerybms.parser.parse_args(['-d', 'benchmark'])
+
+	print("writer: " + str(args.baud) + " baud, " + str(args.baud // BITS_PER_BYTE) + " bytes/s for " + str(args.seconds) + "s, " +
+		(("read every " + str(args.poll) + "s") if (args.poll > 0) else "read on arrival"))
+
+	# the allocations are traced in an extra run, tracemalloc slows the reads
+	run("legacy", LegacyReader, args.baud, args.seconds, args.poll, False)
+	run("readv", BufferReader, args.baud, args.seconds, args.poll, False)
+	tracemalloc.start()
+	run("legacy", LegacyReader, args.baud, args.seconds, args.poll, True)
+	run("readv", BufferReader, args.baud, args.seconds, args.poll, True)
+	tracemalloc.stop()
+
+
+if __name__ == "__main__":
+	main()
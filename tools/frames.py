@@ -0,0 +1,122 @@
+# Synthetic Chargery BMS network packets for the benchmarks and the
+# simulator. All generators take a random.Random instance, so streams
+# are reproducible with the same seed.
+
+import struct
+
+PACKET_HEADER            = 0x24
+PACKET_STATUS_CELLS      = 0x56
+PACKET_STATUS_BMS        = 0x57
+PACKET_STATUS_IMPEDANCES = 0x58
+
+CELL_COUNTS = (8, 16, 24)
+
+
+def checksum_packet(packet):
+	packet.append(sum(packet) & 0xFF)
+	return bytes(packet)
+
+
+def status_cells(rnd, cell_count, millivolts=3300):
+	packet = bytearray([PACKET_HEADER, PACKET_HEADER, PACKET_STATUS_CELLS, 4 + (2 * cell_count) + 8 + 1])
+	for i in range(cell_count):
+		packet += struct.pack('>H', millivolts + rnd.randint(-40, 40))
+	packet += struct.pack('<II', rnd.randint(0, 20000000), rnd.randint(0, 400000))
+	return checksum_packet(packet)
+
+
+def status_bms(rnd):
+	current_mode = rnd.randint(0, 2)
+	temperatures = []
+	for i in range(2):
+		# temperatures below 0 degree celsius are sent as 65536 - value
+		temperature = rnd.randint(-150, 450)
+		if (temperature < 0):
+			temperature = 65536 + temperature
+		temperatures.append(temperature)
+
+	packet = bytearray([PACKET_HEADER, PACKET_HEADER, PACKET_STATUS_BMS, 19])
+	packet += struct.pack('>HBHHHBHBB', 3650, current_mode, rnd.randint(0, 2000), temperatures[0], temperatures[1],
+		rnd.randint(0, 100), 2800, rnd.randint(0, 1), rnd.randint(0, 1))
+	return checksum_packet(packet)
+
+
+def status_impedances(rnd, cell_count):
+	packet = bytearray([PACKET_HEADER, PACKET_HEADER, PACKET_STATUS_IMPEDANCES, 8 + (2 * cell_count), rnd.randint(0, 1)])
+	packet += struct.pack('<H', rnd.randint(0, 2000))
+	for i in range(cell_count):
+		packet += struct.pack('<H', rnd.randint(80, 200))
+	return checksum_packet(packet)
+
+
+def packet_kinds():
+	kinds = {'status': lambda rnd: status_bms(rnd)}
+	for cell_count in CELL_COUNTS:
+		kinds['cells' + str(cell_count)] = (lambda cell_count: lambda rnd: status_cells(rnd, cell_count))(cell_count)
+		kinds['impedances' + str(cell_count)] = (lambda cell_count: lambda rnd: status_impedances(rnd, cell_count))(cell_count)
+	return kinds
+
+
+# One BMS cycle as sent by the device: cells, status and impedances
+def interleaved(rnd, cell_count):
+	return status_cells(rnd, cell_count) + status_bms(rnd) + status_impedances(rnd, cell_count)
+
+
+def corrupt(rnd, packet):
+	packet = bytearray(packet)
+	position = rnd.randint(2, len(packet) - 1)
+	packet[position] ^= 1 << rnd.randint(0, 7)
+	return bytes(packet)
+
+
+def truncate(rnd, packet):
+	return packet[:rnd.randint(1, len(packet) - 1)]
+
+
+def noise(rnd, length):
+	return bytes(bytearray(rnd.randint(0, 255) for i in range(length)))
+
+
+# Stream of frames of one kind. Returns the stream and the number of
+# frames a perfect decoder would decode from it.
+def stream_valid(rnd, kind, frame_count):
+	generator = packet_kinds()[kind]
+	return b''.join(generator(rnd) for i in range(frame_count)), frame_count
+
+
+def stream_interleaved(rnd, cell_count, cycles):
+	return b''.join(interleaved(rnd, cell_count) for i in range(cycles)), cycles * 3
+
+
+# Every frame is corrupted with the given probability, noise bytes are
+# inserted between some of the frames
+def stream_corrupted(rnd, cell_count, cycles, probability=0.1):
+	stream = bytearray()
+	valid = 0
+	for i in range(cycles * 3):
+		packet = (status_cells(rnd, cell_count), status_bms(rnd), status_impedances(rnd, cell_count))[i % 3]
+		if (rnd.random() < probability):
+			packet = corrupt(rnd, packet)
+		else:
+			valid += 1
+		stream += packet
+		if (rnd.random() < probability):
+			stream += noise(rnd, rnd.randint(1, 16))
+	return bytes(stream), valid
+
+
+def stream_truncated(rnd, cell_count, cycles, probability=0.1):
+	stream = bytearray()
+	valid = 0
+	for i in range(cycles * 3):
+		packet = (status_cells(rnd, cell_count), status_bms(rnd), status_impedances(rnd, cell_count))[i % 3]
+		if (rnd.random() < probability):
+			packet = truncate(rnd, packet)
+		else:
+			valid += 1
+		stream += packet
+	return bytes(stream), valid
+
+
+def chunks(data, size):
+	return [data[i:i+size] for i in range(0, len(data), size)]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Simulated Chargery BMS on a pseudo terminal. Streams cells, status and
+# impedance frames to the slave side of a pty, the driver reads them with
+# -d /dev/pts/N (or the --link path). Noise, split writes, checksum errors,
+# truncated frames and disconnects can be injected. With --baud 0 and
+# --rate 0 the frames are written as fast as the reader drains them, which
+# shows the headroom of the driver against the 115200 baud data rate.
+#
+#	python tools/simulator.py --cells 24 --link /tmp/ttyCHGBMS
+#	python chargerybms.py -d /tmp/ttyCHGBMS
+
+import argparse
+import errno
+import os
+import random
+import select
+import sys
+import time
+import tty
+
+import frames
+
+
+class PseudoTerminal(object):
+
+	def __init__(self, link):
+		self.link = link
+		(self.master, self.slave) = os.openpty()
+
+		# raw mode, no echo and no line discipline translations
+		tty.setraw(self.slave)
+		self.name = os.ttyname(self.slave)
+
+		if (self.link is not None):
+			if os.path.lexists(self.link):
+				os.remove(self.link)
+			os.symlink(self.name, self.link)
+
+	# writes as much as the reader accepts within timeout, returns the
+	# number of bytes written
+	def write(self, data, timeout):
+		written = 0
+		deadline = time.time() + timeout
+		while (written < len(data)):
+			remaining = deadline - time.time()
+			if (remaining <= 0):
+				break
+			(readable, writable, failed) = select.select([], [self.master], [], remaining)
+			if (len(writable) == 0):
+				break
+			try:
+				written += os.write(self.master, data[written:])
+			except OSError as e:
+				if (e.errno != errno.EAGAIN):
+					raise
+		return written
+
+	def close(self):
+		if ((self.link is not None) and os.path.lexists(self.link)):
+			os.remove(self.link)
+		os.close(self.master)
+		os.close(self.slave)
+
+
+def build_cycle(rnd, args, stats):
+	cycle = bytearray()
+	for packet in (frames.status_cells(rnd, args.cells), frames.status_bms(rnd), frames.status_impedances(rnd, args.cells)):
+		if (rnd.random() < args.checksum_errors):
+			packet = frames.corrupt(rnd, packet)
+			stats['corrupted'] += 1
+		elif (rnd.random() < args.truncate):
+			packet = frames.truncate(rnd, packet)
+			stats['truncated'] += 1
+		else:
+			stats['frames'] += 1
+		cycle += packet
+		if (rnd.random() < args.noise):
+			cycle += frames.noise(rnd, rnd.randint(1, 16))
+	return bytes(cycle)
+
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Simulated Chargery BMS on a pseudo terminal')
+	parser.add_argument('--cells', type=int, choices=frames.CELL_COUNTS, default=24, help='cell count of the simulated BMS (default 24)')
+	parser.add_argument('--rate', type=float, default=1.0, help='frame cycles (cells, status, impedances) per second, 0 = unlimited (default 1)')
+	parser.add_argument('--baud', type=int, default=115200, help='emulated line speed, 0 = unlimited (default 115200)')
+	parser.add_argument('--noise', type=float, default=0.0, help='probability of noise bytes after a frame')
+	parser.add_argument('--checksum-errors', type=float, default=0.0, help='probability of a corrupted frame')
+	parser.add_argument('--truncate', type=float, default=0.0, help='probability of a truncated frame')
+	parser.add_argument('--split', type=int, default=0, help='split the writes in random pieces of up to SPLIT bytes')
+	parser.add_argument('--disconnect', type=float, default=0.0, help='close the pty every DISCONNECT seconds')
+	parser.add_argument('--downtime', type=float, default=2.0, help='seconds until the pty is reopened after a disconnect (default 2)')
+	parser.add_argument('--link', help='symlink to the current slave device, stays valid across disconnects')
+	parser.add_argument('--duration', type=float, default=0.0, help='stop after DURATION seconds')
+	parser.add_argument('--seed', type=int, default=1, help='random seed')
+	args = parser.parse_args()
+
+	rnd = random.Random(args.seed)
+	terminal = PseudoTerminal(args.link)
+	print("Simulated BMS" + str(args.cells) + " on " + terminal.name + ((" (" + args.link + ")") if args.link else ""))
+	sys.stdout.flush()
+
+	stats = {'frames': 0, 'corrupted': 0, 'truncated': 0, 'bytes': 0, 'stalled': 0, 'disconnects': 0}
+	start = time.time()
+	next_cycle = start
+	next_report = start + 1
+	next_disconnect = (start + args.disconnect) if (args.disconnect > 0) else None
+	report_bytes = 0
+
+	try:
+		while ((args.duration <= 0) or ((time.time() - start) < args.duration)):
+			now = time.time()
+
+			if ((next_disconnect is not None) and (now >= next_disconnect)):
+				print("Disconnect for " + str(args.downtime) + "s")
+				terminal.close()
+				time.sleep(args.downtime)
+				terminal = PseudoTerminal(args.link)
+				print("Reconnected on " + terminal.name)
+				sys.stdout.flush()
+				stats['disconnects'] += 1
+				next_disconnect = time.time() + args.disconnect
+
+			if ((args.rate > 0) and (now < next_cycle)):
+				time.sleep(min(next_cycle - now, 0.1))
+				continue
+			next_cycle += (1.0 / args.rate) if (args.rate > 0) else 0
+
+			cycle = build_cycle(rnd, args, stats)
+			pieces = [cycle]
+			if (args.split > 0):
+				pieces = []
+				position = 0
+				while (position < len(cycle)):
+					size = rnd.randint(1, args.split)
+					pieces.append(cycle[position:position+size])
+					position += size
+
+			for piece in pieces:
+				written = terminal.write(piece, 1.0)
+				stats['bytes'] += written
+				report_bytes += written
+				if (written < len(piece)):
+					# the reader does not drain the pty
+					stats['stalled'] += 1
+					break
+
+				if (args.baud > 0):
+					# 10 bits per byte on the line (start, 8 data, stop)
+					time.sleep(len(piece) * 10.0 / args.baud)
+
+			if (time.time() >= next_report):
+				elapsed = time.time() - next_report + 1
+				print("[FRAMES|" + str(stats['frames']) + "][CORRUPTED|" + str(stats['corrupted']) + "][TRUNCATED|" + str(stats['truncated']) +
+					"][STALLED|" + str(stats['stalled']) + "][DISCONNECTS|" + str(stats['disconnects']) +
+					"][RATE|" + "{:.0f}".format(report_bytes / elapsed) + " bytes/s, " + "{:.1f}".format((report_bytes * 10.0 / 115200) / elapsed) + "x 115200 baud]")
+				sys.stdout.flush()
+				report_bytes = 0
+				next_report = time.time() + 1
+
+	except KeyboardInterrupt:
+		pass
+
+	finally:
+		terminal.close()
+
+	elapsed = time.time() - start
+	print("Sent " + str(stats['frames']) + " valid frames, " + str(stats['bytes']) + " bytes in " + "{:.1f}".format(elapsed) + "s, " +
+		"{:.0f}".format(stats['bytes'] / max(elapsed, 0.000001)) + " bytes/s")
+
+
+if __name__ == "__main__":
+	main()